@@ -12,7 +12,7 @@ II. With that List do the following:
 
     C. Copy that job folder to a working folder.
 
-    D. ZIP the contents of that copied folder with the OSX Archive Utility
+    D. ZIP the contents of that folder, split into disc sized volumes when it won't fit on one disc
 
     E. Sort the ZIP into a Disk Folder
         1. Disk folder exists?
@@ -35,7 +35,45 @@ II. With that List do the following:
 
 
 """
-import openpyxl, os, time, subprocess, shutil, re, datetime
+import openpyxl, os, sys, stat, time, shutil, re, datetime, threading, struct, zlib, bisect, json, atexit, contextlib
+import hashlib, multiprocessing, sqlite3, errno, socket, fcntl
+from multiprocessing.pool import ThreadPool
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+cpu_clock = getattr(time, 'thread_time', time.time)  # per thread cpu time where python has it
+
+try:
+    zlib.compressobj(1, zlib.DEFLATED, -15, 8, zlib.Z_DEFAULT_STRATEGY, b'x')
+    deflate_window = 32768  # each piece of a large file is primed with the end of the one before, like pigz
+except TypeError:
+    deflate_window = 0  # python 2 can't prime a compressor, pieces start cold
+
+try:
+    import pyinotify  # optional, lets daemon mode wake on changes instead of polling
+except ImportError:
+    pyinotify = None
+
+try:
+    import xattr  # optional, reads extended attributes where os can't, macOS
+except ImportError:
+    xattr = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir  # backport for python 2
+    except ImportError:
+        scandir = None
 
 __author__ = 'Benjamin A. Slack, iam@niamjneb.com'
 __version__ = '0.0.0.1'
@@ -49,184 +87,261 @@ kWorkingPath = os.path.expanduser('~/tmp/Staging')
 kJobFolderPrefix = '/Jobs'
 kTrashFolderPrefix = '/Trash'
 kDiscFolderPrefix = 'Disc'
-kFullSize = 4294967296  # 4GB
+kImageReserve = 4194304  # left free on real media for the image's file system and sector padding
+kMediaProfiles = {  # bytes a disc folder may hold
+    'legacy': 4294967296,  # the original 4GB folders
+    'cd': 737280000 - kImageReserve,  # 80 minute CD-R
+    'dvd5': 4700372992 - kImageReserve,
+    'dvd9': 8543666176 - kImageReserve,
+    'bd25': 25025314816 - kImageReserve,
+}
+kMedia = 'legacy'
+kFullSize = kMediaProfiles[kMedia]
+kManifestAllowance = 512  # room a volume leaves on its disc for its manifest lines
+kWorkers = 4  # jobs cleaned up and compressed at the same time
+kPlacement = 'first_fit'  # 'first_fit', 'best_fit' or 'first_fit_decreasing' over the whole batch
+kVolumeSize = kFullSize - kManifestAllowance  # largest archive volume that still fits on an empty disc
+kSplitMode = 'fill'  # 'fill' sizes split volumes to the room left on open discs, 'fixed' makes them kVolumeSize
+kMinVolume = 16777216  # smallest gap on a disc worth filling with a split volume
+kBufferSize = 1048576  # 1MB reads and writes while archiving
+kFastLevel = 1  # deflate level for the 'fast' method
+kHighLevel = 9  # deflate level for the 'high' method
+kCompressWorkers = multiprocessing.cpu_count()  # threads deflating pieces of one large file at once
+kParallelMin = 8 * kBufferSize  # files at least this big are deflated in kBufferSize pieces on kCompressWorkers
+kCompressAhead = 2 * kCompressWorkers  # pieces of a file in flight at once, bounds the memory it takes
+kCompressAheadBytes = kCompressAhead * kBufferSize  # smaller files read ahead and deflating whole at once
+kAppleDouble = True  # keep resource forks and extended attributes as __MACOSX/._name entries, like ditto does
+kStoreExtensions = ['pdf', 'jpg', 'jpeg', 'png', 'gif', 'zip', 'gz', 'tgz', 'bz2', 'xz', '7z', 'rar', 'sit', 'sitx',
+                    'dmg', 'mp3', 'mp4', 'm4v', 'mov', 'avi', 'docx', 'xlsx', 'pptx', 'idml']  # already compressed
+kHighExtensions = ['txt', 'csv', 'xml', 'html', 'htm', 'rtf', 'log', 'ps', 'eps', 'svg', 'len']
+kCompressionTrial = True  # sample the first block of other file types to pick a method
+kTrialBlock = 65536
+kTrialSamples = 3  # samples per file type before its ratio is taken as settled
+kZipLimit = 0xFFFFFFFF  # past this zip needs zip64 records
+kDirectWrite = True  # reserve disc space from an estimate and write archives straight into the disc folder
+kEstimateSamples = 3  # largest files of each unfamiliar type sampled when estimating a job
+kEstimateConfidence = 3.0  # standard deviations of ratio added to an estimate to get its bound
+kEstimateSpread = 0.1  # ratio standard deviation assumed until a type has history
+kMaxRatio = 1.001  # deflate's worst case growth, and a stored file's ratio is 1
 kFileName = 'test.xlsx'
 kPath = os.path.expanduser('~')
 kSep = '/'
 #kURL = kPath + kSep + kFileName
 kURL = os.path.expanduser('~/tmp/Logs/test.xlsx')
+kIndexURL = kWorkingPath + kSep + '.scan_index'
+kCatalogURL = kWorkingPath + kSep + '.disc_catalog'  # sqlite, what each disc folder holds
+kRatioURL = kWorkingPath + kSep + '.ratio_history'  # compression ratios seen per file type, for estimates
+kJournalURL = kWorkingPath + kSep + 'Journal.jsonl'
+kMetricsURL = kWorkingPath + kSep + 'archive_agent.prom'  # for a node_exporter textfile collector
+kEventBatch = 256  # lines written per trip to the log files
+kManifestName = 'MANIFEST.sha256'  # per disc, in sha256sum -c format
+kSFVName = 'MANIFEST.sfv'  # per disc crc32s
+kVerifyWorkers = multiprocessing.cpu_count()
+kDeleteWorkers = 8  # unlinks in flight at once when removing a tree, each is a round trip on a share
+kDeleteProgress = 1000  # files between progress lines while removing a tree
+kIOProfiles = [  # ceilings on the agent's reads, moves and deletes on the share, the first that matches the time wins
+    # {'hours': (8, 18), 'days': (0, 1, 2, 3, 4), 'bytes': 20971520, 'ops': 200, 'concurrency': 4},  # office hours
+    {'hours': (0, 24), 'bytes': 0, 'ops': 0, 'concurrency': 16},  # bytes and ops a second, 0 is no ceiling
+]
+kIOUnmatched = {'bytes': 0, 'ops': 0, 'concurrency': kDeleteWorkers}  # when no profile matches the time
+kIOAdjustInterval = 1.0  # seconds between concurrency adjustments
+kIOLatencyRise = 2.0  # halve concurrency when an operation's latency passes this multiple of its baseline
+kIOBaselineWindow = 300  # seconds a latency baseline is kept before it's re-learned
+kSealFree = 16777216  # a disc with less room than this is sealed, and never rescanned
+kImagePath = kWorkingPath + kSep + 'Images'  # burn ready ISO images of sealed discs
+kImageOnSeal = True  # build a disc's image in the background as soon as it's sealed
+kSector = 2048
+kExtentMax = 0xFFFFF800  # largest ISO 9660 extent, bigger files are split over several
+kPolicyURL = os.path.expanduser('~/tmp/Logs/policy.json')  # dump and tag approvals for daemon mode
+kPollInterval = 60  # seconds between daemon mode checks when nothing wakes it sooner
+kSettleTime = 900  # seconds a job folder must go untouched before daemon mode archives it
+kWorkerJournal = 'Journal_{0}.jsonl'  # each worker's own journal in worker mode
+kLeaseTime = 600  # seconds a worker's job leases and disc claims last unless it renews them
+kLeaseBatch = kWorkers  # jobs a worker leases at a time
+kDedup = False  # leave files already on a disc out of later archives, with a stub manifest saying where they are
+kDedupMin = 65536  # smaller files aren't worth looking up
+kContentIndexURL = kWorkingPath + kSep + '.content_index'  # sqlite, sha256 -> the archive holding that content
+kDedupManifest = 'DEDUP_MANIFEST.json'  # in the job folder of an archive, for the files left out of it
+kRestorePath = kWorkingPath + kSep + 'Restored'  # where restore rebuilds jobs by default
+kPlanHistory = 14  # newest event logs plan mode learns each stage's speed from
+kDelta = True  # archive only what's new or changed when a job comes back after being archived
+kDeltaHash = False  # hash files as they're archived, so one that was only touched isn't archived again
+kContentsPath = kWorkingPath + kSep + 'Contents'  # what each job's archives hold, for delta archiving
+kTagPattern = re.compile(r'([dD]+is[ck]+)(\s*[#]?)(\d+)')  # disc tag folders left in a job folder
+kCleanupDryRun = False  # log the Image_Carriers files cleanup would remove, but leave them
+kCleanupBatch = 64  # Image_Carriers files removed between index updates
+kCarrierExtensions = ['len', 'tif', 'tiff']
+kTokenSplit = re.compile('[_-]')
+kColorCount = re.compile(r'c\d+')  # esko's trailing "c###" token
+kJobColumn = 1  # ledger column holding the job number
+kDiscColumn = 5  # ledger column the disc numbers are written to
 dt = datetime.date.today()
 
 
-class Job:
+def inspected_attribute(name):
+    """
+    A Job attribute that comes from inspecting the job folder, which happens the first time any of them is read.
+    Setting one outright stands in for inspection.
+    """
+
+    def get(self):
+        if not self.inspected:
+            self.inspected = True
+            with mtr.timed('inspect', self.job_number):
+                self.inspect()
+        return getattr(self, name)
+
+    def set(self, value):
+        self.inspected = True
+        setattr(self, name, value)
+
+    return property(get, set)
+
+
+class Job(object):
+    """
+    A job from the ledger. Nothing is read from the job folder until it's needed, so rows that are never looked at,
+    or are skipped, cost next to nothing.
+    """
+    __slots__ = ('job_number', 'location', 'on_server', 'clean', 'archive', 'tagged', 'estimate', 'reservation',
+                 'contents', 'inspected', '_size', '_is_archived', '_on_disc', '_ignore', '_prior_discs')
+
     def __init__(self, job_number):
         self.job_number = job_number
         self.location = generate_job_url(job_number)
-        self.is_archived = False
-        self.size = get_size(self.location)
         self.on_server = True
         self.clean = False
         self.archive = None
-        self.on_disc = None
-        self.ignore = False
-        self.inspect()
+        self.tagged = False
+        self.estimate = None  # (expected, bound) compressed bytes
+        self.reservation = None  # [(disc, bytes held, volume size)] for the archive while it's written
+        self.contents = None  # JobContents of earlier archives, loaded for delta archiving
+        self.inspected = False
+        self._size = None
+        self._is_archived = False
+        self._on_disc = None
+        self._ignore = False
+        self._prior_discs = []  # discs an earlier archive of a re-opened job went to
+
+    is_archived = inspected_attribute('_is_archived')
+    on_disc = inspected_attribute('_on_disc')
+    ignore = inspected_attribute('_ignore')
+    prior_discs = inspected_attribute('_prior_discs')
+
+    def delta_base(self):
+        """
+        :return: the JobContents of the job's earlier archives if only what's changed since needs archiving, or None
+        """
+        if not kDelta or not self.prior_discs:
+            return None
+        if self.contents is None:
+            self.contents = JobContents(self.job_number)
+        return self.contents if self.contents.generations else None
+
+    @property
+    def size(self):
+        if self._size is None:
+            self._size = get_size(self.location)
+        return self._size
 
     def dump(self):
-        try:
-            shutil.rmtree(self.location)
-            lg.add('Job: {0}, deleted job folder @: {1}\n'.format(self.job_number, self.location))
-            self.on_server = False
+        if not self.on_server:  # dumped before an interrupted run got to tag it
             return True
-        except:
-            lg.add('Job: {0}, unable to delete job folder @: {1}\n'.format((self.job_number, self.location)))
+        if self.archive is None or not self.archive.intact():
+            lg.add('Job: {0}, archive is not safely on disc, leaving job folder.\n'.format(self.job_number))
+            return False
+        missing = self.archive.missing()
+        if missing:
+            lg.add('Job: {0}, {1} files in the job folder are in none of its archives, leaving job folder: {2}\n'
+                   .format(self.job_number, len(missing), ', '.join(missing[:10])))
+            return False
+        size = self.size
+        with mtr.timed('dump', self.job_number) as counts:
+            removed, failures = remove_tree(self.location)
+            counts['bytes'], counts['files'] = size, removed
+            if failures:
+                counts['ok'] = False
+        if failures:
+            scn.invalidate(self.location)
+            lg.add('Job: {0}, unable to delete job folder @: {1}, {2} paths left.\n'.format(
+                self.job_number, self.location, len(failures)))
             return False
+        scn.forget(self.location)  # nothing left under it to keep in the index
+        scn.invalidate(self.location.rsplit(kSep, 1)[0])
+        lg.add('Job: {0}, deleted job folder @: {1}\n'.format(self.job_number, self.location))
+        self.on_server = False
+        jnl.record(self.job_number, 'dumped')
+        return True
 
     def tag(self):
+        if self.tagged:
+            return True
         try:
-            tags = []
+            tags = set(self.prior_discs)  # the earlier archive's tags went with the job folder
             for this_file in self.archive.files:
-                tags.append(this_file.in_disc.disc_number)
-            tags.sort()
-            for this_tag in tags:
-                path = self.location + kSep + kDiscFolderPrefix + str(this_tag).zfill(4)
-                os.makedirs(path)
-                lg.add('Tagged Job: {0}, with Disc: {1}.\n'.format(self.job_number, this_tag))
+                tags.add(this_file.in_disc.disc_number)
+            with mtr.timed('tag', self.job_number) as counts:
+                for this_tag in sorted(tags):
+                    path = self.location + kSep + kDiscFolderPrefix + str(this_tag).zfill(4)
+                    if not os.path.isdir(path):
+                        os.makedirs(path)
+                    counts['files'] += 1
+                    lg.add('Tagged Job: {0}, with Disc: {1}.\n'.format(self.job_number, this_tag))
+            scn.invalidate(self.location)
+            self.tagged = True
+            jnl.record(self.job_number, 'tagged')
             return True
         except:
             lg.add('Unable to tag Job: {0}, please investigate.\n'.format(self.job_number))
             return False
 
 
-    def cleanup(self):
+    def cleanup(self, dry_run=kCleanupDryRun):
+        """
+        Empties the Trash folder and removes superseded Image_Carriers files.
+        :param dry_run: only log what would be removed
+        :return: the Image_Carriers files removed, or that would be
+        """
+        started = time.time()
+
         # empty Trash folder
-        try:
-            shutil.rmtree('{0}/Trash'.format(self.location))
-            lg.add('Job: {0}, deleted Trash folder.\n'.format(self.job_number))
-        except:
-            lg.add('Job: {0}, unable to delete Trash folder.\n'.format(self.job_number))
+        if dry_run:
+            lg.add('Job: {0}, would delete Trash folder.\n'.format(self.job_number))
+        else:
+            self.purge_trash()
 
         # clean up Image Carrier folders
-        """
-        1. tokenize each file name in the image carrier folder, compile a list
-        2. if a file has a single token, mark it to keep
-        3. if a file has multiple tokens but none match the job number, mark to delete
-        4. if a file has the job number token, mark it to keep
-        5. if a file has a color token
-            i. look for other files that have the same token
-            ii. mark the most recent to keep
-            iii. mark the remainder to delete
-        6. if no files are marked to keep, mark all files to keep
-        7. delete files marked for deletion
-
-        """
-
-        def tokenize(filename):
-            strip_extension = filename.rpartition('.')[0]
-            break_by_whitespace = strip_extension.split()
-            break_by_underscore = []
-            for this_section in break_by_whitespace:
-                break_by_underscore = break_by_underscore + this_section.split('_')
-            break_by_hyphen = []
-            for this_section in break_by_underscore:
-                break_by_hyphen = break_by_hyphen + this_section.split('-')
-            tokens = break_by_hyphen
-            return tokens
-
-        # compile file list
-
-        image_carrier_path = self.location + '/Deliverables/Image_Carriers'
-
-        files = {}
-        for this_tuple in os.walk(image_carrier_path):
-            this_dir = this_tuple[0]
-            if this_dir[0] != '.':  # ignore dot directories
-                these_files = this_tuple[2]
-                for this_file in these_files:
-                    if this_file[0] != '.':  # ignore dot files and hidden stores
-                        this_filepath = this_dir + '/' + this_file
-                        files[this_filepath] = {}
-                        files[this_filepath]['name'] = this_file
-                        files[this_filepath]['modified'] = os.path.getmtime(this_filepath)
-                        files[this_filepath]['tokens'] = tokenize(this_file)
-                        files[this_filepath]['keep'] = True
-
-        # trap for "c###" in the last token
-
-        pattern = 'c\d+'
-        for this_filepath in files.keys():
-            is_c_token = re.search(pattern, files[this_filepath]['tokens'][-1])
-            if is_c_token:
-                files[this_filepath]['tokens'].pop()
-
-        # clean out not image carriers from the deletion lists
-
-        for this_filepath in files.keys():
-            is_len = files[this_filepath]['name'].rsplit('.')[-1].lower() == 'len'
-            is_tif = files[this_filepath]['name'].rsplit('.')[-1].lower() == 'tif'
-            is_tiff = files[this_filepath]['name'].rsplit('.')[-1].lower() == 'tiff'
-            if not (is_len or is_tif or is_tiff):
-                try:
-                    files.pop(this_filepath, None)
-                except:
-                    pass
-
-        # check for a matching job number token, if not there don't keep
-
-        for this_filepath in files.keys():
-            files[this_filepath]['keep'] = False
-            for this_token in files[this_filepath]['tokens']:
-                pattern = '.*{0}.*'.format(str(self.job_number))
-                job_number_in_token = re.search(pattern, this_token)
-                files[this_filepath]['keep'] = files[this_filepath]['keep'] or bool(job_number_in_token)
-
-        # accumulate color tokens
-
-        color_tokens = {}
-        for this_filepath in files.keys():
-            if files[this_filepath]['keep']:
-                color = files[this_filepath]['tokens'][-1]  # last token should be esko's ink color
-                if not (color in color_tokens.keys()):  # color token not yet created
-                    color_tokens[color] = []
-                    color_tokens[color].append(this_filepath)
-                else:
-                    color_tokens[color].append(this_filepath)
-
-        for this_color in color_tokens.keys():  # with each color
-            if len(color_tokens[this_color]) > 1:  # if there are more than one file
-                dates = []  # for sorting
-                file_by_dates = {}  # reverse lookup to files
-                for this_filepath in color_tokens[this_color]:  # for each filepath in a color
-                    dates.append(files[this_filepath]['modified'])  # append the date to the sorting list
-                    file_by_dates[
-                        files[this_filepath][
-                            'modified']] = this_filepath  # add the filepath to the reverse lookup table
-                dates.sort()  # sort the dates
-                files[file_by_dates[dates.pop()]][
-                    'keep'] = True  # pop the highest from the sort stack and keep that file
-                while dates:
-                    files[file_by_dates[dates.pop()]]['keep'] = False  #set the others to drop
-
-        # check for single token, do this last in case the other tests have marked the file for deletion
-
-        for this_filepath in files.keys():
-            if len(files[this_filepath]['tokens']) <= 2:
-                files[this_filepath]['keep'] = True
-
-        # using the keep field, dump the dead files
-
-        for this_filepath in files.keys():
-            if not (files[this_filepath]['keep']):
-                try:
-                    os.remove(this_filepath)
-                    lg.add('Job: {0}, removed {1}\n'.format(self.job_number, this_filepath))
-                except:
-                    lg.add('Job: {0}, unable to remove {1}\n'.format(self.job_number, this_filepath))
+        cleaner = CarrierCleaner(self.job_number, self.location + '/Deliverables/Image_Carriers')
+        plan = cleaner.plan()
+        if dry_run:
+            for this_filepath in plan:
+                lg.add('Job: {0}, would remove {1}\n'.format(self.job_number, this_filepath))
+            return plan
+        removed, removed_bytes = cleaner.remove(plan)
 
         self.clean = True
+        mtr.add('cleanup', self.job_number, time.time() - started, removed_bytes, removed)
+        jnl.record(self.job_number, 'cleaned')
+        return plan
+
+    def purge_trash(self):
+        trash = self.location + kTrashFolderPrefix
+        if not os.path.isdir(trash):
+            return
+        removed, failures = remove_tree(trash)
+        if failures:
+            lg.add('Job: {0}, unable to delete Trash folder, {1} paths left.\n'.format(self.job_number, len(failures)))
+        else:
+            lg.add('Job: {0}, deleted Trash folder.\n'.format(self.job_number))
+        scn.invalidate(self.location)
 
     def inspect(self):
-        my_walk = os.walk(self.location)
-        path, dirs, files = my_walk.next()
+        try:
+            path, dirs, files = next(scn.walk(self.location))
+        except StopIteration:
+            self._ignore = True
+            lg.add('Job: {0}, no job folder @: {1}. Ignoring.\n'.format(self.job_number, self.location))
+            return
 
         try:
             files.remove('.DS_Store')  # kill the Extreme IP mac share data
@@ -241,9 +356,8 @@ class Job:
         # recognize disc folders
 
         disc_folders = []
-        pattern = '([dD]+is[ck]+)(\s*[#]?)(\d+)'
         for this_dir in dirs:
-            is_disc_folder = re.search(pattern, this_dir)
+            is_disc_folder = kTagPattern.search(this_dir)
             if is_disc_folder:
                 disc_folders.append(int(is_disc_folder.groups()[-1]))
 
@@ -264,343 +378,3863 @@ class Job:
 
             if len(dirs) == len(disc_folders) and len(dirs) > 0:
                 #  job has been archived
-                self.is_archived = True
-                self.on_disc = disc_folders
-                lg.add('Job: {0}, has already been archived on {1}.\n'.format(self.job_number, repr(self.on_disc)))
+                self._is_archived = True
+                self._on_disc = disc_folders
+                lg.add('Job: {0}, has already been archived on {1}.\n'.format(self.job_number, repr(disc_folders)))
             elif len(dirs) > len(disc_folders) and len(dirs) > 0:
-                #  job has directories other than disc folders, archive the job
-                self.is_archived = False
-                self.ignore = False
-                lg.add('Job: {0}, will be archived.\n'.format(self.job_number))
+                #  job has directories other than disc folders, it's been re-opened, archive it again
+                self._is_archived = False
+                self._ignore = False
+                self._prior_discs = disc_folders
+                lg.add('Job: {0}, re-opened since it was archived on {1}, will be archived.\n'.format(
+                    self.job_number, repr(disc_folders)))
             else:
                 # job has fewer directories than it does disc folders, this can not happen
                 try:
                     raise Exception('Job inspection failed. More disc folders than directories in job.')
                 except:
-                    self.ignore = True
+                    self._ignore = True
                     lg.add('Job: {0}, inspection failed. Ignoring.\n'.format(self.job_number))
 
         if len(dirs) == 0:
             try:
                 raise Exception('Job Folder Is Empty.')  #no directories means something is wrong, get a human
             except:
-                self.ignore = True
+                self._ignore = True
                 lg.add('Job: {0}, is empty. Ignoring.\n'.format(self.job_number))
         elif len(disc_folders) == 0:
             lg.add('Job: {0}, will be archived.\n'.format(self.job_number))
 
 
-class File:
-    def __init__(self, url):
+class CarrierCleaner:
+    """
+    Works out which files in a job's Image_Carriers folder are superseded, in one pass over the folder:
+
+    1. tokenize each carrier's name (.len, .tif, .tiff) on whitespace, underscores and hyphens, dropping a trailing
+       "c###" token
+    2. carriers with none of their tokens containing the job number are removed
+    3. carriers that do are grouped by their last token, the ink color, and only the newest of each color survives
+    4. carriers with two tokens or fewer are always kept
+
+    Nothing is deleted until plan() has decided everything, and then removal happens in batches.
+    """
+
+    def __init__(self, job_number, path):
+        self.job_number = str(job_number)
+        self.path = path
+
+    @staticmethod
+    def tokenize(filename):
+        tokens = []
+        for this_section in filename.rpartition('.')[0].split():
+            tokens.extend(kTokenSplit.split(this_section))
+        if tokens and kColorCount.search(tokens[-1]):
+            tokens.pop()
+        return tokens
+
+    def carriers(self):
+        """
+        :return: (path, mtime, tokens) of every carrier, leaving out dot files and anything in dot folders
+        """
+        for this_dir, entry in scn.entries(self.path):
+            if any(part.startswith('.') for part in this_dir[len(self.path):].split(kSep)):
+                continue
+            for this_file, (size, mtime) in entry['files'].items():
+                if this_file.startswith('.') or this_file.rpartition('.')[2].lower() not in kCarrierExtensions:
+                    continue
+                yield this_dir + kSep + this_file, mtime, self.tokenize(this_file)
+
+    def plan(self):
+        """
+        :return: sorted paths of the carriers to remove
+        """
+        remove = set()
+        newest = {}  # color -> (mtime, path) of the newest carrier for this job
+        short = set()
+        for this_path, mtime, tokens in self.carriers():
+            if len(tokens) <= 2:
+                short.add(this_path)
+            if not any(self.job_number in this_token for this_token in tokens):
+                remove.add(this_path)
+                continue
+            color = tokens[-1]  # last token should be esko's ink color
+            candidate = (mtime, this_path)
+            if color not in newest:
+                newest[color] = candidate
+            elif candidate > newest[color]:  # ties in mtime go to the later path
+                remove.add(newest[color][1])
+                newest[color] = candidate
+            else:
+                remove.add(this_path)
+        return sorted(remove - short)
+
+    def remove(self, plan):
+        """
+        :return: (files, bytes) removed
+        """
+        removed, removed_bytes = 0, 0
+        for start in range(0, len(plan), kCleanupBatch):
+            touched = set()
+            for this_filepath in plan[start:start + kCleanupBatch]:
+                try:
+                    size = scn.entry(this_filepath)[0]
+                    with gov.op('delete'):
+                        os.remove(this_filepath)
+                    removed += 1
+                    removed_bytes += size
+                    lg.add('Job: {0}, removed {1}\n'.format(self.job_number, this_filepath))
+                except:
+                    lg.add('Job: {0}, unable to remove {1}\n'.format(self.job_number, this_filepath))
+                touched.add(this_filepath.rsplit(kSep, 1)[0])
+            for this_dir in touched:
+                scn.invalidate(this_dir)
+        return removed, removed_bytes
+
+
+class File(object):
+    __slots__ = ('location', 'name', 'job_number', 'sha256', 'crc', 'is_placed', 'in_disc', '_size')
+
+    def __init__(self, url, job_number=None, sha256=None, crc=None):
         self.location = url
         self.name = url.rsplit('/', 1)[1]
-        self.size = get_size(url)
+        self._size = None
+        self.job_number = job_number
+        self.sha256 = sha256  # hex digests taken while the archive was written
+        self.crc = crc
         self.is_placed = False
         self.in_disc = False
 
+    @property
+    def size(self):
+        if self._size is None:
+            self._size = get_size(self.location)
+        return self._size
+
+    def footprint(self):
+        """
+        :return: the bytes the file takes on a disc, counting its manifest lines
+        """
+        if not self.sha256:
+            return self.size
+        return self.size + 2 * len(self.name) + 77
+
     def add2disc(self, disc):
-        if self.size + disc.size >= kFullSize:
+        if self.footprint() > disc.free():
             return False
         else:
-            shutil.move(self.location, disc.location)
+            if self.location.rsplit(kSep, 1)[0] != disc.location:  # not written there in the first place
+                with mtr.timed('move', self.job_number) as counts:
+                    move_file(self.location, disc.location + kSep + self.name)
+                    counts['bytes'], counts['files'] = self.size, 1
+            scn.invalidate(disc.location)
             self.is_placed = True
             self.in_disc = disc
             disc.size += self.size
-            if disc.size >= kFullSize:
-                disc.is_full = True
             self.location = disc.location + kSep + self.name
+            if self.sha256:
+                disc.add_manifest(self)
+            sync_path(disc.location)
+            if disc.contents is not None and self.name not in disc.contents:
+                disc.contents.append(self.name)
+            if crd is not None:  # the disc's size and seal come from every worker's placements
+                crd.placed(disc, self)
+            else:
+                if kFullSize - disc.size < kSealFree and not disc.reserved:
+                    disc.is_full = True
+                cat.placed(disc, [self.name, kManifestName, kSFVName])
+            if disc.is_full and kImageOnSeal:
+                images.submit(disc.disc_number)
             lg.add('File: {0}, placed @: {1}\n'.format(self.name, self.location))
+            if self.job_number is not None:
+                jnl.record(self.job_number, 'placed', {'name': self.name, 'disc': disc.disc_number})
             return True
 
 
 class Archive:
-    def __init__(self, job):
+    def __init__(self, job, journaled=None, targets=None):
+        """
+        :param targets: [(disc folder, volume size)] reserved for the volumes in turn, any more volumes than that
+        go to the working folder
+        """
         self.job = job
         self.files = []
+        self.contents = None
+        self.stubs = {}
+        if journaled is not None:
+            self.adopt(journaled)
+            return
 
-        # archive the job
-        command = 'ditto'
-        args = '-c -k --sequesterRsrc --keepParent'
-        zip_name = str(job.job_number) + '.zip'
-        zip_path = kWorkingPath + kSep + zip_name
-        do_this = '{0} {1} {2} {3}'.format(command, args, job.location, zip_path)
-        subprocess.call(do_this, shell=True)
-        zip_size = get_size(zip_path)
-
-        # break it up if required
-        if zip_size >= kFullSize:
-            command = 'zip'
-            args = '-q -s 2g'
-            split_path = kWorkingPath + kSep + '{0}_split.zip'.format(job.job_number)
-            do_this = '{0} {1} {2} {3}'.format(command, args, split_path, zip_path)
-            subprocess.call(do_this, shell=True)
-            os.remove(zip_path)
-            these_files = os.listdir(kWorkingPath)
-            for this_file in these_files:
-                if this_file.find('_split') > 0:  # contains the split file name
-                    self.files.append(File(kWorkingPath + kSep + this_file))
-                    lg.add('Archive created: {0}\n'.format(kWorkingPath + kSep + this_file))
-        else:
-            self.files.append(File(zip_path))
-            lg.add('Archive created: {0}\n'.format(zip_path))
+        # archive the job, entries keep the job folder as their parent like ditto --keepParent
+        scn.invalidate(job.location)  # files added since the job was inspected have to be in it
+        name = str(job.job_number)
+        base = job.delta_base()
+        if job.prior_discs:  # keep clear of the earlier archive's name
+            name += '_v{0}'.format(len(base.generations) + 1 if base else 2)
+            jnl.record(job.job_number, 'reopened', job.prior_discs)
+        self.contents = {}  # archive name -> [size, mtime, sha256] of each file written
+        self.stubs = {}  # archive name -> where the content of a file left out is already stored
+        volumes = VolumeWriter(kWorkingPath, name, kVolumeSize, targets or [])
+        writer = ZipWriter(volumes)
+        parent = job.location.rsplit(kSep, 1)[0]
+        skipped = 0
+        try:
+            with mtr.timed('archive', job.job_number) as counts:
+                for this_dir, entry in each_entry(job, base):
+                    arc_dir = this_dir[len(parent) + 1:]
+                    writer.add_dir(arc_dir, entry['mtime'])
+                    if kAppleDouble:
+                        writer.add_apple_double(this_dir, arc_dir, entry['mtime'])
+                    for this_file in sorted(entry['files']):
+                        size, mtime = entry['files'][this_file]
+                        arcname = arc_dir + kSep + this_file
+                        link = entry['links'].get(this_file)
+                        if base is not None:
+                            try:  # the index keeps a file's size and mtime while its folder's mtime holds still
+                                with gov.op('stat'):
+                                    this_stat = os.lstat(this_dir + kSep + this_file)
+                                size, mtime = this_stat.st_size, this_stat.st_mtime
+                            except OSError:
+                                continue  # gone since the scan
+                            if not base.changed(arcname, this_dir + kSep + this_file, size, mtime, link is None):
+                                skipped += 1
+                                continue
+                        if link is not None:  # stored as the link, never followed
+                            writer.add_link(arcname, link, mtime)
+                            self.contents[arcname] = [size, mtime, None]
+                            counts['files'] += 1
+                            continue
+                        if cix is not None and size >= kDedupMin:
+                            sha256, source = cix.find(this_dir + kSep + this_file, size)
+                            if source is not None:
+                                source.update({'sha256': sha256, 'size': size, 'mtime': mtime})
+                                self.stubs[arcname] = source
+                                self.contents[arcname] = [size, mtime, sha256]
+                                if kAppleDouble:  # forks and attributes aren't part of the content
+                                    writer.add_apple_double(this_dir + kSep + this_file, arcname, mtime)
+                                continue
+                        writer.add_file(this_dir + kSep + this_file, arcname, size, mtime)  # and its AppleDouble
+                        self.contents[arcname] = [size, mtime, None]
+                        counts['bytes'] += size
+                        counts['files'] += 1
+                if self.stubs:
+                    writer.add_data(job.location.rsplit(kSep, 1)[-1] + kSep + kDedupManifest,
+                                    json.dumps(self.stubs, sort_keys=True, indent=1).encode('utf-8'), time.time())
+                paths = writer.close()
+                for arcname, sha256 in writer.digests.items():
+                    self.contents[arcname][2] = sha256
+        except:
+            volumes.abort()
+            raise
+        if base is not None:
+            lg.add('Job: {0}, archiving {1} new or changed files, {2} are already on {3}.\n'.format(
+                job.job_number, len(self.contents), skipped, repr(job.prior_discs)))
+        if self.stubs:
+            lg.add('Job: {0}, {1} files, {2} bytes, are already on disc, left out in favour of {3}.\n'.format(
+                job.job_number, len(self.stubs), sum(stub['size'] for stub in self.stubs.values()), kDedupManifest))
+
+        # split volumes are already disc sized
+        for this_path, (sha256, crc) in zip(paths, volumes.checksums):
+            self.files.append(File(this_path, job.job_number, sha256, crc))
+            lg.add('Archive created: {0}\n'.format(this_path))
+        jnl.record(job.job_number, 'archived', [{'name': this_file.name, 'sha256': this_file.sha256,
+                                                 'crc': this_file.crc} for this_file in self.files])
         job.is_archived = True
         job.archive = self
 
+    def record_contents(self):
+        """
+        Adds what this archive holds to the job's contents, once every volume is on a disc.
+        """
+        if self.contents is None:  # adopted from the journal, what it holds wasn't kept
+            return
+        job_contents = self.job.contents or JobContents(self.job.job_number)
+        volumes = [this_file.name for this_file in self.files]
+        discs = sorted(set(this_file.in_disc.disc_number for this_file in self.files))
+        job_contents.add(volumes, discs, self.contents)
+        if cix is not None:  # only what's really in this archive can stand in for later copies
+            cix.add(self.job.job_number, volumes, discs, dict(
+                (arcname, this_file) for arcname, this_file in self.contents.items() if arcname not in self.stubs))
+        self.contents = None
+
+    def missing(self):
+        """
+        Lists the job folder as it is now, not from the index, against what the job's archives hold: this one's
+        entries, the files its dedup manifest left out, and what earlier archives of a re-opened job hold.
+        :return: paths of files only the job folder has, all of them if the archive can't be read
+        """
+        try:
+            files, dirs = list_tree(self.job.location)
+        except OSError as error:
+            if error.errno == errno.ENOENT:
+                return []
+            raise
+        try:
+            reader = ZipReader([this_file.location for this_file in self.files])
+            names = set(reader.entries)
+            for this_name in list(names):
+                if this_name.rsplit(kSep, 1)[-1] == kDedupManifest:
+                    names.update(json.loads(reader.data(this_name).decode('utf-8')))
+        except (IOError, OSError, ValueError, struct.error) as error:
+            lg.add('Job: {0}, unable to read its archive back: {1}\n'.format(self.job.job_number, error))
+            return files
+        names.update(JobContents(self.job.job_number).files)
+        parent = self.job.location.rsplit(kSep, 1)[0]
+        return [this_path for this_path in files if this_path[len(parent) + 1:] not in names]
+
+    def intact(self):
+        """
+        Cheap check before the source is deleted: every volume is on a disc, at its full size, with a checksum in
+        that disc's manifest. Volumes, manifests and disc folders are fsynced as they're written, so the sizes aren't
+        just the page cache's. Use the verify command to re-read them.
+        """
+        for this_file in self.files:
+            if not (this_file.is_placed and this_file.sha256):
+                return False
+            try:
+                if os.path.getsize(this_file.location) != this_file.size:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def adopt(self, journaled):
+        """
+        Picks up the volumes an interrupted run already wrote, wherever they got to, instead of compressing again.
+        :param journaled: {'archived': [volumes], 'placed': {volume name: disc}, 'discs': {number: Disc},
+        'allocator': the DiscAllocator indexing those discs}
+        """
+        for this_volume in journaled['archived']:
+            this_name = this_volume['name']
+            disc = journaled['discs'].get(journaled['placed'].get(this_name))
+            unjournaled = False
+            if disc is None:  # moved or written in place, but the run died before it was journaled
+                for this_disc in journaled['discs'].values():
+                    if this_disc.holds(this_name):
+                        disc = this_disc
+                        unjournaled = True
+            if disc is not None:
+                this_file = File(disc.location + kSep + this_name, self.job.job_number, this_volume['sha256'],
+                                 this_volume['crc'])
+                this_file.is_placed = True
+                this_file.in_disc = disc
+                if unjournaled:
+                    allocator = journaled['allocator']
+                    index = allocator.positions[disc.disc_number]
+                    old_free = disc.free()
+                    disc.add_manifest(this_file)
+                    allocator.update(index, old_free)
+                    jnl.record(self.job.job_number, 'placed', {'name': this_name, 'disc': disc.disc_number})
+            elif os.path.isfile(kWorkingPath + kSep + this_name):
+                this_file = File(kWorkingPath + kSep + this_name, self.job.job_number, this_volume['sha256'],
+                                 this_volume['crc'])
+            else:
+                raise IOError('Volume {0} is neither in the working folder nor on a disc.'.format(this_name))
+            self.files.append(this_file)
+        self.job.is_archived = True
+        self.job.archive = self
+
+
+def each_entry(job, base=None):
+    """
+    Walks a job folder from the index. When archiving a delta, the disc tag folders the earlier archive left are
+    skipped.
+    """
+    for this_dir, entry in scn.entries(job.location):
+        if base is not None and this_dir.rsplit(kSep, 1)[0] == job.location and \
+                kTagPattern.search(this_dir.rsplit(kSep, 1)[-1]) and not entry['files'] and not entry['dirs']:
+            continue
+        yield this_dir, entry
 
-class Disc:
-    def __init__(self, disc_number):
-        self.disc_number = disc_number
-        self.folder_name = kDiscFolderPrefix + str(self.disc_number).zfill(4)
-        self.location = kBaseDisksPath + kSep + self.folder_name
 
+class JobContents:
+    """
+    What every archive of a job holds, one generation per archive: the volumes, the discs they went to and each
+    file's size, mtime and, with kDeltaHash, sha256. Kept as JSON in kContentsPath. When a job is re-opened only
+    files that aren't in an earlier generation as they are now go into the new archive.
+    """
+
+    def __init__(self, job_number):
+        self.path = kContentsPath + kSep + '{0}.json'.format(job_number)
+        self.generations = []
+        self.files = {}  # archive name -> [size, mtime, sha256] as last archived
+        self.verdicts = {}  # archive name -> (size, mtime, changed), so a file as it is now is only hashed once
+        self.lock = threading.Lock()
         try:
-            os.makedirs(self.location)
-            lg.add('Created disc folder: {0}\n'.format(self.location))
-        except:
-            pass
-        self.size = get_size(self.location)
-        if self.size >= kFullSize:
-            self.is_full = True
+            with open(self.path) as contents_file:
+                self.generations = json.load(contents_file)['generations']
+        except (IOError, ValueError, KeyError):
+            self.generations = []
+        for this_generation in self.generations:
+            self.files.update(this_generation['files'])
+
+    def changed(self, arcname, path, size, mtime, read=True):
+        """
+        :param read: False to take a file that was only touched as changed rather than hash it
+        :return: True if the file isn't in an earlier archive as it is now
+        """
+        with self.lock:
+            known = self.verdicts.get(arcname)
+            if known is not None and known[:2] == (size, mtime):
+                return known[2]
+        before = self.files.get(arcname)
+        if before is None or before[0] != size:
+            verdict = True
+        elif abs(before[1] - mtime) < 2:  # zip keeps mtimes to 2 seconds, so a restored file rounds down
+            verdict = False
+        elif not read:
+            return True
         else:
-            self.is_full = False
-        self.contents = os.listdir(self.location)
+            verdict = not (kDeltaHash and before[2] and hash_file(path, True)[1] == before[2])
+        with self.lock:
+            self.verdicts[arcname] = (size, mtime, verdict)
+        return verdict
+
+    def add(self, volumes, discs, files):
+        self.generations.append({'time': time.time(), 'volumes': volumes, 'discs': discs, 'files': files})
+        self.files.update(files)
+        try:
+            if not os.path.isdir(kContentsPath):
+                os.makedirs(kContentsPath)
+            with open(self.path + '.tmp', 'w') as contents_file:
+                json.dump({'generations': self.generations}, contents_file)
+            os.rename(self.path + '.tmp', self.path)
+        except (IOError, OSError):
+            lg.add('Unable to save contents @: {0}\n'.format(self.path))
 
 
-class Log:
+class ContentIndex:
+    """
+    With kDedup, every file of kDedupMin bytes or more that goes into an archive is recorded by its sha256 in a
+    sqlite index, with the job, archive volumes and discs that hold it, once they're all on disc. A later file is
+    only hashed if some recorded file has the same size, and if its hash is recorded too, the archive leaves it out
+    and lists it in the job's kDedupManifest instead, which restore follows back to the earlier archive.
+    """
+
     def __init__(self, path):
-        self.path = path
-        self.name = self.path.rsplit('/')[-1]
-        try:
-            self.size = get_size(self.path)
-        except:
-            self.size = 0
-        self.file = open(self.path, 'a+', 1)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=kLeaseTime, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS content (sha256 TEXT PRIMARY KEY, size INTEGER NOT NULL, job INTEGER NOT NULL,
+                                                name TEXT NOT NULL, volumes TEXT NOT NULL, discs TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS content_size ON content (size);
+        """)
 
+    def find(self, path, size):
+        """
+        :return: (sha256 or None, where an archive already holds the file's content or None)
+        """
+        with self.lock:
+            known = self.db.execute('SELECT 1 FROM content WHERE size = ? LIMIT 1', (size,)).fetchone()
+        if not known:
+            return None, None
+        sha256 = hash_file(path, True)[1]
+        with self.lock:
+            row = self.db.execute('SELECT job, name, volumes, discs FROM content WHERE sha256 = ? AND size = ?',
+                                  (sha256, size)).fetchone()
+        if row is None:
+            return sha256, None
+        return sha256, {'job': row[0], 'name': row[1], 'volumes': json.loads(row[2]), 'discs': json.loads(row[3])}
 
-    def open(self):
-        self.file = open(self.path, 'a+', 1)
+    def add(self, job_number, volumes, discs, files):
+        """
+        :param files: archive name -> [size, mtime, sha256] of the files in the archive
+        """
+        rows = [(sha256, size, job_number, arcname, json.dumps(volumes), json.dumps(discs))
+                for arcname, (size, mtime, sha256) in files.items() if sha256 and size >= kDedupMin]
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR IGNORE INTO content (sha256, size, job, name, volumes, discs) '
+                                'VALUES (?, ?, ?, ?, ?, ?)', rows)
 
     def close(self):
-        self.file.close()
+        with self.lock:
+            self.db.close()
 
-    def add(self, string):
-        print(string)
-        self.file.write(string)
 
+class VolumeWriter:
+    """
+    A write only file that rolls over to a new volume whenever the current one is full. Volumes are written as
+    name.z01, name.z02, ... and renamed when closed: a lone volume becomes name.zip, otherwise they follow zip's split
+    naming, name_split.z01, ..., name_split.zip. Each volume can go to its own folder with its own size, so a split
+    archive can fill the gaps left on several discs.
+    """
 
-class Manager:
-    def __init__(self, url):
-        self.excel_url = url
-        self.job_list = []
-        self.disc_catalog = []
-        self.get_job_list(url)
-        self.setup_disc_catalog()
+    def __init__(self, directory, name, volume_size, targets=()):
+        """
+        :param targets: [(folder, size)] for the first volumes, the rest are volume_size in directory
+        """
+        self.directory = directory
+        self.name = name
+        self.volume_size = volume_size
+        self.targets = list(targets)
+        self.limit = volume_size  # size of the current volume
+        self.paths = []
+        self.volume = -1  # zip numbers disks from 0
+        self.offset = 0
+        self.file = None
+        self.checksums = []  # (sha256, crc32) of each finished volume, taken as it's written
+        self.roll()
+
+    def finish_volume(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())  # the source is deleted on the strength of it
+        self.file.close()
+        self.checksums.append((self.sha256.hexdigest(), '{0:08x}'.format(self.crc & 0xFFFFFFFF)))
 
+    def roll(self):
+        if self.file is not None:
+            self.finish_volume()
+        self.sha256 = hashlib.sha256()
+        self.crc = 0
+        self.volume += 1
+        self.offset = 0
+        directory, self.limit = self.targets.pop(0) if self.targets else (self.directory, self.volume_size)
+        path = directory + kSep + '{0}.z{1}'.format(self.name, str(self.volume + 1).zfill(2))
+        self.file = open(path, 'wb')
+        self.paths.append(path)
 
-    def get_job_list(self, url):
+    def keep_together(self, length):
         """
-        Setups up the master job list and attaches the Excel file log to the manager object.
+        Starts a new volume if a record of this length would otherwise straddle two.
         """
+        if self.offset > 0 and self.offset + length > self.limit:
+            self.roll()
+
+    def write(self, data):
+        while data:
+            if self.offset >= self.limit:
+                self.roll()
+            room = self.limit - self.offset
+            chunk = data[:room]
+            self.file.write(chunk)
+            self.sha256.update(chunk)
+            self.crc = zlib.crc32(chunk, self.crc)
+            self.offset += len(chunk)
+            data = data[room:]
+
+    def close(self):
+        self.finish_volume()
+        if len(self.paths) == 1:
+            names = [self.name + '.zip']
+        else:
+            names = ['{0}_split.z{1}'.format(self.name, str(n + 1).zfill(2)) for n in range(len(self.paths) - 1)]
+            names.append(self.name + '_split.zip')
+        final_paths = []
+        for this_path, this_name in zip(self.paths, names):
+            final_path = this_path.rsplit(kSep, 1)[0] + kSep + this_name
+            os.rename(this_path, final_path)
+            final_paths.append(final_path)
+        for this_folder in set(this_path.rsplit(kSep, 1)[0] for this_path in final_paths):
+            sync_path(this_folder)  # and the renames
+        self.paths = final_paths
+        return final_paths
+
+    def abort(self):
         try:
-            self.wb = openpyxl.load_workbook(url)
+            self.file.close()
         except:
-            print('No excel file at {0)'.format(url))
-            lg.add('Excel file: {0}, does not exist.\n'.format(url))
-            return False
-        ws = self.wb.active
-        max_row = int(ws.max_row) + 1
-        max_col = ws.max_column
-
-        r, c, c2 = 1, 1, 5
-        parsed_jobs = []
-        while r < max_row:
+            pass
+        for this_path in self.paths:
             try:
-                job_number = int(ws.cell(row=r, column=c).value)  # first entry is a job number
+                os.remove(this_path)
             except:
-                r += 1
-                continue
-            if not (ws.cell(row=r, column=c2).value):  # disc already attached to job
-                # check for double entries
-                if not (job_number in parsed_jobs):
-                    self.job_list.append(Job(job_number))
-                    parsed_jobs.append(job_number)
-                else:
-                    lg.add('Duplicate Entry for Job: {0} found. Skipping Entry @ row: {1}\n'.format(job_number, r))
-            r += 1
-        return True
+                pass
 
-    def setup_disc_catalog(self, url=kBaseDisksPath):
+
+class ZipWriter:
+    """
+    Streams entries into a zip, or a split zip, on a VolumeWriter in a single pass. Sizes and crcs follow each entry
+    in a data descriptor, so nothing has to be seeked back to, and memory stays at one read buffer per entry.
+    Zip64 records are used where sizes, offsets or counts outgrow the classic format.
+
+    Files are deflated across a pool of threads (zlib lets go of the GIL while it compresses) and written out in
+    order. A large file goes the way pigz does it, in kBufferSize pieces, with at most kCompressAhead pieces in
+    flight. Smaller ones are read whole and deflated whole, up to kCompressAheadBytes of them ahead of the one
+    being written, whose crc and sizes are then known for its local header, so it needs no data descriptor.
+    """
+
+    pool = None  # kCompressWorkers threads shared by every ZipWriter
+    pool_lock = threading.Lock()
+
+    def __init__(self, volumes):
+        self.volumes = volumes
+        self.entries = []
+        self.pending = []  # (arcname, mtime, method, size, result of deflate_entry or None for a folder) in order
+        self.ahead = 0  # bytes of the pending files
+        self.digests = {}  # archive name -> sha256 of files hashed as they were written
+
+    @classmethod
+    def workers(cls):
+        with cls.pool_lock:
+            if cls.pool is None:
+                cls.pool = ThreadPool(kCompressWorkers)
+            return cls.pool
+
+    @staticmethod
+    def deflate_piece(args):
         """
-        searches the base disc directory for existing disc folders, sizes them and populates the disc catalog
+        :param args: (block, level, the end of the block before it, whether it's the last block)
+        :return: (the block deflated on its own, cpu seconds). Every piece but the last ends in a sync flush, which
+        leaves it on a byte boundary without ending the stream, so the pieces join up into one deflate stream.
         """
+        block, level, dictionary, last = args
+        started = cpu_clock()
+        if dictionary:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15, 8, zlib.Z_DEFAULT_STRATEGY, dictionary)
+        else:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        data = compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+        return data, cpu_clock() - started
 
+    @staticmethod
+    def deflate_entry(args):
         """
-        1. get the list of folders in the staging directory, don't read deeper than the root level
-        2. remove any non-disc folders from that listing
-        3. with the remaining folders, calculate the size of each disc, store the value
-        4. if no disc folders exists, prompt for a disc number to start with, create that folder, set it's size to 0
+        :param args: (the whole file, method, level, whether to take its sha256)
+        :return: (crc, sha256 or None, the data as it goes in the zip, cpu seconds)
         """
+        data, method, level, hashed = args
+        started = cpu_clock()
+        crc = zlib.crc32(data) & 0xFFFFFFFF
+        sha256 = hashlib.sha256(data).hexdigest() if hashed else None
+        if method != 'store':
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            data = compressor.compress(data) + compressor.flush()
+        return crc, sha256, data, cpu_clock() - started
 
-        directories = os.walk(url).next()[1]
+    @staticmethod
+    def dos_time(mtime):
+        t = time.localtime(mtime or 0)
+        if t.tm_year < 1980:
+            return 0, (1 << 5) | 1  # 1980-01-01
+        return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), \
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
 
-        for this_dir in directories:  # drop the non-disc dirs
-            if this_dir.find('Disc') == -1:
-                directories.remove(this_dir)
+    @staticmethod
+    def encode_name(name):
+        if not isinstance(name, bytes):
+            name = name.encode('utf-8', 'surrogateescape')
+        try:
+            name.decode('ascii')
+            return name, 0
+        except UnicodeDecodeError:
+            return name, 0x800  # language encoding flag, the name is utf-8
 
-        if len(directories) > 0:  # one or more disc directories
+    def start_entry(self, arcname, mtime, method, flags, zip64, crc=0, size=0, compressed=None):
+        name, name_flag = self.encode_name(arcname)
+        compressed = size if compressed is None else compressed
+        entry = {'name': name, 'flags': flags | name_flag, 'method': method, 'crc': crc,
+                 'compressed': compressed, 'size': size, 'zip64': zip64}
+        entry['time'], entry['date'] = self.dos_time(mtime)
+        extra = b''
+        size_field, compressed_field = size, compressed
+        if zip64:
+            extra = struct.pack('<HHQQ', 1, 16, 0, 0)
+            size_field = compressed_field = kZipLimit
+        header = struct.pack('<IHHHHHIIIHH', 0x04034b50, 45 if zip64 else 20, entry['flags'], method,
+                             entry['time'], entry['date'], crc, compressed_field, size_field, len(name), len(extra))
+        header += name + extra
+        self.volumes.keep_together(len(header))
+        entry['disk'], entry['offset'] = self.volumes.volume, self.volumes.offset
+        self.volumes.write(header)
+        self.entries.append(entry)
+        return entry
 
-            for index in range(len(directories)):  # drop the "Disc" prefix and convert the ids to ints
-                directories[index] = int(directories[index].strip('Disc'))
+    def add_dir(self, arcname, mtime):
+        if self.pending:  # after the files ahead of it
+            self.pending.append((arcname, mtime, None, 0, None))
+        else:
+            self.write_dir(arcname, mtime)
 
-            for this_disc_number in directories:
-                self.disc_catalog.append(Disc(this_disc_number))
-        else:  # no disc directories
-            while not ('disc_number' in locals()):  # ask for a disc number until you get a valid one
-                try:
-                    disc_number = int(input('Enter a starting Disc #: '))
-                except:
-                    print('Disc number is invalid, please enter an integer disc number.')
-            self.disc_catalog.append(Disc(disc_number))
+    def write_dir(self, arcname, mtime):
+        entry = self.start_entry(arcname + '/', mtime, 0, 0, False)
+        entry['mode'] = (0o40755 << 16) | 0x10
 
-        return True
+    def add_file(self, path, arcname, size, mtime):
+        """
+        The file's sha256, with kDeltaHash or kDedup for a file worth looking up, is in self.digests once the file
+        has been written, by close at the latest.
+        :param size: as the index has it, the file is sized again once it's open, in case it grew since
+        """
+        with open(path, 'rb') as source:
+            size = os.fstat(source.fileno()).st_size
+            double = apple_double(path, source.fileno()) if kAppleDouble else None
+            hashed = kDeltaHash or (cix is not None and size >= kDedupMin)
+            if kCompressWorkers > 1 and size < kParallelMin:
+                self.queue_file(source, arcname, mtime, hashed)
+                if kAppleDouble:
+                    self.add_double(arcname, double, mtime)
+                return
+            self.drain()
+            zip64 = size >= kZipLimit - (kZipLimit >> 6)  # leave room for deflate growing the data
+            crc, read, written, cpu = 0, 0, 0, 0.0
+            digest = hashlib.sha256() if hashed else None
+            block = gov.read(source, kBufferSize)
+            method = policy.choose(arcname, block)  # the first block doubles as the trial sample
+            level = kFastLevel if method == 'fast' else kHighLevel
+            if method == 'store':
+                entry = self.start_entry(arcname, mtime, 0, 0x08, zip64)
+                compressor = None
+            else:
+                entry = self.start_entry(arcname, mtime, 8, 0x08, zip64)
+                compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            entry['mode'] = 0o100644 << 16
+            if compressor is not None and kCompressWorkers > 1 and size >= kParallelMin and \
+                    len(block) == kBufferSize:
+                compressor = None  # the last piece finishes the stream
+                pending = []  # pieces in file order, so the output is the same however the threads run
+                dictionary = b''
+                while block:
+                    next_block = gov.read(source, kBufferSize)
+                    crc = zlib.crc32(block, crc)
+                    if digest is not None:
+                        digest.update(block)
+                    read += len(block)
+                    pending.append(self.workers().apply_async(self.deflate_piece,
+                                                              ((block, level, dictionary, not next_block),)))
+                    if deflate_window:
+                        dictionary = block[-deflate_window:]
+                    while pending and (len(pending) >= kCompressAhead or not next_block):
+                        data, seconds = pending.pop(0).get()
+                        cpu += seconds
+                        written += len(data)
+                        self.volumes.write(data)
+                    block = next_block
+            while block:
+                crc = zlib.crc32(block, crc)
+                if digest is not None:
+                    digest.update(block)
+                read += len(block)
+                if compressor is not None:
+                    started = cpu_clock()
+                    data = compressor.compress(block)
+                    cpu += cpu_clock() - started
+                else:
+                    data = block
+                written += len(data)
+                self.volumes.write(data)
+                block = gov.read(source, kBufferSize)
+        if compressor is not None:
+            data = compressor.flush()
+            written += len(data)
+            self.volumes.write(data)
+        if not zip64 and max(read, written) >= kZipLimit:
+            raise IOError('{0} grew past what a zip without zip64 holds while it was archived.'.format(path))
+        policy.record(arcname, method, read, written, cpu)
+        est.learn(arcname, read, written)
+        entry['crc'], entry['size'], entry['compressed'] = crc & 0xFFFFFFFF, read, written
+        if zip64:
+            descriptor = struct.pack('<IIQQ', 0x08074b50, entry['crc'], written, read)
+        else:
+            descriptor = struct.pack('<IIII', 0x08074b50, entry['crc'], written, read)
+        self.volumes.write(descriptor)
+        if digest is not None:
+            self.digests[arcname] = digest.hexdigest()
+        if kAppleDouble:
+            self.add_double(arcname, double, mtime)
 
-    def get_last_disc(self):
-        disc_numbers = []
-        for this_disc in self.disc_catalog:
-            disc_numbers.append(this_disc.disc_number)
-        disc_numbers.sort()
-        return disc_numbers[-1]
+    def queue_file(self, source, arcname, mtime, hashed):
+        """
+        Reads a file whole and hands it to the pool to deflate, writing out the oldest pending files once more than
+        kCompressAheadBytes are waiting.
+        :param source: the file, open
+        """
+        blocks = []
+        block = gov.read(source, kBufferSize)
+        while block:
+            blocks.append(block)
+            block = gov.read(source, kBufferSize)
+        data = b''.join(blocks)
+        method = policy.choose(arcname, data[:kBufferSize])  # chosen here so trials go in file order
+        level = kFastLevel if method == 'fast' else kHighLevel
+        result = self.workers().apply_async(self.deflate_entry, ((data, method, level, hashed),))
+        self.pending.append((arcname, mtime, method, len(data), result))
+        self.ahead += len(data)
+        while self.pending and self.ahead > kCompressAheadBytes:
+            self.write_pending()
 
-    def update_workbook(self):
-        ws = self.wb.active
-        c, c2 = 1, 5
+    def write_pending(self):
+        arcname, mtime, method, size, result = self.pending.pop(0)
+        if result is None:
+            self.write_dir(arcname, mtime)
+            return
+        if method == 'data':  # (data, mode) already in memory
+            self.ahead -= size
+            self.write_data(arcname, result[0], mtime, result[1])
+            return
+        crc, sha256, data, cpu = result.get()
+        self.ahead -= size
+        entry = self.start_entry(arcname, mtime, 0 if method == 'store' else 8, 0, False, crc, size, len(data))
+        entry['mode'] = 0o100644 << 16
+        self.volumes.write(data)
+        policy.record(arcname, method, size, len(data), cpu)
+        est.learn(arcname, size, len(data))
+        if sha256 is not None:
+            self.digests[arcname] = sha256
 
-        for this_row in range(1, ws.max_row + 1):
-            try:
-                job_number = int(ws.cell(row=this_row, column=c).value)
-            except:
-                continue
-            for this_job in self.job_list:
-                if this_job.job_number == job_number:
-                    disc_entry = ''
-                    if this_job.on_disc:  # was already on disc
-                        for this_disc in this_job.on_disc:
-                            disc_entry += '{0},'.format(str(this_disc))
-                    else:  # was archived
-                        for this_file in this_job.archive.files:
-                            disc_entry += '{0},'.format(str(this_file.in_disc.disc_number))
-                    ws.cell(row=this_row, column=c2).value = disc_entry[0:-1]
-        self.wb.save(self.excel_url)
+    def drain(self):
+        while self.pending:
+            self.write_pending()
 
+    def add_data(self, arcname, data, mtime, mode=0o100644 << 16):
+        """
+        Stores a small entry that's already in memory, sizes and crc up front, behind any files still being deflated.
+        """
+        if self.pending:
+            self.pending.append((arcname, mtime, 'data', len(data), (data, mode)))
+            self.ahead += len(data)
+            while self.pending and self.ahead > kCompressAheadBytes:
+                self.write_pending()
+        else:
+            self.write_data(arcname, data, mtime, mode)
 
-def generate_job_url(job):
-    """
+    def write_data(self, arcname, data, mtime, mode):
+        entry = self.start_entry(arcname, mtime, 0, 0, False, zlib.crc32(data) & 0xFFFFFFFF, len(data))
+        entry['mode'] = mode
+        self.volumes.write(data)
 
-    :param job: the
-     job number to generate the URL for
-    :return: the string of the URL to the job on the server
-    """
+    def add_link(self, arcname, target, mtime):
+        """
+        Stores a symlink the way Info-ZIP and ditto do, as its target with the link's mode in the external attributes.
+        """
+        if not isinstance(target, bytes):
+            target = target.encode('utf-8', 'surrogateescape')
+        self.add_data(arcname, target, mtime, 0o120777 << 16)
 
-    if type(job) != type(''):
-        job = str(job)
-    folderNumber = job[len(job) - 1:len(job)]  # get the last number of the job
-    return kBaseJobsPath + kJobFolderPrefix + folderNumber + kSep + job
+    def add_apple_double(self, path, arcname, mtime):
+        """
+        Adds a folder's, or a file left out of the archive's, resource fork and extended attributes. add_file does
+        this itself for the files it writes, while they're open.
+        """
+        self.add_double(arcname, apple_double(path), mtime)
 
+    def add_double(self, arcname, data, mtime):
+        """
+        Adds what apple_double packed, if there was anything, as an AppleDouble entry __MACOSX/.../._name, where
+        ditto and the Finder look for it, and lets the size estimator know what it took.
+        """
+        if data is None:
+            est.learn_double(0)
+            return
+        parent, name = arcname.rsplit(kSep, 1) if kSep in arcname else ('', arcname)
+        double_name = kSep.join([part for part in ('__MACOSX', parent, '._' + name) if part])
+        est.learn_double(len(data) + 76 + 2 * len(self.encode_name(double_name)[0]))  # with its headers
+        self.add_data(double_name, data, mtime)
 
-def generate_working_url(job):
-    """
+    def close(self):
+        """
+        Writes the central directory and end records.
+        :return: the paths of the finished volumes
+        """
+        self.drain()
+        cd_disk, cd_offset, cd_size = None, 0, 0
+        record_disk, on_last_disk = self.volumes.volume, 0
+        for entry in self.entries:
+            extra = b''
+            size, compressed, offset, disk = entry['size'], entry['compressed'], entry['offset'], entry['disk']
+            if size >= kZipLimit:
+                extra += struct.pack('<Q', size)
+                size = kZipLimit
+            if compressed >= kZipLimit:
+                extra += struct.pack('<Q', compressed)
+                compressed = kZipLimit
+            if offset >= kZipLimit:
+                extra += struct.pack('<Q', offset)
+                offset = kZipLimit
+            if disk >= 0xFFFF:
+                extra += struct.pack('<I', disk)
+                disk = 0xFFFF
+            if extra:
+                extra = struct.pack('<HH', 1, len(extra)) + extra
+            needed = 45 if (extra or entry['zip64']) else 20
+            record = struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | 45, needed, entry['flags'],
+                                 entry['method'], entry['time'], entry['date'], entry['crc'], compressed, size,
+                                 len(entry['name']), len(extra), 0, disk, 0, entry['mode'], offset)
+            record += entry['name'] + extra
+            self.volumes.keep_together(len(record))
+            if cd_disk is None:
+                cd_disk, cd_offset = self.volumes.volume, self.volumes.offset
+            if self.volumes.volume != record_disk:
+                record_disk, on_last_disk = self.volumes.volume, 0
+            self.volumes.write(record)
+            on_last_disk += 1
+            cd_size += len(record)
 
-    :param job: the job number to generate a working folder for
-    :return: the string of the URL of that working folder
-    """
-    if type(job) != type(''):
-        job = str(job)
-    return kWorkingPath + kSep + job
+        count = len(self.entries)
+        end = b''
+        needs_zip64 = count >= 0xFFFF or cd_size >= kZipLimit or cd_offset >= kZipLimit or \
+            self.volumes.volume >= 0xFFFF
+        self.volumes.keep_together(56 + 20 + 22)
+        if cd_disk is None:
+            cd_disk, cd_offset = self.volumes.volume, self.volumes.offset
+        this_disk = self.volumes.volume
+        if this_disk != record_disk:
+            on_last_disk = 0
+        if needs_zip64:
+            end += struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, this_disk, cd_disk, on_last_disk, count,
+                               cd_size, cd_offset)
+            end += struct.pack('<IIQI', 0x07064b50, this_disk, self.volumes.offset, this_disk + 1)
+        end += struct.pack('<IHHHHIIH', 0x06054b50, min(this_disk, 0xFFFF), min(cd_disk, 0xFFFF),
+                           min(on_last_disk, 0xFFFF), min(count, 0xFFFF), min(cd_size, kZipLimit),
+                           min(cd_offset, kZipLimit), 0)
+        self.volumes.write(end)
+        return self.volumes.close()
 
 
-def generate_disc_url(disc):
+class ZipReader:
     """
-
-    :param disc: the disc number to generate path to string for
-    :return: the path to string
+    Reads back what ZipWriter wrote, split archives included, from the central directory, treating the volumes,
+    in order, as one stream.
     """
-    if not isinstance(disc, str):
-        disc = str(disc).zfill(4)
-    return kBaseDisksPath + kDiscFolderPrefix + disc
 
+    def __init__(self, paths):
+        self.paths = paths
+        self.starts = []  # where each volume begins in the stream
+        total = 0
+        for this_path in paths:
+            self.starts.append(total)
+            total += os.path.getsize(this_path)
+        self.size = total
+        self.links = set()  # archive names of the entries that are symlinks
+        self.entries = self.directory()
 
-def get_size(path):
-    total_size = 0
-    try:
-        os.walk(path).next()
-        for dir_path, dir_names, filenames in os.walk(path):
-            for f in filenames:
-                fp = os.path.join(dir_path, f)
-                total_size += os.path.getsize(fp)
-    except:
-        total_size = os.path.getsize(path)
-    return total_size
+    def read(self, offset, length):
+        chunks = []
+        while length > 0:
+            volume = bisect.bisect_right(self.starts, offset) - 1
+            with open(self.paths[volume], 'rb') as source:
+                source.seek(offset - self.starts[volume])
+                data = source.read(length)
+            if not data:
+                raise IOError('{0} ends early.'.format(self.paths[-1]))
+            chunks.append(data)
+            offset += len(data)
+            length -= len(data)
+        return b''.join(chunks)
 
+    def directory(self):
+        """
+        :return: archive name -> (method, crc, compressed size, size, offset of the local header in the stream)
+        """
+        tail_length = min(self.size, 65535 + 22 + 20)
+        tail = self.read(self.size - tail_length, tail_length)
+        end = tail.rfind(b'PK\x05\x06')
+        if end < 0:
+            raise IOError('{0} has no end of central directory record.'.format(self.paths[-1]))
+        count, cd_size, cd_offset = struct.unpack('<HII', tail[end + 10:end + 20])
+        cd_disk = struct.unpack('<H', tail[end + 6:end + 8])[0]
+        if end >= 20 and tail[end - 20:end - 16] == b'PK\x06\x07':  # zip64
+            disk, offset = struct.unpack('<IQ', tail[end - 16:end - 4])
+            record = self.read(self.starts[disk] + offset, 56)
+            cd_disk, count, cd_size, cd_offset = struct.unpack('<I8xQQQ', record[20:56])
+        directory = self.read(self.starts[cd_disk] + cd_offset, cd_size)
+        entries = {}
+        position = 0
+        for this_entry in range(count):
+            method, crc, compressed, size, name_length, extra_length, comment_length, disk = struct.unpack(
+                '<H4xIIIHHHH', directory[position + 10:position + 36])
+            mode, offset = struct.unpack('<II', directory[position + 38:position + 46])
+            name = directory[position + 46:position + 46 + name_length]
+            extra = directory[position + 46 + name_length:position + 46 + name_length + extra_length]
+            while len(extra) >= 4:
+                tag, length = struct.unpack('<HH', extra[:4])
+                if tag == 1:  # zip64 sizes, offset and disk, only the ones that overflowed, in this order
+                    values = extra[4:4 + length]
+                    if size == kZipLimit:
+                        size, values = struct.unpack('<Q', values[:8])[0], values[8:]
+                    if compressed == kZipLimit:
+                        compressed, values = struct.unpack('<Q', values[:8])[0], values[8:]
+                    if offset == kZipLimit:
+                        offset, values = struct.unpack('<Q', values[:8])[0], values[8:]
+                    if disk == 0xFFFF:
+                        disk = struct.unpack('<I', values[:4])[0]
+                extra = extra[4 + length:]
+            name = name.decode('utf-8', 'surrogateescape') if str is not bytes else name
+            entries[name] = (method, crc, compressed, size, self.starts[disk] + offset)
+            if stat.S_ISLNK(mode >> 16):
+                self.links.add(name)
+            position += 46 + name_length + extra_length + comment_length
+        return entries
 
-lg = Log(kWorkingPath + kSep + 'Log_{0}-{1}-{2}.txt'.format(dt.month, dt.day, dt.year))
+    def blocks(self, arcname):
+        """
+        Yields an entry's data, inflated, and checks its crc at the end.
+        """
+        method, crc, compressed, size, offset = self.entries[arcname]
+        name_length, extra_length = struct.unpack('<HH', self.read(offset + 26, 4))
+        position = offset + 30 + name_length + extra_length
+        decompressor = zlib.decompressobj(-15) if method == 8 else None
+        this_crc = 0
+        while compressed > 0:
+            block = self.read(position, min(kBufferSize, compressed))
+            position += len(block)
+            compressed -= len(block)
+            if decompressor is not None:
+                block = decompressor.decompress(block)
+            this_crc = zlib.crc32(block, this_crc)
+            yield block
+        if decompressor is not None:
+            block = decompressor.flush()
+            this_crc = zlib.crc32(block, this_crc)
+            yield block
+        if this_crc & 0xFFFFFFFF != crc:
+            raise IOError('{0} in {1} fails its crc.'.format(arcname, self.paths[-1]))
 
-if __name__ == "__main__":
-    mngr = Manager(kURL)
+    def extract(self, arcname, path):
+        with open(path, 'wb') as out:
+            for block in self.blocks(arcname):
+                out.write(block)
 
-    # code for bucketing the jobs
-    for this_job in mngr.job_list:
-        if not this_job.ignore and not this_job.is_archived:
-            this_job.cleanup()
-            this_job.archive = Archive(this_job)
-            for this_file in this_job.archive.files:
-                index = 0
-                while index < len(mngr.disc_catalog):
-                    try:
-                        if not (this_file.add2disc(mngr.disc_catalog[index])):
-                            index += 1
-                        else:
-                            break
-                    except:
-                        pass
-                if not this_file.is_placed:
-                    new_disc_number = mngr.get_last_disc() + 1
-                    new_disc = Disc(new_disc_number)
-                    mngr.disc_catalog.append(new_disc)
-                    this_file.add2disc(new_disc)
-        lg.file.flush()
+    def data(self, arcname):
+        return b''.join(self.blocks(arcname))
 
-    # code for cleaning up the directory and adding disk tags
-    accepted_inputs = ['y', 'n', 'a']
-    selection = None
-    while not (selection in accepted_inputs):
-        selection = raw_input('Proceed with job dumps and folder tagging? (y/n/a):')
+class CompressionPolicy:
+    """
+    Picks a method for each archive entry: 'store' for formats that are already compressed, 'high' for ones that
+    deflate well, and otherwise whatever a trial compression of the first block suggests. Trial ratios are averaged
+    per file extension and settle after kTrialSamples files, so a folder of a thousand TIFFs pays for three trials.
+    Results are totalled per extension as bytes saved per cpu second.
+    """
+
+    def __init__(self):
+        self.trials = {}  # extension -> [samples, average ratio]
+        self.totals = {}  # (extension, method) -> [files, bytes in, bytes out, cpu seconds]
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def extension(name):
+        base = name.rsplit('/', 1)[-1]
+        if '.' not in base:
+            return ''
+        return base.rsplit('.', 1)[-1].lower()
+
+    def choose(self, name, block):
+        """
+        :param name: the file's name
+        :param block: the first block read from the file
+        :return: 'store', 'fast' or 'high'
+        """
+        ext = self.extension(name)
+        if ext in kStoreExtensions:
+            return 'store'
+        if ext in kHighExtensions:
+            return 'high'
+        if not kCompressionTrial or not block:
+            return 'fast'
+        with self.lock:
+            samples, ratio = self.trials.get(ext, (0, 1.0))
+        if samples < kTrialSamples:
+            sample = block[:kTrialBlock]
+            this_ratio = len(zlib.compress(sample, kFastLevel)) / float(len(sample))
+            with self.lock:
+                samples, ratio = self.trials.get(ext, (0, 1.0))
+                ratio = (ratio * samples + this_ratio) / (samples + 1)
+                samples += 1
+                self.trials[ext] = (samples, ratio)
+        if ratio > 0.95:
+            return 'store'
+        if ratio > 0.6:
+            return 'fast'
+        return 'high'
+
+    def record(self, name, method, bytes_in, bytes_out, cpu):
+        with self.lock:
+            totals = self.totals.setdefault((self.extension(name), method), [0, 0, 0, 0.0])
+            totals[0] += 1
+            totals[1] += bytes_in
+            totals[2] += bytes_out
+            totals[3] += cpu
+
+    def report(self):
+        for (ext, method), (files, bytes_in, bytes_out, cpu) in sorted(self.totals.items()):
+            saved = bytes_in - bytes_out
+            rate = saved / cpu if cpu > 0 else 0
+            lg.add('Compression .{0} ({1}): {2} files, {3} -> {4} bytes, {5:.0f} bytes saved per cpu second\n'.format(
+                ext, method, files, bytes_in, bytes_out, rate))
+
+
+class SizeEstimator:
+    """
+    Predicts how big a job's archive will be before it's written, so disc space can be reserved for it up front.
+
+    Each file type's ratio comes from the history of files already archived, kept across runs, or for a type with
+    too little history, from deflating a couple of blocks out of its largest files in the job. The bound adds
+    kEstimateConfidence standard deviations of ratio to each type, capped at kMaxRatio, which no entry can exceed
+    since the policy stores anything that won't compress. Zip headers are counted exactly. With kAppleDouble, each
+    file and folder adds the average its AppleDouble entry has taken so far, since its forks and attributes can't be
+    sized without reading them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.history = {}  # extension -> [bytes in, bytes out, files, mean ratio, sum of squared deviations]
+        self.doubles = [0, 0]  # [files and folders, bytes of their AppleDouble entries]
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as history_file:
+                history = json.load(history_file)
+            if 'ratios' in history:
+                self.history, self.doubles = history['ratios'], history.get('apple_double', [0, 0])
+            else:  # from before AppleDouble entries were counted
+                self.history = history
+        except (IOError, ValueError):
+            self.history = {}
+
+    def save(self):
+        try:
+            temp = '{0}.{1}.tmp'.format(self.path, os.getpid())  # other workers may be saving it too
+            with self.lock, open(temp, 'w') as history_file:
+                json.dump({'ratios': self.history, 'apple_double': self.doubles}, history_file)
+            os.rename(temp, self.path)
+        except:
+            lg.add('Unable to save ratio history @: {0}\n'.format(self.path))
+
+    def learn(self, name, bytes_in, bytes_out):
+        if not bytes_in:
+            return
+        ratio = bytes_out / float(bytes_in)
+        with self.lock:
+            stats = self.history.setdefault(CompressionPolicy.extension(name), [0, 0, 0, 0.0, 0.0])
+            stats[0] += bytes_in
+            stats[1] += bytes_out
+            stats[2] += 1
+            delta = ratio - stats[3]
+            stats[3] += delta / stats[2]
+            stats[4] += delta * (ratio - stats[3])
+
+    def learn_double(self, nbytes):
+        """
+        :param nbytes: what a file or folder's AppleDouble entry took, headers and all, 0 if it didn't need one
+        """
+        with self.lock:
+            self.doubles[0] += 1
+            self.doubles[1] += nbytes
+
+    @staticmethod
+    def sample(paths):
+        """
+        :param paths: files of one type, largest first
+        :return: ratios of a block from the start and the middle of each
+        """
+        ratios = []
+        for this_path, size in paths:
+            try:
+                with open(this_path, 'rb') as source:
+                    for offset in sorted(set([0, max(0, size // 2 - kTrialBlock // 2)])):
+                        source.seek(offset)
+                        block = gov.read(source, kTrialBlock)
+                        if block:
+                            ratios.append(len(zlib.compress(block, kFastLevel)) / float(len(block)))
+            except IOError:
+                pass
+        return ratios
+
+    def ratio(self, ext, paths, sample=True):
+        """
+        :param sample: False to go without reading any files, a type without enough history is then expected to do
+        as well as everything else has, and bounded by kMaxRatio
+        :return: (expected, bound) ratio for a file type
+        """
+        if ext in kStoreExtensions:
+            return 1.0, 1.0
+        with self.lock:
+            stats = self.history.get(ext)
+            totals = [sum(this_stats[index] for this_stats in self.history.values()) for index in (0, 1)]
+        if stats and stats[2] >= kTrialSamples and stats[0]:
+            spread = (stats[4] / (stats[2] - 1)) ** 0.5
+            expected = stats[1] / float(stats[0])
+        elif not sample:
+            return min(totals[1] / float(totals[0]), kMaxRatio) if totals[0] else kMaxRatio, kMaxRatio
+        else:
+            ratios = self.sample(sorted(paths, key=lambda p: -p[1])[:kEstimateSamples])
+            if not ratios:
+                return kMaxRatio, kMaxRatio
+            expected = sum(ratios) / len(ratios)
+            spread = kEstimateSpread
+            if len(ratios) > 1:
+                spread = max(spread, (sum((r - expected) ** 2 for r in ratios) / (len(ratios) - 1)) ** 0.5)
+        return min(expected, kMaxRatio), min(expected + kEstimateConfidence * spread, kMaxRatio)
+
+    def estimate(self, job, sample=True, skip=()):
+        """
+        :param sample: False to estimate from the history and the folder's metadata alone
+        :param skip: paths of files and folders that won't be in the archive, ones cleanup will remove
+        :return: (expected, bound) size in bytes of the job's archive
+        """
+        parent = job.location.rsplit(kSep, 1)[0]
+        base = job.delta_base()
+        by_type = {}  # extension -> [(path, size)]
+        overhead = 98  # end of central directory records
+        doubled = 0  # files and folders that may have an AppleDouble entry
+        for this_dir, entry in each_entry(job, base):
+            if skip and any(this_dir == this_path or this_dir.startswith(this_path + kSep) for this_path in skip):
+                continue
+            arc_dir = len(ZipWriter.encode_name(this_dir[len(parent) + 1:] + '/')[0])
+            overhead += 76 + 2 * arc_dir
+            doubled += 1
+            for this_file, (size, mtime) in entry['files'].items():
+                if skip and this_dir + kSep + this_file in skip:
+                    continue
+                link = this_file in entry['links']
+                if base is not None and not base.changed(this_dir[len(parent) + 1:] + kSep + this_file,
+                                                         this_dir + kSep + this_file, size, mtime, sample and not link):
+                    continue
+                name = len(ZipWriter.encode_name(this_file)[0])
+                overhead += 144 + 2 * (arc_dir + name)  # headers, zip64 extra fields and the data descriptor
+                if link:  # stored, the target is the data
+                    overhead += size
+                    continue
+                doubled += 1
+                by_type.setdefault(CompressionPolicy.extension(this_file), []).append(
+                    (this_dir + kSep + this_file, size))
+        if kAppleDouble:
+            with self.lock:
+                if self.doubles[0]:
+                    overhead += doubled * self.doubles[1] // self.doubles[0]
+        expected, bound = overhead, overhead
+        for ext, paths in by_type.items():
+            total = sum(size for this_path, size in paths)
+            expected_ratio, bound_ratio = self.ratio(ext, paths, sample)
+            expected += total * expected_ratio
+            bound += total * bound_ratio
+        return int(expected), int(bound) + 1
+
+
+class Disc(object):
+    __slots__ = ('disc_number', 'folder_name', 'location', 'reserved', 'claimed', 'size', 'contents', 'is_full')
+
+    def __init__(self, disc_number, size=None, contents=None, is_full=False):
+        """
+        :param size: the used bytes the catalog has for the disc, if it's still current. Without it the folder is
+        created if need be, read and recorded in the catalog.
+        :param contents: the names in the folder, None to fetch them from the catalog when they're needed
+        """
+        self.disc_number = disc_number
+        self.folder_name = kDiscFolderPrefix + str(self.disc_number).zfill(4)
+        self.location = kBaseDisksPath + kSep + self.folder_name
+        self.reserved = 0  # held for archives being written into the folder
+        self.claimed = 0  # held by other workers, in worker mode
+        if size is not None:
+            self.size = size
+            self.contents = contents
+            self.is_full = is_full
+            return
+
+        try:
+            os.makedirs(self.location)
+            lg.add('Created disc folder: {0}\n'.format(self.location))
+        except:
+            pass
+        self.rescan()
+
+    def rescan(self):
+        """
+        Reads the disc's folder again and records what's in it in the catalog.
+        """
+        self.size = get_size(self.location)
+        self.is_full = kFullSize - self.size < kSealFree
+        path, dirs, files = next(scn.walk(self.location))
+        self.contents = dirs + files
+        cat.scanned(self)
+
+    def holds(self, name):
+        if self.contents is None:
+            self.contents = list(cat.contents(self.disc_number))
+        return name in self.contents
+
+    def add_manifest(self, this_file):
+        """
+        Records a placed file's checksums in this disc's sha256sum style manifest and its SFV file.
+        """
+        lines = [(kManifestName, '{0}  {1}\n'.format(this_file.sha256, this_file.name)),
+                 (kSFVName, '{0} {1}\n'.format(this_file.name, this_file.crc))]
+        for this_name, this_line in lines:
+            with open(self.location + kSep + this_name, 'a') as manifest:
+                manifest.write(this_line)
+                manifest.flush()
+                os.fsync(manifest.fileno())
+            self.size += len(this_line)
+
+    def free(self):
+        """
+        :return: the largest file add2disc will still accept, leaving room for what's reserved
+        """
+        if self.is_full:  # sealed
+            return 0
+        return max(0, kFullSize - self.size - self.reserved - self.claimed)
+
+
+class DiscCatalog:
+    """
+    What each disc folder held when it was last read or placed into, kept in sqlite so startup doesn't have to walk
+    every disc ever staged. A disc's folder mtime is recorded alongside it and is only trusted while no archive is
+    being written into the folder, so a disc left half written is read again on the next run. Sealed discs, those
+    with less than kSealFree left, are never read again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS discs (number INTEGER PRIMARY KEY, used INTEGER NOT NULL, mtime REAL,
+                                              full INTEGER NOT NULL DEFAULT 0);
+            CREATE TABLE IF NOT EXISTS contents (disc INTEGER NOT NULL, name TEXT NOT NULL, size INTEGER NOT NULL,
+                                                 PRIMARY KEY (disc, name));
+        """)
+
+    def discs(self):
+        """
+        :return: disc number -> (used bytes, folder mtime, sealed)
+        """
+        with self.lock:
+            rows = self.db.execute('SELECT number, used, mtime, full FROM discs').fetchall()
+        return dict((number, (used, mtime, bool(full))) for number, used, mtime, full in rows)
+
+    def contents(self, disc_number):
+        """
+        :return: name -> size of everything in the disc's folder
+        """
+        with self.lock:
+            rows = self.db.execute('SELECT name, size FROM contents WHERE disc = ?', (disc_number,)).fetchall()
+        return dict(rows)
+
+    @staticmethod
+    def mtime(disc):
+        if disc.reserved:  # still being written into
+            return None
+        try:
+            return os.stat(disc.location).st_mtime
+        except OSError:
+            return None
+
+    def save_disc(self, disc):
+        self.db.execute('INSERT OR REPLACE INTO discs (number, used, mtime, full) VALUES (?, ?, ?, ?)',
+                        (disc.disc_number, disc.size, self.mtime(disc), int(disc.is_full and not disc.reserved)))
+
+    def scanned(self, disc):
+        """
+        Replaces what's recorded for a disc with what was just read from its folder.
+        """
+        sizes = [(disc.disc_number, this_name, get_size(disc.location + kSep + this_name))
+                 for this_name in disc.contents]
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM contents WHERE disc = ?', (disc.disc_number,))
+            self.db.executemany('INSERT INTO contents (disc, name, size) VALUES (?, ?, ?)', sizes)
+            self.save_disc(disc)
+
+    @staticmethod
+    def gone(db, disc):
+        """
+        Drops rows for names no longer in the disc's folder, volumes renamed when they were finished or moved away.
+        :return: the bytes the dropped rows counted
+        """
+        try:
+            present = set(os.listdir(disc.location))
+        except OSError:
+            return 0
+        rows = db.execute('SELECT name, size FROM contents WHERE disc = ?', (disc.disc_number,)).fetchall()
+        gone = [(this_name, size) for this_name, size in rows if this_name not in present]
+        db.executemany('DELETE FROM contents WHERE disc = ? AND name = ?',
+                       [(disc.disc_number, this_name) for this_name, size in gone])
+        return sum(size for this_name, size in gone)
+
+    def placed(self, disc, names):
+        """
+        Records files just written or moved into a disc's folder.
+        """
+        sizes = []
+        for this_name in names:
+            try:
+                sizes.append((disc.disc_number, this_name, os.path.getsize(disc.location + kSep + this_name)))
+            except OSError:
+                pass
+        with self.lock, self.db:
+            disc.size = max(0, disc.size - self.gone(self.db, disc))
+            self.db.executemany('INSERT OR REPLACE INTO contents (disc, name, size) VALUES (?, ?, ?)', sizes)
+            self.save_disc(disc)
+
+    def drop(self, disc_number):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM contents WHERE disc = ?', (disc_number,))
+            self.db.execute('DELETE FROM discs WHERE number = ?', (disc_number,))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class Coordinator:
+    """
+    Lets several agents, on one machine or several, work through the same ledger into the same staging folder.
+    Everything they share is kept in the disc catalog's sqlite file, and every change is made in an immediate
+    transaction, so only one worker makes it at a time:
+
+    leases say which worker is archiving each job. A worker renews its leases and claims while it runs, so if it
+    dies they run out after kLeaseTime and the next worker to ask takes its jobs over, along with their journal
+    records.
+    claims hold room on a disc for an archive being written into it or moved onto it. A claim only goes through if
+    the disc has room for it on top of everything placed on it and every other live claim.
+    locks keep two workers from doing the same thing at once, saving the ledger for one.
+
+    sqlite's locking relies on the file system, so the staging folder has to be on one where locks work, which
+    rules out some NFS mounts.
+    """
+
+    def __init__(self, path, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=kLeaseTime, check_same_thread=False, isolation_level=None)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS discs (number INTEGER PRIMARY KEY, used INTEGER NOT NULL, mtime REAL,
+                                              full INTEGER NOT NULL DEFAULT 0);
+            CREATE TABLE IF NOT EXISTS contents (disc INTEGER NOT NULL, name TEXT NOT NULL, size INTEGER NOT NULL,
+                                                 PRIMARY KEY (disc, name));
+            CREATE TABLE IF NOT EXISTS leases (job INTEGER PRIMARY KEY, worker TEXT NOT NULL, expires REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS claims (worker TEXT NOT NULL, job INTEGER NOT NULL, disc INTEGER NOT NULL,
+                                               bytes INTEGER NOT NULL, expires REAL NOT NULL,
+                                               PRIMARY KEY (worker, job, disc));
+            CREATE TABLE IF NOT EXISTS locks (name TEXT PRIMARY KEY, worker TEXT NOT NULL, expires REAL NOT NULL);
+        """)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.heartbeat)
+        self.thread.daemon = True
+        self.thread.start()
+        lg.add('Worker: {0}, started.\n'.format(name))
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')  # takes the write lock now, so what's read can't change
+            try:
+                yield self.db
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+
+    def heartbeat(self):
+        while not self.stopped.wait(kLeaseTime / 4.0):
+            try:
+                self.renew()
+            except sqlite3.Error as error:
+                lg.add('Worker: {0}, unable to renew its leases: {1}\n'.format(self.name, error))
+
+    def renew(self):
+        expires = time.time() + kLeaseTime
+        with self.transaction() as db:
+            for this_table in ('leases', 'claims', 'locks'):
+                db.execute('UPDATE {0} SET expires = ? WHERE worker = ?'.format(this_table), (expires, self.name))
+
+    def lease(self, job_numbers, limit=None):
+        """
+        Leases jobs that no other worker holds, or whose worker has stopped renewing them.
+        :param limit: the most jobs to take on that aren't already held by this worker
+        :return: the job numbers now held by this worker
+        """
+        now = time.time()
+        granted, taken = [], []
+        with self.transaction() as db:
+            for this_job_number in job_numbers:
+                row = db.execute('SELECT worker, expires FROM leases WHERE job = ?', (this_job_number,)).fetchone()
+                if row is not None and row[0] != self.name and row[1] >= now:
+                    continue
+                if (row is None or row[0] != self.name) and limit is not None and limit <= 0:
+                    continue
+                db.execute('INSERT OR REPLACE INTO leases (job, worker, expires) VALUES (?, ?, ?)',
+                           (this_job_number, self.name, now + kLeaseTime))
+                if row is None or row[0] != self.name:
+                    limit = None if limit is None else limit - 1
+                if row is not None and row[0] != self.name:
+                    db.execute('DELETE FROM claims WHERE job = ?', (this_job_number,))
+                    taken.append((this_job_number, row[0]))
+                granted.append(this_job_number)
+        for this_job_number, worker in taken:
+            count = jnl.adopt(this_job_number, kWorkingPath + kSep + kWorkerJournal.format(worker))
+            lg.add('Job: {0}, taken over from worker: {1}, with {2} journal records.\n'.format(
+                this_job_number, worker, count))
+        return granted
+
+    def unlease(self, job_number):
+        with self.transaction() as db:
+            db.execute('DELETE FROM leases WHERE job = ? AND worker = ?', (job_number, self.name))
+            db.execute('DELETE FROM claims WHERE job = ? AND worker = ?', (job_number, self.name))
+
+    def usage(self, db, disc_number, job_number=None):
+        """
+        :return: (bytes placed on the disc, bytes claimed by other workers, bytes claimed for anything but job_number
+        by this one, sealed)
+        """
+        used = db.execute('SELECT COALESCE(SUM(size), 0) FROM contents WHERE disc = ?', (disc_number,)).fetchone()[0]
+        row = db.execute('SELECT full FROM discs WHERE number = ?', (disc_number,)).fetchone()
+        others, mine = 0, 0
+        for worker, job, claimed in db.execute('SELECT worker, job, bytes FROM claims WHERE disc = ? AND expires >= ?',
+                                               (disc_number, time.time())):
+            if worker != self.name:
+                others += claimed
+            elif job != job_number:
+                mine += claimed
+        return used, others, mine, bool(row and row[0])
+
+    def claim(self, disc, job_number, size):
+        """
+        Makes sure at least size bytes are held on the disc for the job, and brings the disc's size, other workers'
+        claims and seal up to date while it's at it.
+        :return: True if the room is held
+        """
+        with self.transaction() as db:
+            used, others, mine, full = self.usage(db, disc.disc_number, job_number)
+            disc.size, disc.claimed, disc.is_full = used, others, full
+            row = db.execute('SELECT bytes FROM claims WHERE worker = ? AND job = ? AND disc = ?',
+                             (self.name, job_number, disc.disc_number)).fetchone()
+            size = max(size, row[0] if row else 0)
+            if full or used + others + mine + size > kFullSize:
+                return False
+            db.execute('INSERT OR REPLACE INTO claims (worker, job, disc, bytes, expires) VALUES (?, ?, ?, ?, ?)',
+                       (self.name, job_number, disc.disc_number, size, time.time() + kLeaseTime))
+        return True
+
+    def settle(self, job_number):
+        """
+        Gives back whatever room the job still holds, once its archive has been placed or given up on.
+        """
+        with self.transaction() as db:
+            db.execute('DELETE FROM claims WHERE worker = ? AND job = ?', (self.name, job_number))
+
+    def placed(self, disc, this_file):
+        """
+        Records a file just placed on a disc and takes it off the job's claim. The disc is sealed once it's nearly
+        full and no worker is still writing into it.
+        """
+        sizes = []
+        for this_name in (this_file.name, kManifestName, kSFVName):
+            try:
+                sizes.append((disc.disc_number, this_name, os.path.getsize(disc.location + kSep + this_name)))
+            except OSError:
+                pass
+        with self.transaction() as db:
+            DiscCatalog.gone(db, disc)
+            db.executemany('INSERT OR REPLACE INTO contents (disc, name, size) VALUES (?, ?, ?)', sizes)
+            db.execute('UPDATE claims SET bytes = MAX(0, bytes - ?) WHERE worker = ? AND job = ? AND disc = ?',
+                       (this_file.footprint(), self.name, this_file.job_number, disc.disc_number))
+            used, others, mine, full = self.usage(db, disc.disc_number, this_file.job_number)
+            row = db.execute('SELECT bytes FROM claims WHERE worker = ? AND job = ? AND disc = ?',
+                             (self.name, this_file.job_number, disc.disc_number)).fetchone()
+            writing = others + mine + (row[0] if row else 0)
+            disc.size, disc.claimed = used, others
+            disc.is_full = full or (kFullSize - used < kSealFree and not writing)
+            db.execute('INSERT OR REPLACE INTO discs (number, used, mtime, full) VALUES (?, ?, ?, ?)',
+                       (disc.disc_number, used, None if writing else DiscCatalog.mtime(disc), int(disc.is_full)))
+
+    def next_disc(self, last):
+        """
+        :return: a disc number no worker has used yet, recorded so no other worker opens it too
+        """
+        with self.transaction() as db:
+            highest = db.execute('SELECT MAX(number) FROM discs').fetchone()[0]
+            number = max(last, highest or 0) + 1
+            db.execute('INSERT INTO discs (number, used, mtime, full) VALUES (?, 0, NULL, 0)', (number,))
+        return number
+
+    def refresh(self, allocator):
+        """
+        Brings the allocator up to date with the discs other workers have opened, placed on or claimed room on.
+        """
+        with self.transaction() as db:
+            rows = db.execute('SELECT number, full FROM discs').fetchall()
+            usage = dict((number, self.usage(db, number)) for number, full in rows if not full)
+        for number, full in sorted(rows):
+            if number not in allocator.positions:
+                if full or not os.path.isdir(kBaseDisksPath + kSep + kDiscFolderPrefix + str(number).zfill(4)):
+                    continue
+                allocator.manager.disc_catalog.append(Disc(number))
+                allocator.add(allocator.manager.disc_catalog[-1])
+            index = allocator.positions[number]
+            disc = allocator.discs[index]
+            old_free = disc.free()
+            if full:
+                disc.is_full = True
+            else:
+                disc.size, disc.claimed = usage[number][0], usage[number][1]
+            allocator.update(index, old_free)
+
+    @contextlib.contextmanager
+    def mutex(self, name):
+        """
+        Holds a named lock across every worker, waiting for it if another worker has it.
+        """
+        while True:
+            with self.transaction() as db:
+                row = db.execute('SELECT worker, expires FROM locks WHERE name = ?', (name,)).fetchone()
+                if row is None or row[1] < time.time():
+                    db.execute('INSERT OR REPLACE INTO locks (name, worker, expires) VALUES (?, ?, ?)',
+                               (name, self.name, time.time() + kLeaseTime))
+                    break
+            time.sleep(1)
+        try:
+            yield
+        finally:
+            with self.transaction() as db:
+                db.execute('DELETE FROM locks WHERE name = ? AND worker = ?', (name, self.name))
+
+    def close(self):
+        """
+        Lets go of everything this worker holds. Its leases are left expired rather than removed, so whoever takes
+        its jobs over knows whose journal to carry them on from.
+        """
+        self.stopped.set()
+        with self.transaction() as db:
+            db.execute('UPDATE leases SET expires = 0 WHERE worker = ?', (self.name,))
+            db.execute('DELETE FROM claims WHERE worker = ?', (self.name,))
+            db.execute('DELETE FROM locks WHERE worker = ?', (self.name,))
+        with self.lock:
+            self.db.close()
+        lg.add('Worker: {0}, stopped.\n'.format(self.name))
+
+
+class Log:
+    def __init__(self, path):
+        self.path = path
+        self.name = self.path.rsplit('/')[-1]
+        try:
+            self.size = get_size(self.path)
+        except:
+            self.size = 0
+        self.writer = EventWriter(self.path)
+        self.lock = threading.Lock()
+
+
+    def open(self):
+        self.writer = EventWriter(self.path)
+
+    def close(self):
+        self.writer.close()
+
+    def flush(self):
+        self.writer.flush()
+
+    def add(self, string):
+        with self.lock:
+            print(string)
+        self.writer.put(string)
+
+
+class EventWriter:
+    """
+    Appends to a file from a background thread, so the agent's hot loops only ever put a line on a queue. Lines are
+    written out in batches of up to kEventBatch whenever the writer catches up.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.drain)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def drain(self):
+        with open(self.path, 'ab') as out:
+            while True:
+                batch = [self.queue.get()]
+                while len(batch) < kEventBatch:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                lines = [line for line in batch if isinstance(line, (bytes, type(u'')))]
+                out.write(b''.join(line if isinstance(line, bytes) else line.encode('utf-8') for line in lines))
+                out.flush()
+                for this_line in batch:
+                    if hasattr(this_line, 'set'):  # an event flush() is waiting on
+                        this_line.set()
+                if None in batch:
+                    return
+
+    def put(self, line):
+        self.queue.put(line)
+
+    def flush(self):
+        if self.thread.is_alive():
+            done = threading.Event()
+            self.queue.put(done)
+            done.wait()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
+class Metrics:
+    """
+    Times each stage of a job (inspect, cleanup, archive, move, dump, tag, ledger) and counts the bytes and files it
+    handled. Every measurement goes out as a JSON line through an EventWriter, and totals per stage are written at
+    the end of the run in Prometheus' text format.
+    """
+
+    def __init__(self, events):
+        self.events = events
+        self.totals = {}  # stage -> [count, seconds, bytes, files, failures]
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    @contextlib.contextmanager
+    def timed(self, stage, job_number=None):
+        """
+        with mtr.timed('move', job) as counts: ... counts['bytes'] += n
+        """
+        counts = {'bytes': 0, 'files': 0, 'ok': True}
+        started = time.time()
+        try:
+            yield counts
+        except:
+            counts['ok'] = False
+            raise
+        finally:
+            self.add(stage, job_number, time.time() - started, counts['bytes'], counts['files'], counts['ok'])
+
+    def add(self, stage, job_number, seconds, bytes_count=0, files=0, ok=True):
+        with self.lock:
+            totals = self.totals.setdefault(stage, [0, 0.0, 0, 0, 0])
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] += bytes_count
+            totals[3] += files
+            totals[4] += 0 if ok else 1
+        self.events.put(json.dumps({'time': time.time(), 'stage': stage, 'job': job_number, 'seconds': seconds,
+                                    'bytes': bytes_count, 'files': files, 'ok': ok}) + '\n')
+
+    def summary(self, path=kMetricsURL):
+        lines = []
+        for name, index, kind, text in [('stage_runs_total', 0, 'counter', 'Times each stage ran.'),
+                                        ('stage_seconds_total', 1, 'counter', 'Wall time spent in each stage.'),
+                                        ('stage_bytes_total', 2, 'counter', 'Bytes each stage handled.'),
+                                        ('stage_files_total', 3, 'counter', 'Files each stage handled.'),
+                                        ('stage_failures_total', 4, 'counter', 'Stage runs that failed.')]:
+            lines.append('# HELP archive_agent_{0} {1}'.format(name, text))
+            lines.append('# TYPE archive_agent_{0} {1}'.format(name, kind))
+            for stage, totals in sorted(self.totals.items()):
+                lines.append('archive_agent_{0}{{stage="{1}"}} {2}'.format(name, stage, totals[index]))
+        lines.append('# HELP archive_agent_run_seconds Wall time of the last run.')
+        lines.append('# TYPE archive_agent_run_seconds gauge')
+        lines.append('archive_agent_run_seconds {0}'.format(time.time() - self.started))
+        lines.append('# HELP archive_agent_last_run_timestamp_seconds When the last run finished.')
+        lines.append('# TYPE archive_agent_last_run_timestamp_seconds gauge')
+        lines.append('archive_agent_last_run_timestamp_seconds {0}'.format(time.time()))
+        temp = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(temp, 'w') as out:  # collectors must never see half a file
+            out.write('\n'.join(lines) + '\n')
+        os.rename(temp, path)
+
+
+class Manager:
+    def __init__(self, url):
+        self.excel_url = url
+        self.job_list = []
+        self.disc_catalog = []
+        self.get_job_list(url)
+        self.setup_disc_catalog()
+        self.allocator = DiscAllocator(self)
+        self.resume()
+
+
+    def get_job_list(self, url, known=None):
+        """
+        Setups up the master job list and attaches the Excel file log to the manager object.
+        :param known: job number -> Job already inspected, reused instead of inspecting again
+        """
+        try:
+            self.ledger = Ledger(url)
+        except:
+            print('No excel file at {0}'.format(url))
+            lg.add('Excel file: {0}, does not exist.\n'.format(url))
+            return False
+        for job_number, r in self.ledger.duplicates:
+            lg.add('Duplicate Entry for Job: {0} found. Skipping Entry @ row: {1}\n'.format(job_number, r))
+        for job_number in self.ledger.unfiled:
+            if known and job_number in known:
+                self.job_list.append(known[job_number])
+            else:
+                self.job_list.append(Job(job_number))
+        return True
+
+    def setup_disc_catalog(self, url=kBaseDisksPath):
+        """
+        Populates the disc catalog from the disc folders in the staging directory. Sealed discs come straight from
+        the persistent catalog, open ones are only read again if their folder has changed since it was recorded.
+        If there are no disc folders, prompts for a disc number to start with and creates that folder, unless there's
+        nobody to ask.
+        :return: False if there are no discs to archive to
+        """
+        known = cat.discs()  # disc number -> (used, mtime, full)
+        pattern = re.compile('^' + kDiscFolderPrefix + r'(\d+)$')
+        disc_numbers = []
+        for this_dir in os.listdir(url):
+            is_disc_folder = pattern.match(this_dir)
+            if is_disc_folder and (int(is_disc_folder.group(1)) in known or os.path.isdir(url + kSep + this_dir)):
+                disc_numbers.append(int(is_disc_folder.group(1)))
+
+        rescanned = 0
+        for this_disc_number in sorted(disc_numbers):
+            used, mtime, full = known.get(this_disc_number, (None, None, False))
+            if used is not None and full:
+                this_disc = Disc(this_disc_number, used, None, True)
+            elif used is not None and mtime is not None and \
+                    mtime == os.stat(url + kSep + kDiscFolderPrefix + str(this_disc_number).zfill(4)).st_mtime:
+                this_disc = Disc(this_disc_number, used, None, False)
+            else:
+                this_disc = Disc(this_disc_number)
+                rescanned += 1
+                if this_disc.is_full and kImageOnSeal:
+                    images.submit(this_disc_number)
+            self.disc_catalog.append(this_disc)
+        for this_disc_number in set(known) - set(disc_numbers):
+            cat.drop(this_disc_number)
+        lg.add('Disc catalog: {0} discs, {1} read from their folders.\n'.format(len(disc_numbers), rescanned))
+
+        if not self.disc_catalog:  # no disc directories
+            if unattended:
+                lg.add('No disc folders @: {0}, create the first one, {1}NNNN, to start archiving.\n'.format(
+                    url, kDiscFolderPrefix))
+                return False
+            while not ('disc_number' in locals()):  # ask for a disc number until you get a valid one
+                try:
+                    disc_number = int(input('Enter a starting Disc #: '))
+                except EOFError:  # input isn't a terminal
+                    lg.add('No disc folders @: {0}, and no starting disc number given.\n'.format(url))
+                    return False
+                except:
+                    print('Disc number is invalid, please enter an integer disc number.')
+            self.disc_catalog.append(Disc(disc_number))
+
+        return True
+
+    def resume(self, jobs=None):
+        """
+        Carries jobs from an interrupted run forward from the journal, so finished stages aren't done again.
+        :param jobs: the jobs to carry forward, all of them by default
+        """
+        discs = dict((this_disc.disc_number, this_disc) for this_disc in self.disc_catalog)
+        unarchived = []  # jobs whose archives may have been left half written
+        resumed = []  # jobs whose volumes may have been left half copied onto a disc
+        unplaced = []  # [(job, volumes)] to place once what was left half done is cleared away
+        for this_job in (self.job_list if jobs is None else jobs):
+            stages = jnl.stages(this_job.job_number)
+            if not stages:
+                if crd is None:  # in worker mode it may be another worker's, being written now
+                    unarchived.append(this_job.job_number)
+                continue
+            if crd is not None and jobs is None and not crd.lease([this_job.job_number]):
+                continue  # another worker has taken it over
+            resumed.append(this_job.job_number)
+            if 'archived' not in stages:
+                unarchived.append(this_job.job_number)
+            lg.add('Job: {0}, resuming after: {1}.\n'.format(this_job.job_number, ', '.join(sorted(stages))))
+            this_job.clean = 'cleaned' in stages
+            if 'reopened' in stages:
+                this_job.prior_discs = stages['reopened']
+            if 'archived' not in stages:
+                continue
+            try:
+                Archive(this_job, {'archived': stages['archived'], 'placed': stages.get('placed', {}),
+                                   'discs': discs, 'allocator': self.allocator})
+            except:
+                lg.add('Job: {0}, journaled archive is missing. Ignoring.\n'.format(this_job.job_number))
+                this_job.ignore = True
+                continue
+            this_job.ignore = False  # a dumped job has no folder left to inspect
+            this_job.on_server = 'dumped' not in stages
+            this_job.tagged = 'tagged' in stages
+            unplaced.append((this_job, [this_file for this_file in this_job.archive.files if not this_file.is_placed]))
+        self.remove_partial(unarchived, resumed)
+        for this_job, files in unplaced:
+            if files and not self.allocator.place_batch(files):
+                this_job.ignore = True
+            if crd is not None:
+                crd.settle(this_job.job_number)
+
+    def remove_partial(self, job_numbers, copied=()):
+        """
+        Removes volumes of the jobs' archives that an interrupted run left half written, in the working folder or
+        straight in a disc folder, and reads those discs again so the catalog drops them.
+        :param copied: jobs whose volumes may have been left half copied onto a disc, as .tmp files
+        """
+        if not job_numbers and not copied:
+            return
+        alternatives = []
+        if job_numbers:
+            alternatives.append('({0})(_v\\d+)?\\.z\\d\\d'.format('|'.join(str(n) for n in job_numbers)))
+        if copied:
+            alternatives.append('({0})(_v\\d+)?(_split)?\\.z(ip|\\d\\d)\\.tmp'.format(
+                '|'.join(str(n) for n in copied)))
+        pattern = re.compile('^(?:{0})$'.format('|'.join(alternatives)))
+        folders = [(kWorkingPath, None)] + [(this_disc.location, this_disc) for this_disc in self.disc_catalog
+                                            if not this_disc.is_full]
+        for this_folder, disc in folders:
+            try:
+                names = [this_name for this_name in os.listdir(this_folder) if pattern.match(this_name)]
+            except OSError:
+                continue
+            for this_name in names:
+                try:
+                    os.remove(this_folder + kSep + this_name)
+                except OSError:
+                    continue
+                lg.add('Job: {0}, removed half written volume @: {1}\n'.format(
+                    re.match('\\d+', this_name).group(0), this_folder + kSep + this_name))
+            if names:
+                scn.invalidate(this_folder)
+                if disc is not None:
+                    index = self.allocator.positions[disc.disc_number]
+                    old_free = disc.free()
+                    disc.rescan()
+                    self.allocator.update(index, old_free)
+
+    def place(self, archives, strategy=kPlacement):
+        """
+        Puts the files of one or more archives onto discs, opening new discs only when none has room. Volumes
+        written into a reserved disc stay there if they fit.
+        :return: True if every file was placed
+        """
+        files = []
+        for this_archive in archives:
+            self.allocator.release(this_archive.job)
+            files.extend(this_archive.files)
+        placed = self.allocator.place_batch(files, strategy)
+        for this_archive in archives:
+            if all(this_file.is_placed for this_file in this_archive.files):
+                this_archive.record_contents()
+            if crd is not None:
+                crd.settle(this_archive.job.job_number)
+        return placed
+
+    def add_disc(self):
+        if crd is not None:  # another worker may have opened the next one already
+            new_disc = Disc(crd.next_disc(self.get_last_disc()))
+        else:
+            new_disc = Disc(self.get_last_disc() + 1)
+        self.disc_catalog.append(new_disc)
+        return new_disc
+
+    def get_last_disc(self):
+        return max(this_disc.disc_number for this_disc in self.disc_catalog)
+
+    def refresh(self):
+        """
+        Re-reads the ledger, keeping the jobs already known, adding newly listed ones and dropping ones now filed.
+        :return: the new jobs
+        """
+        known = dict((this_job.job_number, this_job) for this_job in self.job_list)
+        self.job_list = []
+        if not self.get_job_list(self.excel_url, known):
+            self.job_list = list(known.values())
+            return []
+        return [this_job for this_job in self.job_list if this_job.job_number not in known]
+
+    def update_workbook(self, jobs=None):
+        """
+        :param jobs: the jobs to file in the ledger, all of them by default
+        """
+        started = time.time()
+        filed = []
+        for this_job in (self.job_list if jobs is None else jobs):
+            disc_entry = ''
+            if this_job.on_disc:  # was already on disc
+                for this_disc in this_job.on_disc:
+                    disc_entry += '{0},'.format(str(this_disc))
+            elif this_job.archive and all(this_file.is_placed for this_file in this_job.archive.files):  # was archived
+                new_discs = [this_file.in_disc.disc_number for this_file in this_job.archive.files]
+                for this_disc in this_job.prior_discs:  # a re-opened job is still on its earlier discs too
+                    if this_disc not in new_discs:
+                        disc_entry += '{0},'.format(str(this_disc))
+                for this_disc in new_discs:
+                    disc_entry += '{0},'.format(str(this_disc))
+            if disc_entry:
+                self.ledger.set(this_job.job_number, disc_entry[0:-1])
+                filed.append(this_job)
+        changed = len(self.ledger.changes)
+        if crd is not None:  # only the changed cells are written, but not by two workers at once
+            with crd.mutex('ledger'):
+                self.ledger.save()
+        else:
+            self.ledger.save()
+        mtr.add('ledger', None, time.time() - started, 0, changed)
+        for this_job in filed:
+            jnl.record(this_job.job_number, 'ledger')
+            if crd is not None:
+                crd.unlease(this_job.job_number)
+        return filed
+
+
+class Journal:
+    """
+    An append only file of the stages each job has finished: cleaned, archived, placed (once per volume), dumped,
+    tagged and ledger. Every record is flushed to disk before the agent moves on, so after a crash the next run can
+    replay it and pick each job up where it stopped. Jobs that made it into the ledger are dropped when the process
+    that owns the journal compacts it at startup; every other mode only reads it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.state = {}  # job number -> {stage: data}
+        self.lock = threading.Lock()
+        self.replay()
+        self.file = open(self.path, 'a')
+
+    def read(self):
+        """
+        :return: (records of jobs still in flight, how many records there were in all)
+        """
+        records = []
+        try:
+            with open(self.path) as journal_file:
+                for this_line in journal_file:
+                    try:
+                        records.append(json.loads(this_line))
+                    except ValueError:  # torn last line from a crash
+                        pass
+        except IOError:
+            return [], 0
+        done = set(r['job'] for r in records if r['stage'] == 'ledger')
+        return [r for r in records if r['job'] not in done], len(records)
+
+    def replay(self):
+        for this_record in self.read()[0]:
+            self.apply(this_record)
+
+    def compact(self):
+        """
+        Drops the records of jobs that made it into the ledger. Only for the process that owns the journal, at startup:
+        the journal is locked while it's rewritten and anyone appending to the old file reopens it before writing.
+        """
+        with self.lock:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+            try:
+                kept, count = self.read()
+                if len(kept) < count:
+                    with open(self.path + '.tmp', 'w') as journal_file:
+                        for this_record in kept:
+                            journal_file.write(json.dumps(this_record) + '\n')
+                        journal_file.flush()
+                        os.fsync(journal_file.fileno())
+                    os.rename(self.path + '.tmp', self.path)
+                    lg.add('Journal: compacted {0} records to {1}\n'.format(count, len(kept)))
+            finally:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            self.file.close()
+            self.file = open(self.path, 'a')
+
+    def append(self, lines):
+        """
+        Writes and syncs lines under the journal's file lock, following it to a new file if it was compacted since it
+        was opened. Call with self.lock held.
+        """
+        while True:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+            try:
+                current = os.stat(self.path).st_ino == os.fstat(self.file.fileno()).st_ino
+            except OSError:
+                current = False
+            if current:
+                break
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            self.file.close()
+            self.file = open(self.path, 'a')
+        try:
+            for this_line in lines:
+                self.file.write(this_line)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        finally:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+
+    def apply(self, record):
+        stages = self.state.setdefault(record['job'], {})
+        if record['stage'] == 'placed':
+            stages.setdefault('placed', {})[record['data']['name']] = record['data']['disc']
+        else:
+            stages[record['stage']] = record['data']
+
+    def record(self, job_number, stage, data=None):
+        this_record = {'job': job_number, 'stage': stage, 'data': data, 'time': time.time()}
+        with self.lock:
+            self.append([json.dumps(this_record) + '\n'])
+            self.apply(this_record)
+
+    def stages(self, job_number):
+        with self.lock:
+            return dict(self.state.get(job_number, {}))
+
+    def adopt(self, job_number, path):
+        """
+        Copies a job's records from another worker's journal into this one, so the job carries on from where that
+        worker stopped.
+        """
+        records = []
+        try:
+            with open(path) as journal_file:
+                for this_line in journal_file:
+                    try:
+                        this_record = json.loads(this_line)
+                    except ValueError:
+                        continue
+                    if this_record['job'] == job_number:
+                        records.append(this_record)
+        except IOError:
+            pass
+        with self.lock:
+            self.state.pop(job_number, None)
+            self.append([json.dumps(this_record) + '\n' for this_record in records])
+            for this_record in records:
+                self.apply(this_record)
+        return len(records)
+
+    def close(self):
+        self.file.close()
+
+
+class Ledger:
+    """
+    The Excel job ledger. The sheet is streamed once in openpyxl's read only mode to index every job number to its
+    rows, and only the disc column cells that change are written back when it's saved.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.rows = {}  # job number -> rows it appears on
+        self.unfiled = []  # job numbers with nothing in the disc column, in ledger order
+        self.duplicates = []  # (job number, row) of repeated unfiled entries
+        self.changes = {}  # row -> new disc column value
+        self.read()
+
+    def read(self):
+        wb = openpyxl.load_workbook(self.url, read_only=True)
+        try:
+            ws = wb.active
+            ws.reset_dimensions()  # don't trust the stored dimensions, read to the last row
+            seen = set()
+            for r, row in enumerate(ws.iter_rows(min_row=1, max_col=kDiscColumn), 1):
+                try:
+                    job_number = int(row[kJobColumn - 1].value)  # first entry is a job number
+                except:
+                    continue
+                self.rows.setdefault(job_number, []).append(r)
+                if len(row) < kDiscColumn or not row[kDiscColumn - 1].value:  # no disc attached to job yet
+                    if job_number not in seen:
+                        seen.add(job_number)
+                        self.unfiled.append(job_number)
+                    else:
+                        self.duplicates.append((job_number, r))
+        finally:
+            wb.close()
+
+    def set(self, job_number, value):
+        for r in self.rows.get(job_number, []):
+            self.changes[r] = value
+
+    def save(self):
+        """
+        openpyxl can't save a read only workbook, so the file is opened normally here, but only if there is
+        something to write, and only the changed cells are touched.
+        """
+        if not self.changes:
+            return False
+        wb = openpyxl.load_workbook(self.url)
+        ws = wb.active
+        for r, value in self.changes.items():
+            ws.cell(row=r, column=kDiscColumn).value = value
+        wb.save(self.url)
+        self.changes = {}
+        return True
+
+
+class DiscAllocator:
+    """
+    Chooses discs for archive files from an index of each disc's free space, instead of trying every disc in turn.
+
+    First fit takes the lowest numbered disc with room, found by walking a max tree of free space ordered by disc
+    number. Best fit takes the disc left with the least room, found by bisecting a list sorted by free space. First
+    fit decreasing places a whole batch largest file first. Either lookup is O(log discs).
+    """
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.discs = []  # in disc number order, leaves of the tree
+        self.tree = [0, 0]  # tree[1] is the root, leaves start at self.capacity
+        self.capacity = 1
+        self.by_free = []  # sorted (free, disc_number, index)
+        self.positions = {}  # disc_number -> index
+        self.folders = {}  # disc folder -> index
+        for this_disc in sorted(manager.disc_catalog, key=lambda d: d.disc_number):
+            self.add(this_disc)
+
+    def add(self, disc):
+        index = len(self.discs)
+        self.discs.append(disc)
+        self.positions[disc.disc_number] = index
+        self.folders[disc.location] = index
+        if index >= self.capacity:
+            self.capacity *= 2
+            self.tree = [0] * (2 * self.capacity)
+            for this_index, this_disc in enumerate(self.discs):
+                self.tree[self.capacity + this_index] = this_disc.free()
+            for node in range(self.capacity - 1, 0, -1):
+                self.tree[node] = max(self.tree[2 * node], self.tree[2 * node + 1])
+        else:
+            self.set_leaf(index, disc.free())
+        bisect.insort(self.by_free, (disc.free(), disc.disc_number, index))
+
+    def set_leaf(self, index, free):
+        node = self.capacity + index
+        self.tree[node] = free
+        node //= 2
+        while node:
+            self.tree[node] = max(self.tree[2 * node], self.tree[2 * node + 1])
+            node //= 2
+
+    def update(self, index, old_free):
+        disc = self.discs[index]
+        del self.by_free[bisect.bisect_left(self.by_free, (old_free, disc.disc_number, index))]
+        bisect.insort(self.by_free, (disc.free(), disc.disc_number, index))
+        self.set_leaf(index, disc.free())
+
+    def first_fit(self, size):
+        if self.tree[1] < size:
+            return None
+        node = 1
+        while node < self.capacity:
+            node = 2 * node if self.tree[2 * node] >= size else 2 * node + 1
+        return node - self.capacity
+
+    def best_fit(self, size):
+        position = bisect.bisect_left(self.by_free, (size,))
+        if position == len(self.by_free):
+            return None
+        return self.by_free[position][2]
+
+    def choose(self, size, strategy=kPlacement):
+        """
+        :return: the index of a disc with room for size bytes, opening a new disc if none has
+        """
+        index = self.best_fit(size) if strategy == 'best_fit' else self.first_fit(size)
+        if index is None:
+            self.add(self.manager.add_disc())
+            index = len(self.discs) - 1
+        return index
+
+    def hold(self, job, index, size, volume_size):
+        """
+        :return: False if, in worker mode, another worker got to the room first
+        """
+        disc = self.discs[index]
+        old_free = disc.free()
+        if crd is not None and not crd.claim(disc, job.job_number, size):
+            self.update(index, old_free)  # the claim brought the disc up to date
+            return False
+        disc.reserved += size
+        self.update(index, old_free)
+        job.reservation.append((disc, size, volume_size))
+        return True
+
+    def reserve(self, job, strategy=kPlacement):
+        """
+        Holds room for the bound of the job's estimate. An archive that fits on a disc gets room on one. A bigger
+        one, with kSplitMode 'fill', gets the room left on each open disc in turn, then new discs, and its volumes
+        are sized to match.
+        :return: [(disc folder, volume size)] to write the volumes to, or None to write them to the working folder
+        """
+        size = job.estimate[1]
+        job.reservation = []
+        if size <= kVolumeSize:
+            while not self.hold(job, self.choose(size, strategy), size, kVolumeSize):
+                pass
+        elif kSplitMode == 'fill':
+            remaining = size
+            while remaining > 0:
+                index = self.first_fit(kMinVolume + kManifestAllowance)
+                if index is None:
+                    self.add(self.manager.add_disc())
+                    index = len(self.discs) - 1
+                free = self.discs[index].free()
+                if self.hold(job, index, min(free, remaining), free - kManifestAllowance):
+                    remaining -= free
+        else:
+            job.reservation = None
+            return None
+        return [(disc.location, volume_size) for disc, held, volume_size in job.reservation]
+
+    def release(self, job):
+        """
+        Gives back whatever the job had reserved.
+        """
+        for disc, size, volume_size in job.reservation or []:
+            index = self.positions[disc.disc_number]
+            old_free = disc.free()
+            disc.reserved -= size
+            self.update(index, old_free)
+        job.reservation = None
+
+    def place(self, this_file, strategy=kPlacement):
+        """
+        A file already written into a disc folder stays there if it fits.
+        :return: True if the file was moved onto a disc
+        """
+        footprint = this_file.footprint()
+        index = self.folders.get(this_file.location.rsplit(kSep, 1)[0])
+        if index is not None and footprint > self.discs[index].free():
+            lg.add('File: {0}, outgrew its estimate, relocating from Disc: {1}\n'.format(
+                this_file.name, self.discs[index].disc_number))
+            index = None
+        while True:
+            if index is None:
+                index = self.choose(footprint, strategy)
+            disc = self.discs[index]
+            old_free = disc.free()
+            if crd is None or crd.claim(disc, this_file.job_number, footprint):
+                break
+            self.update(index, old_free)  # another worker got there first
+            index = None
+        try:
+            placed = this_file.add2disc(disc)
+        except:
+            placed = False
+        self.update(index, old_free)
+        if not placed:
+            lg.add('File: {0}, could not be placed on Disc: {1}\n'.format(this_file.name, disc.disc_number))
+        return placed
+
+    def place_batch(self, files, strategy=kPlacement):
+        if strategy == 'first_fit_decreasing':
+            files = sorted(files, key=lambda f: f.size, reverse=True)
+        placed = True
+        for this_file in files:
+            placed = self.place(this_file, strategy) and placed
+        return placed
+
+
+class Pipeline:
+    """
+    Cleans up and compresses several jobs at once on a pool of worker threads. Finished archives come back to the
+    thread that called run(), which does all of the disc placement, so disc sizes are only ever changed in one place.
+
+    With kDirectWrite, every job is cleaned up and its archive size estimated first, then disc space is reserved for
+    each estimate, largest first for first fit decreasing, so the archives can be written straight into their discs
+    instead of being moved there afterwards. Archives that will be split over several discs are written one at a
+    time once the rest have been placed, with their volumes sized to the room left on the open discs.
+    """
+
+    def __init__(self, manager, workers=kWorkers):
+        self.manager = manager
+        self.workers = workers
+
+    def clean(self, job):
+        try:
+            if not job.clean:
+                job.cleanup()
+            if kDirectWrite:
+                scn.invalidate(job.location)  # estimate what's there now, not when it was inspected
+                with mtr.timed('estimate', job.job_number) as counts:
+                    job.estimate = est.estimate(job)
+                    counts['bytes'] = job.estimate[0]
+        except:
+            job.ignore = True
+            lg.add('Job: {0}, unable to clean up. Ignoring.\n'.format(job.job_number))
+        return job
+
+    def prepare(self, job):
+        try:
+            if not job.clean:
+                job.cleanup()
+            targets = None
+            if job.reservation is not None:
+                targets = [(disc.location, volume_size) for disc, held, volume_size in job.reservation]
+            Archive(job, None, targets)
+        except:
+            job.ignore = True  # keeps a half archived job from being dumped
+            lg.add('Job: {0}, unable to archive. Ignoring.\n'.format(job.job_number))
+        return job
+
+    def reserve(self, jobs):
+        if kPlacement == 'first_fit_decreasing':
+            jobs = sorted(jobs, key=lambda j: j.estimate[1], reverse=True)
+        strategy = 'best_fit' if kPlacement == 'best_fit' else 'first_fit'
+        for this_job in jobs:
+            targets = self.manager.allocator.reserve(this_job, strategy)
+            if targets is None:
+                lg.add('Job: {0}, will need more than one disc, writing it to the working folder.\n'.format(
+                    this_job.job_number))
+            elif len(targets) > 1:
+                lg.add('Job: {0}, will be split over Discs: {1}.\n'.format(this_job.job_number, ', '.join(
+                    this_path.rsplit(kSep, 1)[-1] for this_path, volume_size in targets)))
+
+    def settle(self, job):
+        if job.estimate is not None:
+            lg.add('Job: {0}, estimated {1} bytes (at most {2}), wrote {3}.\n'.format(
+                job.job_number, job.estimate[0], job.estimate[1], sum(f.size for f in job.archive.files)))
+        if not self.manager.place([job.archive]):
+            job.ignore = True  # leave it on the server
+
+    def run(self, jobs):
+        batch = []  # first fit decreasing needs every archive before it places any
+        pool = ThreadPool(self.workers)
+        try:
+            groups = [jobs]
+            if kDirectWrite:
+                jobs = [this_job for this_job in pool.map(self.clean, jobs) if not this_job.ignore]
+                # archives split over several discs go last, one at a time, to fill the room the others really leave
+                split = [this_job for this_job in jobs if kSplitMode == 'fill' and this_job.estimate[1] > kVolumeSize]
+                groups = [[this_job for this_job in jobs if this_job not in split]] + [[j] for j in split]
+            for group in groups:
+                if kDirectWrite:
+                    self.reserve(group)
+                for this_job in pool.imap_unordered(self.prepare, group):
+                    if this_job.ignore:
+                        self.manager.allocator.release(this_job)
+                        if crd is not None:
+                            crd.settle(this_job.job_number)
+                    elif this_job.reservation is None and kPlacement == 'first_fit_decreasing':
+                        batch.append(this_job)
+                    else:
+                        self.settle(this_job)
+                    lg.flush()
+        finally:
+            pool.close()
+            pool.join()
+        if batch and not self.manager.place([this_job.archive for this_job in batch]):
+            for this_job in batch:
+                if not all(this_file.is_placed for this_file in this_job.archive.files):
+                    this_job.ignore = True
+
+
+class Planner:
+    """
+    Works out what a run would do without doing any of it, from metadata alone, so it takes seconds even for
+    hundreds of jobs. The ledger is read as Manager reads it, each job's folder is taken from the scan index,
+    cleanup is planned but not carried out, and archive sizes come from the ratio history without sampling any
+    files. Disc space is then laid out with a DiscAllocator the way Pipeline would reserve and place it, over copies
+    of the discs the catalog knows, and each stage's running time comes from how fast it has gone in recent event
+    logs.
+    """
+
+    def __init__(self, url=kURL):
+        self.excel_url = url
+        self.disc_catalog = []
+        self.jobs = []  # (job, source bytes, bytes cleanup removes, (expected, bound))
+        self.opened = []  # discs the plan needs that don't exist yet
+
+    def setup_disc_catalog(self, url=kBaseDisksPath):
+        """
+        Takes each disc's used space from the catalog, or from its folder's metadata, without creating anything.
+        """
+        known = cat.discs()
+        pattern = re.compile('^' + kDiscFolderPrefix + r'(\d+)$')
+        for this_dir in sorted(os.listdir(url)):
+            is_disc_folder = pattern.match(this_dir)
+            if not is_disc_folder:
+                continue
+            number = int(is_disc_folder.group(1))
+            used, mtime, full = known.get(number, (None, None, False))
+            if used is None:
+                used = get_size(url + kSep + this_dir)
+                full = kFullSize - used < kSealFree
+            self.disc_catalog.append(Disc(number, used, None, full))
+
+    def add_disc(self):
+        new_disc = Disc(self.get_last_disc() + 1, 0, [], False)
+        self.disc_catalog.append(new_disc)
+        self.opened.append(new_disc)
+        return new_disc
+
+    def get_last_disc(self):
+        return max([this_disc.disc_number for this_disc in self.disc_catalog] or [0])
+
+    def project(self, job):
+        """
+        :return: (source bytes, bytes cleanup would remove, (expected, bound) archive size)
+        """
+        trash = job.location + kTrashFolderPrefix
+        skip = set(CarrierCleaner(job.job_number, job.location + '/Deliverables/Image_Carriers').plan())
+        removed = sum(scn.entry(this_path)[0] for this_path in skip) + scn.size(trash)
+        skip.add(trash)
+        source = scn.size(job.location)
+        return source, removed, est.estimate(job, False, skip)
+
+    def simulate(self, allocator):
+        """
+        Reserves and places each archive as Pipeline would, archives split over several discs last, one at a time.
+        :return: job number -> disc numbers its volumes would go to
+        """
+        layout = {}
+        jobs = [this_job for this_job, source, removed, estimate in self.jobs]
+        split = [this_job for this_job in jobs if kSplitMode == 'fill' and this_job.estimate[1] > kVolumeSize]
+        groups = [[this_job for this_job in jobs if this_job not in split]] + [[this_job] for this_job in split]
+        strategy = 'best_fit' if kPlacement == 'best_fit' else 'first_fit'
+        for group in groups:
+            if kPlacement == 'first_fit_decreasing':
+                group = sorted(group, key=lambda j: j.estimate[1], reverse=True)
+            for this_job in group:
+                allocator.reserve(this_job, strategy)
+            for this_job in group:
+                targets = [(disc, volume_size) for disc, held, volume_size in this_job.reservation or []]
+                allocator.release(this_job)
+                remaining = this_job.estimate[0]
+                layout[this_job.job_number] = []
+                while remaining > 0:
+                    if targets:
+                        disc, volume_size = targets.pop(0)
+                        index = allocator.positions[disc.disc_number]
+                    else:
+                        volume_size = kVolumeSize
+                        index = allocator.choose(min(remaining, volume_size) + kManifestAllowance, strategy)
+                        disc = allocator.discs[index]
+                    volume = min(remaining, volume_size)
+                    old_free = disc.free()
+                    disc.size += volume + kManifestAllowance
+                    if kFullSize - disc.size < kSealFree and not disc.reserved:
+                        disc.is_full = True
+                    allocator.update(index, old_free)
+                    layout[this_job.job_number].append(disc.disc_number)
+                    remaining -= volume
+        return layout
+
+    @staticmethod
+    def throughput(path=kWorkingPath, logs=kPlanHistory):
+        """
+        :return: stage -> [runs, seconds, bytes] from the newest event logs
+        """
+        names = [this_name for this_name in os.listdir(path)
+                 if this_name.startswith('Events_') and this_name.endswith('.jsonl')]
+        names.sort(key=lambda this_name: os.path.getmtime(path + kSep + this_name), reverse=True)
+        stages = {}
+        for this_name in names[:logs]:
+            with open(path + kSep + this_name) as events:
+                for this_line in events:
+                    try:
+                        event = json.loads(this_line)
+                    except ValueError:
+                        continue
+                    if not event.get('ok', True):
+                        continue
+                    totals = stages.setdefault(event['stage'], [0, 0.0, 0])
+                    totals[0] += 1
+                    totals[1] += event['seconds']
+                    totals[2] += event['bytes']
+        return stages
+
+    def run(self):
+        started = time.time()
+        ledger = Ledger(self.excel_url)
+        for this_job_number in ledger.unfiled:
+            this_job = Job(this_job_number)
+            if this_job.ignore or this_job.is_archived:
+                continue
+            source, removed, this_job.estimate = self.project(this_job)
+            self.jobs.append((this_job, source, removed, this_job.estimate))
+        self.setup_disc_catalog()
+        if not self.disc_catalog:
+            self.add_disc()
+        layout = self.simulate(DiscAllocator(self))
+        self.report(layout, ledger, time.time() - started)
+        return True
+
+    def report(self, layout, ledger, seconds):
+        source = sum(this_source for this_job, this_source, removed, estimate in self.jobs)
+        removed = sum(this_removed for this_job, this_source, this_removed, estimate in self.jobs)
+        expected = sum(estimate[0] for this_job, this_source, this_removed, estimate in self.jobs)
+        bound = sum(estimate[1] for this_job, this_source, this_removed, estimate in self.jobs)
+        lg.add('Plan: {0} of {1} unfiled jobs to archive, {2} bytes, {3} of them removed by cleanup.\n'.format(
+            len(self.jobs), len(ledger.unfiled), source, removed))
+        lg.add('Plan: archives of {0} bytes expected, at most {1}.\n'.format(expected, bound))
+        for this_job, this_source, this_removed, estimate in self.jobs:
+            lg.add('Plan: Job: {0}, {1} bytes to {2} (at most {3}) on Discs: {4}.\n'.format(
+                this_job.job_number, this_source - this_removed, estimate[0], estimate[1],
+                ', '.join(str(n) for n in sorted(set(layout[this_job.job_number])))))
+        touched = sorted(set(n for numbers in layout.values() for n in numbers))
+        sealed = [this_disc.disc_number for this_disc in self.disc_catalog
+                  if this_disc.disc_number in touched and this_disc.is_full]
+        opened = [this_disc.disc_number for this_disc in self.opened if this_disc.disc_number in touched]
+        lg.add('Plan: {0} discs written to, {1} of them new, {2} sealed: {3}.\n'.format(
+            len(touched), len(opened), len(sealed), ', '.join(str(n) for n in touched)))
+
+        # each stage's time at the speed it has gone lately, per byte where it counts bytes, otherwise per run
+        history = self.throughput()
+        work = {'cleanup': (len(self.jobs), 0), 'estimate': (len(self.jobs), 0),
+                'archive': (len(self.jobs), source - removed), 'move': (0, 0), 'image': (len(sealed), 0),
+                'ledger': (1, 0), 'dump': (len(self.jobs), source - removed), 'tag': (len(self.jobs), 0)}
+        if not kDirectWrite:  # archives are written to the working folder and moved onto their discs
+            work['move'] = (len(self.jobs), expected)
+        if kImageOnSeal:
+            work['image'] = (len(sealed), len(sealed) * kFullSize)
+        projected = {}
+        for stage in ('cleanup', 'estimate', 'archive', 'move', 'image', 'ledger', 'dump', 'tag'):
+            runs, byte_count = work[stage]
+            seen = history.get(stage)
+            if not runs:
+                continue
+            if not seen:
+                lg.add('Plan: {0}, no history to go on.\n'.format(stage))
+                continue
+            if byte_count and seen[2]:
+                projected[stage] = byte_count * seen[1] / seen[2]
+            else:
+                projected[stage] = runs * seen[1] / seen[0]
+            if stage in ('cleanup', 'estimate', 'archive'):  # run kWorkers jobs at a time
+                projected[stage] /= min(kWorkers, runs)
+            lg.add('Plan: {0}, about {1:.0f} seconds.\n'.format(stage, projected[stage]))
+        total = sum(projected.values())
+        lg.add('Plan: about {0:.0f} seconds in all, {1:.0f} of them dumping and tagging. Planned in {2:.1f} '
+               'seconds.\n'.format(total, projected.get('dump', 0) + projected.get('tag', 0), seconds))
+
+
+class Policy:
+    """
+    Stands in for the dump and tag prompts when running as a daemon. The policy file is JSON:
+
+        {"dump_and_tag": "none" | "all" | "listed", "jobs": [job numbers approved when "listed"]}
+
+    It's re-read whenever it changes, so jobs can be approved while the daemon runs. A missing or unreadable file
+    approves nothing.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.mtime = None
+        self.mode = 'none'
+        self.jobs = set()
+        self.load()
+
+    def load(self):
+        try:
+            mtime = os.stat(self.url).st_mtime
+        except OSError:
+            self.mode, self.jobs, self.mtime = 'none', set(), None
+            return
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+        try:
+            with open(self.url) as policy_file:
+                settings = json.load(policy_file)
+            self.mode = settings.get('dump_and_tag', 'none')
+            self.jobs = set(str(job_number) for job_number in settings.get('jobs', []))
+            lg.add('Policy: dump and tag {0}.\n'.format(self.mode))
+        except (IOError, ValueError, AttributeError):
+            lg.add('Policy file: {0}, unreadable, keeping the previous policy.\n'.format(self.url))
+
+    def approves(self, job):
+        return self.mode == 'all' or (self.mode == 'listed' and str(job.job_number) in self.jobs)
+
+
+class Watcher:
+    """
+    Waits for something to change under the watched folders: with inotify (pyinotify) when it's installed and the
+    file system supports it, otherwise by sleeping. Either way the daemon decides what changed by comparing mtimes,
+    so a missed or spurious wake up costs one extra check at most. SMB and AFP mounts don't deliver inotify events
+    for changes made by other machines, so polling still bounds the delay there.
+    """
+
+    def __init__(self, paths):
+        self.notifier = None
+        if pyinotify is None:
+            return
+        try:
+            manager = pyinotify.WatchManager()
+            mask = pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM | \
+                pyinotify.IN_CLOSE_WRITE | pyinotify.IN_ATTRIB
+            for this_path in paths:
+                if os.path.isdir(this_path):
+                    manager.add_watch(this_path, mask)
+            self.notifier = pyinotify.Notifier(manager, timeout=0)
+        except:
+            self.notifier = None
+
+    def wait(self, timeout):
+        if self.notifier is None:
+            time.sleep(timeout)
+            return
+        if self.notifier.check_events(int(timeout * 1000)):
+            self.notifier.read_events()
+            self.notifier.process_events()
+
+
+class Daemon:
+    """
+    Long running mode. The ledger is only re-read when its file changes, and a job is only inspected again when
+    something in its folder does. A job is archived once its folder has gone kSettleTime without changes. Dumps
+    and tags come from the Policy file, and a job is filed in the ledger once it has been dumped and tagged, or
+    straight away if the policy is to leave jobs on the server.
+    """
+
+    def __init__(self):
+        self.policy = Policy(kPolicyURL)
+        self.mngr = Manager(kURL)
+        self.ledger_mtime = self.stat(kURL)
+        self.seen = {}  # job number -> newest directory mtime when last inspected
+        roots = [kBaseJobsPath + kJobFolderPrefix + str(digit) for digit in range(10)]
+        self.watcher = Watcher(roots + [os.path.dirname(kURL), os.path.dirname(kPolicyURL)])
+
+    @staticmethod
+    def stat(path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def newest(self, job, fresh=False):
+        """
+        :param fresh: lstat every file rather than trust the index, which misses files rewritten in place
+        :return: the newest mtime of anything in the job's folder
+        """
+        newest = None
+        for this_dir, entry in scn.entries(job.location):
+            mtimes = [entry['mtime']]
+            for this_file, (size, mtime) in entry['files'].items():
+                if fresh:
+                    try:
+                        with gov.op('stat'):
+                            mtime = os.lstat(this_dir + kSep + this_file).st_mtime
+                    except OSError:
+                        continue
+                mtimes.append(mtime)
+            for mtime in mtimes:
+                if mtime is not None and (newest is None or mtime > newest):
+                    newest = mtime
+        return newest
+
+    def changed_jobs(self):
+        """
+        :return: jobs that are new or have changed and have since settled, freshly inspected
+        """
+        scn.refresh()
+        ready = []
+        for index, this_job in enumerate(self.mngr.job_list):
+            if this_job.is_archived:
+                continue  # on disc already, or waiting to be dumped
+            newest = self.newest(this_job)
+            if newest is None or self.seen.get(this_job.job_number) == newest:
+                continue
+            if time.time() - newest < kSettleTime:
+                continue  # someone's still working on it
+            fresh = self.newest(this_job, True)
+            if fresh is None or time.time() - fresh < kSettleTime:
+                continue  # or editing files in place, which the index can't see, or it's just gone
+            if this_job.job_number in self.seen:
+                this_job = self.mngr.job_list[index] = Job(this_job.job_number)
+            self.seen[this_job.job_number] = newest
+            if not this_job.ignore and not this_job.is_archived:
+                ready.append(this_job)
+        return ready
+
+    def cycle(self):
+        self.policy.load()
+        if not self.mngr.disc_catalog:  # waiting for a disc folder to start from
+            if not self.mngr.setup_disc_catalog():
+                return
+            self.mngr.allocator = DiscAllocator(self.mngr)
+        ledger_mtime = self.stat(kURL)
+        if ledger_mtime != self.ledger_mtime:
+            self.ledger_mtime = ledger_mtime
+            new_jobs = self.mngr.refresh()
+            lg.add('Ledger changed, {0} new jobs.\n'.format(len(new_jobs)))
+
+        ready = self.changed_jobs()
+        if ready:
+            Pipeline(self.mngr).run(ready)
+
+        dump_and_tag(self.mngr.job_list, self.policy.approves)
+        done = [this_job for this_job in self.mngr.job_list if this_job.on_disc or
+                (this_job.archive is not None and (this_job.tagged or self.policy.mode == 'none'))]
+        if done and self.mngr.update_workbook(done):
+            self.ledger_mtime = self.stat(kURL)
+            self.mngr.refresh()
+        scn.save()
+        est.save()
+        mtr.summary()
+        lg.flush()
+
+    def run(self):
+        lg.add('Daemon started, checking every {0} seconds.\n'.format(kPollInterval))
+        while True:
+            try:
+                self.cycle()
+            except Exception as error:
+                lg.add('Daemon cycle failed: {0}\n'.format(error))
+            self.watcher.wait(kPollInterval)
+
+
+class Worker(Daemon):
+    """
+    Daemon mode for one of several agents sharing the ledger and the staging folder. A worker only archives the
+    jobs it holds a lease on, at most kLeaseBatch new ones a cycle, and claims disc room through the Coordinator
+    before it writes or moves anything onto a disc. Jobs taken over from a worker that stopped carry on from its
+    journal, and anything that worker left half written on a disc is removed as they resume.
+    """
+
+    def changed_jobs(self):
+        crd.refresh(self.mngr.allocator)
+        ready = Daemon.changed_jobs(self)
+        granted = set(crd.lease([this_job.job_number for this_job in ready], kLeaseBatch))
+        leased = []
+        for this_job in ready:
+            if this_job.job_number not in granted:
+                del self.seen[this_job.job_number]  # someone else has it, look again next cycle
+                continue
+            if jnl.stages(this_job.job_number):  # taken over, half written volumes are removed as it resumes
+                self.mngr.resume([this_job])
+            if not this_job.ignore and this_job.archive is None:
+                leased.append(this_job)
+        return leased
+
+
+class IOGovernor:
+    """
+    Paces the agent's reads, listings, moves and deletes on the share so people working on it aren't starved.
+    Every operation takes from two token buckets, bytes and operations a second, and holds one of a limited number
+    of slots while it runs. The ceilings come from the first of kIOProfiles matching the local time. The number of
+    slots adapts like TCP's window: one more each kIOAdjustInterval while every kind of operation is as quick as its
+    baseline, half as many as soon as one kind slows past kIOLatencyRise times its baseline.
+    """
+
+    def __init__(self, profiles):
+        self.profiles = profiles
+        self.lock = threading.Condition(threading.Lock())
+        self.profile = None
+        self.ceiling = 0
+        self.limit = 1.0
+        self.active = 0
+        self.rates = {'bytes': 0, 'ops': 0}
+        self.tokens = {'bytes': 0.0, 'ops': 0.0}
+        self.filled = time.time()
+        self.latency = {}  # kind -> [average seconds, baseline seconds, when the baseline was set]
+        self.adjusted = 0.0
+
+    def match(self, now):
+        t = time.localtime(now)
+        for this_profile in self.profiles:
+            start, end = this_profile.get('hours', (0, 24))
+            in_hours = start <= t.tm_hour < end if start <= end else (t.tm_hour >= start or t.tm_hour < end)
+            if in_hours and t.tm_wday in this_profile.get('days', range(7)):
+                return this_profile
+        return kIOUnmatched  # the same one every time, so choose keeps the state it has
+
+    def choose(self, now):
+        profile = self.match(now)
+        if profile is self.profile:
+            return
+        self.profile = profile
+        self.rates = {'bytes': profile.get('bytes', 0), 'ops': profile.get('ops', 0)}
+        self.tokens = dict(self.rates)
+        self.ceiling = max(1, profile.get('concurrency', kDeleteWorkers))
+        self.limit = float(self.ceiling)
+        self.latency = {}
+        self.lock.notify_all()
+        if any(self.rates.values()):
+            lg.add('I/O profile: {0} bytes/s, {1} ops/s, {2} at once.\n'.format(
+                self.rates['bytes'] or 'unlimited', self.rates['ops'] or 'unlimited', self.ceiling))
+
+    def wait_for(self, nbytes):
+        """
+        Takes tokens for an operation, sleeping until the buckets aren't in debt. An operation bigger than a bucket
+        takes it into debt, which the ones after it wait out.
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                for this_bucket, rate in self.rates.items():
+                    if rate:
+                        self.tokens[this_bucket] = min(rate, self.tokens[this_bucket] + (now - self.filled) * rate)
+                self.filled = now
+                short = [-self.tokens[b] / rate for b, rate in self.rates.items() if rate and self.tokens[b] < 0]
+                if not short:
+                    self.tokens['bytes'] -= nbytes
+                    self.tokens['ops'] -= 1
+                    return
+            time.sleep(max(short))
+
+    def record(self, kind, seconds, nbytes, now):
+        """
+        Folds an operation's latency, per kBufferSize for reads and moves, into its kind's average and adjusts the
+        number of slots.
+        """
+        sample = seconds / max(1.0, float(nbytes) / kBufferSize)
+        this_kind = self.latency.get(kind)
+        if this_kind is None:
+            self.latency[kind] = [sample, sample, now]
+            return
+        this_kind[0] += 0.2 * (sample - this_kind[0])
+        if this_kind[0] < this_kind[1] or now - this_kind[2] > kIOBaselineWindow:
+            this_kind[1], this_kind[2] = this_kind[0], now
+        if now - self.adjusted < kIOAdjustInterval:
+            return
+        self.adjusted = now
+        slow = [k for k, (average, baseline, since) in self.latency.items() if average > baseline * kIOLatencyRise]
+        if slow:
+            if self.limit > 1:
+                self.limit = max(1.0, self.limit / 2)
+                lg.add('I/O: {0} slowing down, {1} operations at once.\n'.format(', '.join(sorted(slow)),
+                                                                                 int(self.limit)))
+        elif self.limit < self.ceiling:
+            self.limit += 1
+            self.lock.notify_all()
+
+    @contextlib.contextmanager
+    def op(self, kind, nbytes=0):
+        """
+        Wraps one operation on the share.
+        :param kind: 'list', 'stat', 'read', 'move' or 'delete', each kind keeps its own latency baseline
+        :param nbytes: bytes it reads or moves
+        """
+        with self.lock:
+            self.choose(time.time())
+        self.wait_for(nbytes)
+        with self.lock:
+            while self.active >= int(self.limit):
+                self.lock.wait()
+            self.active += 1
+        started = time.time()
+        try:
+            yield
+        finally:
+            now = time.time()
+            with self.lock:
+                self.active -= 1
+                self.record(kind, now - started, nbytes, now)
+                self.lock.notify()
+
+    def read(self, source, length):
+        with self.op('read', length):
+            return source.read(length)
+
+
+class Scanner:
+    """
+    Keeps an on-disk index of the directory trees the agent looks at. Each tree is read in a single scandir pass,
+    recording every directory's subdirectories and every file's size and mtime. On later runs a directory whose
+    mtime is unchanged is taken from the index and only its subdirectories are stat'd, so a dormant job costs one
+    round trip per directory instead of one per file.
+
+    A file rewritten in place does not change its directory's mtime, so its cached size can go stale. That's
+    acceptable for jobs waiting to be archived, which aren't being worked on.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.dirs = {}  # directory path -> {'mtime': float, 'dirs': [names], 'files': {name: (size, mtime)},
+        # 'links': {name: target}}, symlinks are in 'files' too, with their own size and mtime
+        self.fresh = set()  # roots already brought up to date during this run
+        self.invalidated = 0  # bumped by invalidate, a scan that overlapped one doesn't count its root as fresh
+        self.lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as index_file:
+                self.dirs = pickle.load(index_file)
+            if any('links' not in entry for entry in self.dirs.values()):  # from before symlinks were told apart
+                self.dirs = {}
+        except:
+            self.dirs = {}
+
+    def save(self):
+        try:
+            temp = '{0}.{1}.tmp'.format(self.path, os.getpid())  # other workers may be saving it too
+            with self.lock, open(temp, 'wb') as index_file:
+                pickle.dump(self.dirs, index_file, 2)
+            os.rename(temp, self.path)
+        except:
+            lg.add('Unable to save scan index @: {0}\n'.format(self.path))
+
+    def read_dir(self, path, mtime):
+        entry = {'mtime': mtime, 'dirs': [], 'files': {}, 'links': {}}
+        if scandir is not None:
+            with gov.op('list'):  # the stats come with the listing
+                for this_entry in scandir(path):
+                    if this_entry.is_dir(follow_symlinks=False):
+                        entry['dirs'].append(this_entry.name)
+                    else:
+                        this_stat = this_entry.stat(follow_symlinks=False)
+                        entry['files'][this_entry.name] = (this_stat.st_size, this_stat.st_mtime)
+                        if this_entry.is_symlink():
+                            entry['links'][this_entry.name] = None
+        else:
+            with gov.op('list'):
+                names = os.listdir(path)
+            for this_name in names:
+                with gov.op('stat'):
+                    this_stat = os.lstat(path + kSep + this_name)
+                if stat.S_ISDIR(this_stat.st_mode):
+                    entry['dirs'].append(this_name)
+                else:
+                    entry['files'][this_name] = (this_stat.st_size, this_stat.st_mtime)
+                    if stat.S_ISLNK(this_stat.st_mode):
+                        entry['links'][this_name] = None
+        for this_name in entry['links']:
+            with gov.op('stat'):
+                entry['links'][this_name] = os.readlink(path + kSep + this_name)
+        return entry
+
+    def scan(self, root):
+        """
+        Brings a tree up to date in the index. The lock is only held while the index is looked at or changed, so jobs
+        on other threads can list the share at the same time.
+        :param root: the directory to bring up to date in the index
+        :return: True if the root exists
+        """
+        with self.lock:
+            if root in self.fresh:
+                return root in self.dirs
+            invalidated = self.invalidated
+        pending = [root]
+        while pending:
+            this_dir = pending.pop()
+            try:
+                with gov.op('stat'):
+                    mtime = os.stat(this_dir).st_mtime
+                with self.lock:
+                    entry = self.dirs.get(this_dir)
+                if entry is None or entry['mtime'] != mtime:
+                    new_entry = self.read_dir(this_dir, mtime)
+                    with self.lock:
+                        if entry is not None:
+                            for this_name in entry['dirs']:  # drop subtrees that have gone away
+                                if this_name not in new_entry['dirs']:
+                                    self.forget(this_dir + kSep + this_name)
+                        self.dirs[this_dir] = new_entry
+                    entry = new_entry
+            except OSError:
+                self.forget(this_dir)
+                continue
+            for this_name in entry['dirs']:
+                pending.append(this_dir + kSep + this_name)
+        with self.lock:
+            if self.invalidated == invalidated:
+                self.fresh.add(root)
+            return root in self.dirs
+
+    def refresh(self):
+        """
+        Lets every root be brought up to date again, for long running processes.
+        """
+        with self.lock:
+            self.fresh = set()
+
+    def forget(self, path):
+        prefix = path + kSep
+        with self.lock:
+            for this_dir in [d for d in self.dirs if d == path or d.startswith(prefix)]:
+                del self.dirs[this_dir]
+
+    def invalidate(self, path):
+        """
+        Marks a directory as changed by the agent itself so the next lookup re-reads it.
+        """
+        with self.lock:
+            entry = self.dirs.get(path)
+            if entry is not None:
+                entry['mtime'] = None
+            self.fresh = set(root for root in self.fresh if not (path == root or path.startswith(root + kSep)))
+            self.invalidated += 1
+
+    def entries(self, root):
+        if not self.scan(root):
+            return
+        pending = [root]
+        while pending:
+            this_dir = pending.pop(0)
+            entry = self.dirs.get(this_dir)
+            if entry is None:  # forgotten by another thread since the scan
+                continue
+            yield this_dir, entry
+            for this_name in entry['dirs']:
+                pending.append(this_dir + kSep + this_name)
+
+    def walk(self, root):
+        """
+        Same shape as os.walk, answered from the index.
+        """
+        for this_dir, entry in self.entries(root):
+            yield this_dir, list(entry['dirs']), list(entry['files'].keys())
+
+    def entry(self, path):
+        """
+        :param path: a file inside a scanned tree
+        :return: (size, mtime) of the file
+        """
+        parent, name = path.rsplit(kSep, 1)
+        return self.dirs[parent]['files'][name]
+
+    def size(self, root):
+        total_size = 0
+        for this_dir, entry in self.entries(root):
+            for this_size, this_mtime in entry['files'].values():
+                total_size += this_size
+        return total_size
+
+
+class IsoImage:
+    """
+    Masters an ISO 9660 image with Joliet names of a sealed disc folder, laid out from what the disc catalog holds for
+    it, so the folder is read exactly once, to copy its files in. The layout is worked out before anything is written:
+    volume descriptors, path tables and the root directories (ISO names and Joliet names) first, then each file's
+    data, so the image is written front to back with one buffer of memory. Disc folders are flat, and a folder
+    holding anything but files isn't imaged.
+    """
+
+    def __init__(self, disc_number, contents):
+        """
+        :param contents: name -> size of each file on the disc
+        """
+        self.disc_number = disc_number
+        self.volume_id = kDiscFolderPrefix + str(disc_number).zfill(4)
+        self.names = sorted(contents)
+        self.sizes = contents
+        self.stamp = time.gmtime()
+        iso_names = self.unique([self.iso_name(this_name) for this_name in self.names], 30)
+        joliet_names = self.unique([this_name[:64] for this_name in self.names], 64)
+        self.iso_names = dict(zip(self.names, [(n + ';1').encode('ascii') for n in iso_names]))
+        self.joliet_names = dict(zip(self.names, [n.encode('utf-16-be') for n in joliet_names]))
+
+        # 16 system sectors, primary and joliet descriptors, terminator, then L and M path tables for each
+        self.extents = dict((this_name, 0) for this_name in self.names)  # sizing the directories doesn't need them
+        self.iso_root = 23
+        self.iso_root_size = self.directory_size(self.iso_names)
+        self.joliet_root = self.iso_root + self.iso_root_size // kSector
+        self.joliet_root_size = self.directory_size(self.joliet_names)
+        sector = self.joliet_root + self.joliet_root_size // kSector
+        for this_name in self.names:
+            self.extents[this_name] = sector
+            sector += (self.sizes[this_name] + kSector - 1) // kSector
+        self.sectors = sector
+
+    @staticmethod
+    def iso_name(name):
+        if not isinstance(name, type(u'')):
+            name = name.decode('utf-8', 'replace')
+        base, dot, ext = name.upper().rpartition('.')
+        if not dot:
+            base, ext = ext, ''
+        base = re.sub('[^A-Z0-9_]', '_', base) or '_'
+        ext = re.sub('[^A-Z0-9_]', '_', ext)[:8]
+        return base[:29 - len(ext)] + '.' + ext
+
+    @staticmethod
+    def unique(names, limit):
+        seen, result = set(), []
+        for this_name in names:
+            candidate, count = this_name, 1
+            while candidate.upper() in seen:
+                suffix = '~{0}'.format(count)
+                base, dot, ext = this_name.rpartition('.')
+                base = base if dot else this_name
+                candidate = base[:limit - len(suffix) - len(dot + ext if dot else '')] + suffix + \
+                    (dot + ext if dot else '')
+                count += 1
+            seen.add(candidate.upper())
+            result.append(candidate)
+        return result
+
+    @staticmethod
+    def both(fmt, value):
+        return struct.pack('<' + fmt, value) + struct.pack('>' + fmt, value)
+
+    def date(self):
+        t = self.stamp
+        return struct.pack('7B', t.tm_year - 1900, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec, 0)
+
+    def long_date(self):
+        return time.strftime('%Y%m%d%H%M%S00', self.stamp).encode('ascii') + b'\x00'
+
+    def record(self, identifier, extent, size, flags):
+        length = 33 + len(identifier) + (1 - len(identifier) % 2)
+        return struct.pack('<BB', length, 0) + self.both('I', extent) + self.both('I', size) + self.date() + \
+            struct.pack('<BBB', flags, 0, 0) + self.both('H', 1) + struct.pack('<B', len(identifier)) + \
+            identifier + b'\x00' * (1 - len(identifier) % 2)
+
+    def file_records(self, this_name, identifier):
+        """
+        :return: the directory records for a file, one per extent
+        """
+        size, extent, records = self.sizes[this_name], self.extents[this_name], []
+        while size > kExtentMax:
+            records.append(self.record(identifier, extent, kExtentMax, 0x80))  # more extents follow
+            size -= kExtentMax
+            extent += kExtentMax // kSector
+        records.append(self.record(identifier, extent, size, 0))
+        return records
+
+    def directory_records(self, names, root, root_size):
+        records = [self.record(b'\x00', root, root_size, 2), self.record(b'\x01', root, root_size, 2)]
+        for this_name in sorted(self.names, key=lambda n: names[n]):
+            records.extend(self.file_records(this_name, names[this_name]))
+        return records
+
+    def directory_size(self, names):
+        return len(self.pack(self.directory_records(names, 0, 0)))
+
+    @staticmethod
+    def pack(records):
+        """
+        :return: the records in whole sectors, none of them straddling two
+        """
+        out, used = [], 0
+        for this_record in records:
+            if used + len(this_record) > kSector:
+                out.append(b'\x00' * (kSector - used))
+                used = 0
+            out.append(this_record)
+            used += len(this_record)
+        out.append(b'\x00' * ((kSector - used) % kSector))
+        return b''.join(out)
+
+    @staticmethod
+    def text(kind, value, length):
+        """
+        :return: a descriptor string field, ascii in the primary descriptor and UCS-2 in the joliet one
+        """
+        if kind == 2:
+            return (value.encode('utf-16-be') + b'\x00 ' * length)[:length]
+        return value.ljust(length).encode('ascii')
+
+    def descriptor(self, kind, volume_id, root, root_size, path_tables, escape):
+        text = lambda value, length: self.text(kind, value, length)
+        body = struct.pack('<B5sBB', kind, b'CD001', 1, 0) + text('', 32) + text(volume_id, 32) + b'\x00' * 8
+        body += self.both('I', self.sectors) + escape.ljust(32, b'\x00') + self.both('H', 1) + self.both('H', 1)
+        body += self.both('H', kSector) + self.both('I', 10)
+        body += struct.pack('<II', path_tables, 0) + struct.pack('>II', path_tables + 1, 0)
+        body += self.record(b'\x00', root, root_size, 2)
+        body += text('', 128) + text('', 128) + text('', 128) + text('ARCHIVE_AGENT', 128)
+        body += text('', 37) + text('', 37) + text('', 37)
+        body += self.long_date() + self.long_date() + b'0' * 16 + b'\x00' + self.long_date()
+        body += struct.pack('<BB', 1, 0)
+        return body.ljust(kSector, b'\x00')
+
+    def path_table(self, root, big_endian):
+        return (struct.pack('<BB', 1, 0) + struct.pack('>I' if big_endian else '<I', root) +
+                struct.pack('>H' if big_endian else '<H', 1) + b'\x00\x00').ljust(kSector, b'\x00')
+
+    def header(self):
+        """
+        :return: everything in the image ahead of the first file's data
+        """
+        return b''.join([
+            b'\x00' * (16 * kSector),
+            self.descriptor(1, self.volume_id.upper(), self.iso_root, self.iso_root_size, 19, b''),
+            self.descriptor(2, self.volume_id, self.joliet_root, self.joliet_root_size, 21, b'%/E'),
+            struct.pack('<B5sB', 255, b'CD001', 1).ljust(kSector, b'\x00'),
+            self.path_table(self.iso_root, False), self.path_table(self.iso_root, True),
+            self.path_table(self.joliet_root, False), self.path_table(self.joliet_root, True),
+            self.pack(self.directory_records(self.iso_names, self.iso_root, self.iso_root_size)),
+            self.pack(self.directory_records(self.joliet_names, self.joliet_root, self.joliet_root_size))])
+
+    def write(self, source, path):
+        """
+        Streams the image to path, by way of a temporary file.
+        :param source: the disc folder
+        :return: the image's sha256
+        """
+        sha256 = hashlib.sha256()
+        with open(path + '.tmp', 'wb') as out:
+            def put(data):
+                out.write(data)
+                sha256.update(data)
+
+            put(self.header())
+            for this_name in self.names:
+                remaining = self.sizes[this_name]
+                with open(source + kSep + this_name, 'rb') as this_file:
+                    while remaining > 0:
+                        block = this_file.read(min(kBufferSize, remaining))
+                        if not block:
+                            break
+                        put(block)
+                        remaining -= len(block)
+                    if remaining or this_file.read(1):
+                        raise IOError('{0} has changed size since it was catalogued.'.format(this_name))
+                put(b'\x00' * (-self.sizes[this_name] % kSector))
+        os.rename(path + '.tmp', path)
+        return sha256.hexdigest()
+
+
+class ImageBuilder:
+    """
+    Masters disc images on a background thread, one at a time, so a sealed disc's image is written while the agent
+    carries on with the next disc.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.queue = queue.Queue()
+        self.submitted = set()
+        self.thread = None
+        atexit.register(self.close)
+
+    def submit(self, disc_number):
+        if disc_number in self.submitted:
+            return
+        self.submitted.add(disc_number)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.drain)
+            self.thread.daemon = True
+            self.thread.start()
+        self.queue.put(disc_number)
+
+    def drain(self):
+        while True:
+            disc_number = self.queue.get()
+            if disc_number is None:
+                return
+            self.build(disc_number)
+
+    def build(self, disc_number, force=False):
+        """
+        :return: True if the disc has an image
+        """
+        folder = kDiscFolderPrefix + str(disc_number).zfill(4)
+        path = self.path + kSep + folder + '.iso'
+        if os.path.exists(path) and not force:
+            return True
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            image = IsoImage(disc_number, cat.contents(disc_number))
+            with mtr.timed('image', None) as counts:
+                sha256 = image.write(kBaseDisksPath + kSep + folder, path)
+                counts['bytes'], counts['files'] = image.sectors * kSector, len(image.names)
+            with open(path + '.sha256', 'w') as manifest:
+                manifest.write('{0}  {1}\n'.format(sha256, folder + '.iso'))
+            lg.add('Image of Disc: {0}, written @: {1}\n'.format(disc_number, path))
+            return True
+        except Exception as error:  # runs on its own thread, nothing above it to catch anything
+            lg.add('Unable to image Disc: {0}: {1}\n'.format(disc_number, error))
+            try:
+                os.remove(path + '.tmp')
+            except OSError:
+                pass
+            return False
+
+    def close(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
+def image(disc_numbers=None):
+    """
+    Masters images of sealed discs that don't have one yet, or of the discs given, sealed or not.
+    :param disc_numbers: disc numbers as strings, from the command line
+    :return: True if every image was written
+    """
+    if disc_numbers:
+        return all([images.build(int(this_number), True) for this_number in disc_numbers])
+    sealed = [number for number, (used, mtime, full) in sorted(cat.discs().items()) if full]
+    return all([images.build(this_number) for this_number in sealed])
+
+
+def plan(url=kURL):
+    """
+    Projects the next run's disc layout, sizes and running time without changing anything.
+    """
+    return Planner(url).run()
+
+def locate_volumes(volumes, discs, discs_path=kBaseDisksPath):
+    """
+    :return: the path of each volume in the disc folders it went to
+    """
+    paths = []
+    for this_volume in volumes:
+        for this_disc in discs:
+            this_path = discs_path + kSep + kDiscFolderPrefix + str(this_disc).zfill(4) + kSep + this_volume
+            if os.path.isfile(this_path):
+                paths.append(this_path)
+                break
+        else:
+            raise IOError('Volume {0} is not on Discs: {1}.'.format(this_volume, repr(discs)))
+    return paths
+
+
+def restore(job_number, destination=kRestorePath, discs_path=kBaseDisksPath):
+    """
+    Rebuilds a job folder from its archives, the first and any made after it was re-opened, in order, with files
+    left out by dedup copied from the archives that hold them.
+    :param discs_path: the folder holding the disc folders, the staging folder or wherever the discs are mounted
+    :return: True if every file was restored
+    """
+    job_number = int(job_number)
+    contents = JobContents(job_number)
+    if not contents.generations:
+        lg.add('Job: {0}, has no recorded archives to restore from.\n'.format(job_number))
+        return False
+    readers = {}  # volumes -> ZipReader, sources are often shared
+    ok = True
+    for this_generation in contents.generations:
+        try:
+            reader = ZipReader(locate_volumes(this_generation['volumes'], this_generation['discs'], discs_path))
+        except (IOError, OSError, struct.error) as error:
+            lg.add('Job: {0}, unable to read {1}: {2}\n'.format(job_number, this_generation['volumes'][-1], error))
+            ok = False
+            continue
+        stubs = {}
+        for arcname in sorted(reader.entries):
+            path = destination + kSep + arcname
+            if arcname.endswith('/'):
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                continue
+            if arcname.rsplit('/', 1)[-1] == kDedupManifest:
+                stubs = json.loads(reader.data(arcname).decode('utf-8'))
+                continue
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            if arcname in reader.links:  # made again as a link, its mtime can't be set without following it
+                if os.path.islink(path) or os.path.isfile(path):
+                    os.remove(path)
+                target = reader.data(arcname)
+                os.symlink(target.decode('utf-8', 'surrogateescape') if str is not bytes else target, path)
+                continue
+            reader.extract(arcname, path)
+            restore_mtime(path, this_generation['files'].get(arcname))
+        for arcname, stub in sorted(stubs.items()):
+            path = destination + kSep + arcname
+            try:
+                key = tuple(stub['volumes'])
+                if key not in readers:
+                    readers[key] = ZipReader(locate_volumes(stub['volumes'], stub['discs'], discs_path))
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                readers[key].extract(stub['name'], path)
+                if hash_file(path)[1] != stub['sha256']:
+                    raise IOError('content differs from its sha256')
+                restore_mtime(path, [stub['size'], stub['mtime'], stub['sha256']])
+            except (IOError, OSError, KeyError, struct.error) as error:
+                lg.add('Job: {0}, unable to restore {1} from Job: {2}: {3}\n'.format(
+                    job_number, arcname, stub.get('job'), error))
+                ok = False
+    lg.add('Job: {0}, restored @: {1}{2}\n'.format(job_number, destination, '' if ok else ', with errors'))
+    return ok
+
+
+def restore_mtime(path, recorded):
+    if recorded:
+        os.utime(path, (recorded[1], recorded[1]))
+
+
+def list_tree(path):
+    """
+    :return: (files, directories) under path, symlinks counted as files and not followed
+    """
+    files, dirs = [], []
+    pending = [path]
+    while pending:
+        this_dir = pending.pop()
+        dirs.append(this_dir)
+        if scandir is not None:
+            with gov.op('list'):
+                this_list = list(scandir(this_dir))
+            for this_entry in this_list:
+                if this_entry.is_dir(follow_symlinks=False):
+                    pending.append(this_entry.path)
+                else:
+                    files.append(this_entry.path)
+        else:
+            with gov.op('list'):
+                names = os.listdir(this_dir)
+            for this_name in names:
+                this_path = this_dir + kSep + this_name
+                if os.path.isdir(this_path) and not os.path.islink(this_path):
+                    pending.append(this_path)
+                else:
+                    files.append(this_path)
+    return files, dirs
+
+
+def remove_path(args):
+    """
+    :param args: (function, path), os.remove or os.rmdir
+    :return: (path, None) or (path, the error)
+    """
+    function, path = args
+    try:
+        with gov.op('delete'):
+            function(path)
+        return path, None
+    except OSError as error:
+        if error.errno == errno.ENOENT:  # someone else got there first
+            return path, None
+        return path, error
+
+
+def remove_tree(path, workers=kDeleteWorkers):
+    """
+    Deletes a directory tree with a pool of threads, so a share's round trip per unlink is paid several at a time.
+    Every file goes first, then the directories a level at a time, deepest first. Nothing that fails is retried.
+
+    :param path: the tree to remove
+    :return: (files removed, [(path, error)] for everything that couldn't be removed)
+    """
+    try:
+        files, dirs = list_tree(path)
+    except OSError as error:
+        if error.errno == errno.ENOENT:
+            return 0, []
+        lg.add('Unable to list {0}: {1}\n'.format(path, error))
+        return 0, [(path, error)]
+
+    removed, failures = 0, []
+    pool = ThreadPool(workers)
+    try:
+        for this_path, error in pool.imap_unordered(remove_path, [(os.remove, f) for f in files], 16):
+            if error is None:
+                removed += 1
+                if removed % kDeleteProgress == 0:
+                    lg.add('Removing {0}: {1} of {2} files.\n'.format(path, removed, len(files)))
+            else:
+                failures.append((this_path, error))
+
+        levels = {}
+        for this_dir in dirs:
+            levels.setdefault(this_dir.count(kSep), []).append(this_dir)
+        for depth in sorted(levels, reverse=True):  # siblings can go together, parents have to wait for them
+            for this_path, error in pool.imap_unordered(remove_path, [(os.rmdir, d) for d in levels[depth]]):
+                if error is not None:
+                    failures.append((this_path, error))
+    finally:
+        pool.close()
+        pool.join()
+
+    for this_path, error in failures[:10]:
+        lg.add('Unable to remove {0}: {1}\n'.format(this_path, error))
+    if len(failures) > 10:
+        lg.add('... and {0} more.\n'.format(len(failures) - 10))
+    return removed, failures
+
+
+def read_xattrs(path, fd=None):
+    """
+    :param fd: the file, open, to read them through rather than look the path up again
+    :return: [(name, value)] of the path's extended attributes, empty where they can't be read
+    """
+    try:
+        with gov.op('stat'):
+            if hasattr(os, 'listxattr') and fd is not None:
+                return [(this_name, os.getxattr(fd, this_name)) for this_name in os.listxattr(fd)]
+            if hasattr(os, 'listxattr'):
+                return [(this_name, os.getxattr(path, this_name, follow_symlinks=False))
+                        for this_name in os.listxattr(path, follow_symlinks=False)]
+            if xattr is not None:
+                if fd is not None:  # an open file has nothing to follow
+                    return list(xattr.xattr(fd).items())
+                return list(xattr.xattr(path, xattr.XATTR_NOFOLLOW).items())
+    except (IOError, OSError, ValueError):
+        pass
+    return []
+
+
+def apple_double(path, fd=None):
+    """
+    Packs a file's resource fork and extended attributes the way macOS does in ._ files: an AppleDouble header with
+    a Finder info entry, which carries the attributes in an ATTR block after the 32 bytes of Finder info, and a
+    resource fork entry.
+    :param fd: the file, open, to read the attributes through
+    :return: the ._ file's bytes, or None if there's nothing to keep
+    """
+    attributes = []
+    finder_info = b'\0' * 32
+    for this_name, value in read_xattrs(path, fd):
+        if not isinstance(this_name, bytes):
+            this_name = this_name.encode('utf-8')
+        if this_name == b'com.apple.FinderInfo':
+            finder_info = (value + b'\0' * 32)[:32]
+        elif this_name != b'com.apple.ResourceFork':  # comes from the named fork
+            attributes.append((this_name[:127], value))
+    fork = b''
+    if sys.platform == 'darwin' and not os.path.isdir(path):
+        try:
+            with gov.op('read'), open(path + '/..namedfork/rsrc', 'rb') as source:
+                fork = source.read()
+        except (IOError, OSError):
+            fork = b''
+    if not attributes and not fork and finder_info == b'\0' * 32:
+        return None
+
+    entries, data = [], []
+    offset = 120 + sum((12 + len(this_name) + 3) & ~3 for this_name, value in attributes)  # 4 byte aligned
+    data_start = offset
+    for this_name, value in sorted(attributes):
+        entry = struct.pack('>IIHB', offset, len(value), 0, len(this_name) + 1) + this_name + b'\0'
+        entries.append(entry + b'\0' * (-len(entry) % 4))
+        data.append(value)
+        offset += len(value)
+    header = struct.pack('>II16sH', 0x00051607, 0x00020000, b'Mac OS X        ', 2)
+    header += struct.pack('>III', 9, 50, offset - 50)  # Finder info and the ATTR block
+    header += struct.pack('>III', 2, offset, len(fork))  # resource fork
+    header += finder_info + b'\0\0'
+    header += struct.pack('>4sIIII12xHH', b'ATTR', 0, offset, data_start, offset - data_start, 0, len(attributes))
+    return header + b''.join(entries) + b''.join(data) + fork
+
+
+def move_file(source, destination):
+    """
+    Renames a file on the same device. Across devices it's copied a kBufferSize block at a time, each paced by the
+    I/O governor, then synced and the source removed.
+    """
+    try:
+        same_device = os.stat(source).st_dev == os.stat(os.path.dirname(destination)).st_dev
+    except OSError:
+        same_device = False
+    if same_device:
+        with gov.op('move'):
+            os.rename(source, destination)
+        return
+    with open(source, 'rb') as reader, open(destination + '.tmp', 'wb') as out:
+        block = gov.read(reader, kBufferSize)
+        while block:
+            out.write(block)
+            block = gov.read(reader, kBufferSize)
+        out.flush()
+        os.fsync(out.fileno())
+    shutil.copystat(source, destination + '.tmp')
+    os.rename(destination + '.tmp', destination)
+    with gov.op('delete'):
+        os.remove(source)
+
+
+def sync_path(path):
+    """
+    Flushes a file, or a folder's entries, to stable storage. Folders can't be opened for this on Windows, where
+    it's left to the file system.
+    """
+    try:
+        descriptor = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(descriptor)
+    except OSError:
+        pass
+    finally:
+        os.close(descriptor)
+
+
+def hash_file(path, on_share=False):
+    """
+    :param path: the file to checksum
+    :param on_share: pace the reads with the I/O governor
+    :return: (path, sha256, crc32) in hex, or (path, None, None) if it can't be read
+    """
+    sha256, crc = hashlib.sha256(), 0
+    try:
+        with open(path, 'rb') as source:
+            while True:
+                block = gov.read(source, kBufferSize) if on_share else source.read(kBufferSize)
+                if not block:
+                    break
+                sha256.update(block)
+                crc = zlib.crc32(block, crc)
+    except IOError:
+        return path, None, None
+    return path, sha256.hexdigest(), '{0:08x}'.format(crc & 0xFFFFFFFF)
+
+
+def verify(url=kBaseDisksPath, workers=kVerifyWorkers):
+    """
+    Re-reads every file listed in the manifests of the Disc folders under url, spread over a pool of processes.
+
+    :param url: the staging folder
+    :return: True if every file matched its manifest
+    """
+    expected = {}  # path -> (sha256, crc32)
+    for this_dir in sorted(os.listdir(url)):
+        location = url + kSep + this_dir
+        if not this_dir.startswith(kDiscFolderPrefix) or not os.path.isdir(location):
+            continue
+        crcs = {}
+        try:
+            with open(location + kSep + kSFVName) as sfv:
+                for this_line in sfv:
+                    name, crc = this_line.rstrip('\n').rsplit(' ', 1)
+                    crcs[name] = crc
+        except IOError:
+            pass
+        try:
+            with open(location + kSep + kManifestName) as manifest:
+                for this_line in manifest:
+                    sha256, name = this_line.rstrip('\n').split('  ', 1)
+                    expected[location + kSep + name] = (sha256, crcs.get(name))
+        except IOError:
+            lg.add('Disc folder: {0}, has no manifest.\n'.format(location))
+
+    pool = multiprocessing.Pool(workers)
+    failures = 0
+    try:
+        for path, sha256, crc in pool.imap_unordered(hash_file, sorted(expected)):
+            if sha256 is None:
+                lg.add('Verify: {0}, missing or unreadable.\n'.format(path))
+                failures += 1
+            elif (sha256, crc) != expected[path] and (sha256, None) != expected[path]:
+                lg.add('Verify: {0}, does not match its manifest.\n'.format(path))
+                failures += 1
+    finally:
+        pool.close()
+        pool.join()
+    lg.add('Verified {0} files, {1} failed.\n'.format(len(expected), failures))
+    return failures == 0
+
+
+def generate_job_url(job):
+    """
+
+    :param job: the
+     job number to generate the URL for
+    :return: the string of the URL to the job on the server
+    """
+
+    if type(job) != type(''):
+        job = str(job)
+    folderNumber = job[len(job) - 1:len(job)]  # get the last number of the job
+    return kBaseJobsPath + kJobFolderPrefix + folderNumber + kSep + job
+
+
+def generate_working_url(job):
+    """
+
+    :param job: the job number to generate a working folder for
+    :return: the string of the URL of that working folder
+    """
+    if type(job) != type(''):
+        job = str(job)
+    return kWorkingPath + kSep + job
+
+
+def generate_disc_url(disc):
+    """
+
+    :param disc: the disc number to generate path to string for
+    :return: the path to string
+    """
+    if not isinstance(disc, str):
+        disc = str(disc).zfill(4)
+    return kBaseDisksPath + kDiscFolderPrefix + disc
+
+
+def get_size(path):
+    """
+
+    :param path: a file or a directory
+    :return: the size in bytes, directories are totalled from the scan index and missing ones are empty
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return scn.size(path)
+
+
+def confirm_dump(job):
+    confirm = None
+    confirm_inputs = ['y', 'n']
+    while not (confirm in confirm_inputs):
+        confirm = raw_input('Delete Job: {0} @ {1}? (y/n): '.format(job.job_number, job.location))
+        confirm = str(confirm).lower()
+        if not (confirm in confirm_inputs):
+            print('Selection not recognized. Please enter (y/n).\n')
+    return confirm == 'y'
+
+
+def dump_and_tag(jobs, approved):
+    """
+    Deletes each archived job from the server and tags its folder with the discs it went to.
+
+    :param jobs: the jobs to consider
+    :param approved: called with each archived job, True if it may be dumped
+    """
+    for this_job in jobs:
+        if not (this_job.on_disc) and not (this_job.ignore) and this_job.is_archived and approved(this_job):
+            if this_job.dump():  # only tag a folder that's really gone
+                this_job.tag()
+
+
+def run():
+    """
+    The nightly batch: archive every job waiting in the ledger, place it on discs, then dump and tag on request.
+    :return: False if there was no disc to archive to
+    """
+    mngr = Manager(kURL)
+    if not mngr.disc_catalog:
+        return False
+
+    # code for bucketing the jobs
+    pending = [this_job for this_job in mngr.job_list if not this_job.ignore and not this_job.is_archived]
+    Pipeline(mngr).run(pending)
+
+    # code for cleaning up the directory and adding disk tags
+    accepted_inputs = ['y', 'n', 'a']
+    selection = None
+    while not (selection in accepted_inputs):
+        selection = raw_input('Proceed with job dumps and folder tagging? (y/n/a):')
         selection = str(selection).lower()
         if not (selection in accepted_inputs):
             print('Selection Invalid, please select (y/n/a).\n')
 
     if selection != 'n':
-        for this_job in mngr.job_list:
-            if not (this_job.on_disc) and not (this_job.ignore):
-                if selection == 'y':
-                    confirm = None
-                    confirm_inputs = ['y', 'n']
-                    while not (confirm in confirm_inputs):
-                        confirm = raw_input('Delete Job: {0} @ {1}? (y/n): '.format(this_job.job_number, this_job.location))
-                        confirm = str(confirm).lower()
-                        if not (confirm in confirm_inputs):
-                            print('Selection not recognized. Please enter (y/n).\n')
-                    if confirm == 'y':
-                        this_job.dump()
-                        this_job.tag()
-                    else:
-                        continue
-                elif selection == 'a':
-                    this_job.dump()
-                    this_job.tag()
+        dump_and_tag(mngr.job_list, lambda this_job: selection == 'a' or confirm_dump(this_job))
     else:
         lg.add('Leaving jobs on server.\n')
 
     # code for updating the excel doc
     mngr.update_workbook()
+    scn.save()
+    est.save()
+    policy.report()
+    mtr.summary()
+    return True
+
+
+gov = IOGovernor(kIOProfiles)
+scn = Scanner(kIndexURL)
+policy = CompressionPolicy()
+est = SizeEstimator(kRatioURL)
+lg = Log(kWorkingPath + kSep + 'Log_{0}-{1}-{2}.txt'.format(dt.month, dt.day, dt.year))
+mtr = Metrics(EventWriter(kWorkingPath + kSep + 'Events_{0}-{1}-{2}.jsonl'.format(dt.month, dt.day, dt.year)))
+jnl = Journal(kJournalURL)
+cat = DiscCatalog(kCatalogURL)
+crd = None  # a Coordinator in worker mode
+unattended = False  # daemon and worker modes, nobody to answer a prompt
+cix = ContentIndex(kContentIndexURL) if kDedup else None
+images = ImageBuilder(kImagePath)
 
-lg.close()
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'verify':  # archive_agent.py verify [staging folder]
+        ok = verify(*sys.argv[2:3])
+    elif len(sys.argv) > 1 and sys.argv[1] == 'image':  # archive_agent.py image [disc numbers]
+        ok = image(sys.argv[2:])
+    elif len(sys.argv) > 2 and sys.argv[1] == 'restore':  # archive_agent.py restore job [destination]
+        ok = restore(*sys.argv[2:4])
+    elif len(sys.argv) > 1 and sys.argv[1] == 'plan':  # archive_agent.py plan
+        ok = plan()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'daemon':
+        ok = True
+        unattended = True
+        jnl.compact()
+        Daemon().run()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'worker':  # archive_agent.py worker [name]
+        ok = True
+        unattended = True
+        name = sys.argv[2] if len(sys.argv) > 2 else '{0}-{1}'.format(socket.gethostname(), os.getpid())
+        jnl.close()
+        jnl = Journal(kWorkingPath + kSep + kWorkerJournal.format(name))
+        jnl.compact()
+        crd = Coordinator(kCatalogURL, name)
+        try:
+            Worker().run()
+        finally:
+            crd.close()
+    else:
+        jnl.compact()
+        ok = run()
+    images.close()
+    jnl.close()
+    cat.close()
+    if cix is not None:
+        cix.close()
+    lg.close()
+    sys.exit(0 if ok else 1)
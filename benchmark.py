@@ -0,0 +1,245 @@
+"""
+Builds a reproducible fake JobsA share, Staging area and Excel ledger on local disk and times each stage of
+archive_agent against it: inspect, cleanup, archive, placement and the ledger update.
+
+archive_agent works out its paths from the home folder when it's imported, so the synthetic tree is laid out the
+way those paths expect (<root>/tmp/JobsA, <root>/tmp/Staging, <root>/tmp/Logs/test.xlsx) and HOME is pointed at
+<root> before the import.
+
+Usage:
+    python benchmark.py --jobs 50 --files 40 --split-jobs 2 --disc-size 67108864 --output results.jsonl
+
+Each run appends one JSON line to the output file. If an earlier run with the same settings is in there, the
+stage times are printed side by side with it.
+"""
+import argparse, binascii, datetime, json, math, os, random, shutil, sys, tempfile, time
+
+__author__ = 'Benjamin A. Slack, iam@niamjneb.com'
+
+kColors = ['Cyan', 'Magenta', 'Yellow', 'Black', 'PMS185', 'PMS286', 'White', 'Varnish']
+kSides = ['front', 'back', 'label', 'sleeve']
+kArtTypes = ['pdf', 'ai', 'tif', 'psd', 'txt', 'jpg', 'eps', 'xml']
+kPoolSize = 65536
+
+
+class Generator:
+    """
+    Lays out the fake share. Everything comes from one seeded random number generator, so the same settings always
+    give byte for byte the same tree.
+    """
+
+    def __init__(self, root, args):
+        self.root = root
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.pool = bytearray(self.rng.getrandbits(8) for _ in range(kPoolSize))
+        self.bytes = 0
+        self.files = 0
+
+    def content(self, size, compressibility=None):
+        """
+        :param size: bytes to generate
+        :param compressibility: defaults to args.compressibility
+        :return: data of which roughly that fraction is runs of repeated text and the rest is random
+        """
+        if compressibility is None:
+            compressibility = self.args.compressibility
+        out = bytearray()
+        while len(out) < size:
+            block = min(4096, size - len(out))
+            if self.rng.random() < compressibility:
+                out += (b'archive agent ' * (block // 14 + 1))[:block]
+            else:
+                start = self.rng.randrange(kPoolSize - block + 1)
+                out += self.pool[start:start + block]
+        return bytes(out)
+
+    def noise(self, size):
+        """
+        :return: size random bytes, which deflate can't shrink the way it shrinks repeats of the pool
+        """
+        if size == 0:
+            return b''
+        return binascii.unhexlify('{0:0{1}x}'.format(self.rng.getrandbits(8 * size), 2 * size))
+
+    def file_size(self):
+        mu = math.log(self.args.mean_size) - self.args.size_sigma ** 2 / 2  # keep the mean at mean_size
+        return max(0, min(int(self.rng.lognormvariate(mu, self.args.size_sigma)), self.args.max_size))
+
+    def write(self, path, size, data=None, compressibility=None, noise=False):
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        with open(path, 'wb') as out:
+            if data is None:
+                while size > 0:  # keep memory flat for big files
+                    if noise:
+                        chunk = self.noise(min(size, 1048576))
+                    else:
+                        chunk = self.content(min(size, 1048576), compressibility)
+                    out.write(chunk)
+                    size -= len(chunk)
+            else:
+                out.write(data)
+        self.bytes += os.path.getsize(path)
+        self.files += 1
+
+    def job(self, job_number, split):
+        location = '{0}/tmp/JobsA/Jobs{1}/{2}'.format(self.root, job_number % 10, job_number)
+        for index in range(self.args.files):
+            ext = self.rng.choice(kArtTypes)
+            self.write('{0}/Art/art_{1}.{2}'.format(location, index, ext), self.file_size())
+        for index in range(self.args.trash):
+            self.write('{0}/Trash/old_{1}.tif'.format(location, index), self.file_size())
+
+        # Image_Carriers: current and superseded separations, other jobs' carriers and short names that are kept
+        carriers = location + '/Deliverables/Image_Carriers'
+        for index in range(self.args.carriers):
+            side, color = self.rng.choice(kSides), self.rng.choice(kColors)
+            pattern = self.rng.choice(self.args.carrier_patterns)
+            name = pattern.format(job=job_number, side=side, color=color, n=index, other=job_number + 7)
+            path = carriers + '/' + name
+            self.write(path, 0, b'II*\x00' + self.content(self.args.carrier_size))
+            stamp = 1400000000 + self.rng.randrange(10 ** 7)
+            os.utime(path, (stamp, stamp))
+
+        if split:  # bigger than a disc even once compressed
+            self.write(location + '/Art/master.bin', int(self.args.disc_size * 1.5), noise=True)
+
+    def ledger(self, job_numbers):
+        import openpyxl
+        wb = openpyxl.Workbook()
+        ws = wb.active
+        for row, job_number in enumerate(job_numbers, 1):
+            ws.cell(row=row, column=1).value = job_number
+        wb.save(self.root + '/tmp/Logs/test.xlsx')
+
+    def build(self):
+        for folder in ('JobsA', 'Staging/Disc0001', 'Logs'):
+            os.makedirs('{0}/tmp/{1}'.format(self.root, folder))
+        job_numbers = [self.args.first_job + index for index in range(self.args.jobs)]
+        for index, job_number in enumerate(job_numbers):
+            self.job(job_number, index < self.args.split_jobs)
+        self.ledger(job_numbers)
+        return job_numbers
+
+
+class Stopwatch:
+    def __init__(self):
+        self.stages = {}
+
+    def time(self, stage, function, *args):
+        started = time.time()
+        result = function(*args)
+        this_stage = self.stages.setdefault(stage, {'seconds': 0.0, 'calls': 0})
+        this_stage['seconds'] += time.time() - started
+        this_stage['calls'] += 1
+        return result
+
+
+def run_stages(args):
+    """
+    Imports the agent against the synthetic tree and times each stage one job at a time, so a stage's time isn't
+    hidden behind another's.
+    """
+    import archive_agent as agent
+    scale = float(args.disc_size) / agent.kFullSize  # thresholds sized for real discs shrink with them
+    agent.kSealFree = int(agent.kSealFree * scale)
+    agent.kMinVolume = int(agent.kMinVolume * scale)
+    agent.kFullSize = args.disc_size
+    agent.kVolumeSize = args.disc_size - agent.kManifestAllowance
+    watch = Stopwatch()
+    real_stdout = sys.stdout
+    if not args.verbose:
+        sys.stdout = open(os.devnull, 'w')  # Log.add prints every line
+    try:
+        mngr = watch.time('inspect', agent.Manager, agent.kURL)
+        watch.time('inspect', lambda: [this_job.ignore for this_job in mngr.job_list])  # jobs inspect lazily
+        archives = []
+        for this_job in mngr.job_list:
+            if this_job.ignore or this_job.is_archived:
+                continue
+            watch.time('cleanup', this_job.cleanup)
+            archives.append(watch.time('archive', agent.Archive, this_job))
+        for this_archive in archives:
+            watch.time('placement', mngr.place, [this_archive])
+        watch.time('ledger', mngr.update_workbook)
+        agent.scn.save()
+        agent.images.close()  # sealed discs are imaged in the background
+    finally:
+        if not args.verbose:
+            sys.stdout.close()
+            sys.stdout = real_stdout
+    volumes = [this_file for this_archive in archives for this_file in this_archive.files]
+    return watch.stages, {'jobs': len(mngr.job_list), 'archives': len(archives), 'volumes': len(volumes),
+                          'compressed_bytes': sum(this_file.size for this_file in volumes),
+                          'discs': len(mngr.disc_catalog)}
+
+
+def previous_result(path, settings):
+    try:
+        with open(path) as results:
+            matches = [r for r in (json.loads(line) for line in results if line.strip()) if r['settings'] == settings]
+    except IOError:
+        return None
+    return matches[-1] if matches else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark archive_agent against a synthetic job share.')
+    parser.add_argument('--jobs', type=int, default=20)
+    parser.add_argument('--first-job', type=int, default=40000)
+    parser.add_argument('--files', type=int, default=30, help='art files per job')
+    parser.add_argument('--trash', type=int, default=5, help='files in each Trash folder')
+    parser.add_argument('--carriers', type=int, default=24, help='Image_Carriers files per job')
+    parser.add_argument('--carrier-size', type=int, default=65536)
+    parser.add_argument('--carrier-patterns', nargs='+',
+                        default=['{job}_{side}_{color}.tif', 'old_{job}_{side}_{color}.tif',
+                                 '{job}_{side}_{color}_c{n}.len', '{other}_{side}_{color}.tif', '{side}_{color}.tif'],
+                        help='name formats using {job}, {side}, {color}, {n} and {other}')
+    parser.add_argument('--mean-size', type=int, default=262144, help='mean art file size in bytes')
+    parser.add_argument('--size-sigma', type=float, default=1.5, help='spread of the lognormal file sizes')
+    parser.add_argument('--max-size', type=int, default=67108864)
+    parser.add_argument('--compressibility', type=float, default=0.5, help='0 is random data, 1 is repeated text')
+    parser.add_argument('--split-jobs', type=int, default=1, help='jobs that need split volumes')
+    parser.add_argument('--disc-size', type=int, default=33554432, help='stands in for kFullSize')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--root', help='build the tree here instead of a temporary folder')
+    parser.add_argument('--keep', action='store_true', help="don't delete the tree afterwards")
+    parser.add_argument('--output', default='benchmark_results.jsonl')
+    parser.add_argument('--verbose', action='store_true', help="show the agent's log")
+    args = parser.parse_args()
+
+    root = os.path.abspath(args.root) if args.root else tempfile.mkdtemp(prefix='archive_agent_bench_')
+    if args.root and os.path.isdir(root) and os.listdir(root):
+        parser.error('{0} is not empty'.format(root))
+    settings = dict((k, v) for k, v in vars(args).items() if k not in ('root', 'keep', 'output', 'verbose'))
+    try:
+        started = time.time()
+        generator = Generator(root, args)
+        generator.build()
+        generated = time.time() - started
+        os.environ['HOME'] = root
+        stages, counts = run_stages(args)
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, True)
+
+    counts.update({'source_bytes': generator.bytes, 'source_files': generator.files})
+    result = {'date': datetime.datetime.now().isoformat(), 'python': sys.version.split()[0],
+              'settings': settings, 'generate_seconds': generated, 'stages': stages, 'counts': counts}
+    earlier = previous_result(args.output, settings)
+    with open(args.output, 'a') as results:
+        results.write(json.dumps(result, sort_keys=True) + '\n')
+
+    print('{0:<10} {1:>10} {2:>10}'.format('stage', 'seconds', 'previous'))
+    for stage in ('inspect', 'cleanup', 'archive', 'placement', 'ledger'):
+        seconds = stages.get(stage, {}).get('seconds', 0.0)
+        before = earlier['stages'].get(stage, {}).get('seconds') if earlier else None
+        print('{0:<10} {1:>10.3f} {2:>10}'.format(stage, seconds, '{0:.3f}'.format(before) if before is not None
+                                                   else '-'))
+    print(json.dumps(counts, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+"""
+Round trips archives written by ZipWriter through zipfile and ZipReader, and checks the disc allocator's index.
+archive_agent reads its folders from HOME when it's imported, so it gets a scratch one first.
+
+Run from the repository root with python -m pytest tests, or python -m unittest discover tests.
+"""
+
+import os, sys, time, struct, shutil, subprocess, tempfile, unittest, zipfile
+
+kHome = tempfile.mkdtemp(prefix='archive_agent_test_')
+os.environ['HOME'] = kHome
+for this_folder in ('tmp/Staging', 'tmp/Logs'):
+    os.makedirs(os.path.join(kHome, this_folder))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import archive_agent  # noqa: E402, after HOME is set
+
+
+def tearDownModule():
+    archive_agent.images.close()
+    shutil.rmtree(kHome, ignore_errors=True)
+
+
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(dir=archive_agent.kWorkingPath)
+        self.source = self.folder + '/source'
+        os.makedirs(self.source)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def make_file(self, name, data):
+        path = self.source + '/' + name
+        with open(path, 'wb') as out:
+            out.write(data)
+        return path
+
+    def write_archive(self, name, files, volume_size=archive_agent.kVolumeSize, links=()):
+        """
+        :param files: [(archive name, data)], written under job/
+        :param links: [(archive name, target)], written under job/ after the files
+        :return: the paths of the archive's volumes
+        """
+        writer = archive_agent.ZipWriter(archive_agent.VolumeWriter(self.folder, name, volume_size))
+        writer.add_dir('job', time.time())
+        for arcname, data in files:
+            writer.add_file(self.make_file(arcname, data), 'job/' + arcname, len(data), time.time())
+        for arcname, target in links:
+            writer.add_link('job/' + arcname, target, time.time())
+        return writer.close()
+
+    def check_contents(self, reader, files):
+        for arcname, data in files:
+            self.assertEqual(reader.read('job/' + arcname) if hasattr(reader, 'namelist') else
+                             reader.data('job/' + arcname), data)
+
+    def test_single_round_trip(self):
+        text = b''.join([b'line ' + str(n).encode('ascii') + b'\n' for n in range(1500000)])
+        files = [('small.txt', b'hello world ' * 5000),  # whole, deflated on the pool
+                 ('empty.bin', b''),
+                 ('noise.bin', os.urandom(300000)),  # won't compress, stored
+                 ('big.txt', text[:archive_agent.kParallelMin + 12345])]  # deflated in pieces
+        paths = self.write_archive('single', files, links=[('link', 'small.txt')])
+        self.assertEqual([os.path.basename(this_path) for this_path in paths], ['single.zip'])
+
+        archive = zipfile.ZipFile(paths[0])
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(sorted(archive.namelist()),
+                         sorted(['job/', 'job/link'] + ['job/' + arcname for arcname, data in files]))
+        self.check_contents(archive, files)
+        self.assertEqual(archive.getinfo('job/link').external_attr >> 16, 0o120777)
+        self.assertEqual(archive.read('job/link'), b'small.txt')
+        archive.close()
+
+        reader = archive_agent.ZipReader(paths)
+        self.check_contents(reader, files)
+        self.assertEqual(reader.links, set(['job/link']))
+
+    def test_split_round_trip(self):
+        files = [('first.bin', os.urandom(1500000)), ('second.bin', os.urandom(1500000)), ('last.txt', b'end\n')]
+        paths = self.write_archive('split', files, 1 << 20)
+        self.assertTrue(len(paths) > 2)
+        self.assertEqual(os.path.basename(paths[-1]), 'split_split.zip')
+        for this_path in paths[:-1]:
+            self.assertTrue(os.path.getsize(this_path) <= 1 << 20)
+
+        self.check_contents(archive_agent.ZipReader(paths), files)
+
+        try:  # zipfile can't read split archives, zip can join one back up
+            subprocess.check_call(['zip', '-q', '-s', '0', paths[-1], '--out', self.folder + '/joined.zip'])
+        except OSError:
+            self.skipTest('zip is not installed')
+        archive = zipfile.ZipFile(self.folder + '/joined.zip')
+        self.assertIsNone(archive.testzip())
+        self.check_contents(archive, files)
+        archive.close()
+
+    def test_zip64_entry(self):
+        """
+        A sparse file past 4 GiB, deflated to a few MB. Reading it takes around half a minute per cpu.
+        """
+        size = archive_agent.kZipLimit + 4096
+        path = self.source + '/sparse.raw'
+        with open(path, 'wb') as out:
+            out.truncate(size)
+        writer = archive_agent.ZipWriter(archive_agent.VolumeWriter(self.folder, 'large', archive_agent.kVolumeSize))
+        writer.add_file(path, 'sparse.raw', size, time.time())
+        paths = writer.close()
+
+        with open(paths[0], 'rb') as archive_file:
+            header = archive_file.read(30 + len('sparse.raw') + 4)
+            archive_file.seek(-200, os.SEEK_END)
+            tail = archive_file.read()
+        compressed, uncompressed = struct.unpack('<II', header[18:26])
+        self.assertEqual((compressed, uncompressed), (archive_agent.kZipLimit, archive_agent.kZipLimit))
+        self.assertEqual(struct.unpack('<H', header[-4:-2])[0], 1)  # zip64 extra field
+        record = tail[tail.rfind(b'PK\x01\x02'):]  # the entry's central directory record
+        compressed, uncompressed, name_length = struct.unpack('<IIH', record[20:30])
+        self.assertEqual(uncompressed, archive_agent.kZipLimit)  # compressed, a few MB, fits as it is
+        extra = record[46 + name_length:]
+        self.assertEqual(struct.unpack('<HHQ', extra[:12]), (1, 8, size))  # zip64 extra field with the real size
+
+        archive = zipfile.ZipFile(paths[0])
+        self.assertEqual(archive.getinfo('sparse.raw').file_size, size)
+        archive.close()
+        self.assertEqual(archive_agent.ZipReader(paths).entries['sparse.raw'][3], size)
+
+
+class Catalog(object):
+    """
+    Stands in for the Manager, whose disc catalog the allocator indexes.
+    """
+
+    def __init__(self, discs):
+        self.disc_catalog = discs
+
+    def add_disc(self):
+        disc = archive_agent.Disc(max(this_disc.disc_number for this_disc in self.disc_catalog) + 1, 0, [], False)
+        self.disc_catalog.append(disc)
+        return disc
+
+
+class Job(object):
+    def __init__(self):
+        self.job_number = None
+        self.reservation = []
+
+
+class AllocatorTest(unittest.TestCase):
+
+    @staticmethod
+    def disc(disc_number, free, is_full=False):
+        return archive_agent.Disc(disc_number, archive_agent.kFullSize - free, [], is_full)
+
+    def check_index(self, allocator):
+        """
+        Every leaf is its disc's free space, every inner node the larger of its children, and by_free is sorted and
+        in step with the discs.
+        """
+        for index, this_disc in enumerate(allocator.discs):
+            self.assertEqual(allocator.tree[allocator.capacity + index], this_disc.free())
+        for index in range(len(allocator.discs), allocator.capacity):
+            self.assertEqual(allocator.tree[allocator.capacity + index], 0)
+        for node in range(1, allocator.capacity):
+            self.assertEqual(allocator.tree[node], max(allocator.tree[2 * node], allocator.tree[2 * node + 1]))
+        self.assertEqual(allocator.by_free, sorted((this_disc.free(), this_disc.disc_number, index)
+                                                   for index, this_disc in enumerate(allocator.discs)))
+
+    def test_first_fit_takes_the_lowest_disc_with_room(self):
+        allocator = archive_agent.DiscAllocator(Catalog([self.disc(3, 100), self.disc(1, 1000), self.disc(2, 5000)]))
+        self.check_index(allocator)
+        self.assertEqual([this_disc.disc_number for this_disc in allocator.discs], [1, 2, 3])
+        self.assertEqual(allocator.first_fit(50), 0)
+        self.assertEqual(allocator.first_fit(1000), 0)
+        self.assertEqual(allocator.first_fit(1001), 1)
+        self.assertIsNone(allocator.first_fit(5001))
+        self.assertEqual(allocator.best_fit(50), 2)
+
+        index = allocator.choose(5001, 'first_fit')  # opens disc 4
+        self.assertEqual((index, allocator.discs[index].disc_number), (3, 4))
+        self.check_index(allocator)
+
+    def test_reservations_keep_the_index_current(self):
+        allocator = archive_agent.DiscAllocator(Catalog([self.disc(1, 1000), self.disc(2, 5000)]))
+        job = Job()
+        self.assertTrue(allocator.hold(job, allocator.first_fit(800), 800, archive_agent.kVolumeSize))
+        self.check_index(allocator)
+        self.assertEqual(allocator.first_fit(800), 1)  # disc 1 has 200 left
+        for this_number in range(3, 8):  # grows the tree past its capacity
+            allocator.add(self.disc(this_number, 100 * this_number))
+            self.check_index(allocator)
+        allocator.release(job)
+        self.check_index(allocator)
+        self.assertEqual(allocator.first_fit(800), 0)
+
+    def test_sealed_discs_are_never_chosen(self):
+        allocator = archive_agent.DiscAllocator(Catalog([self.disc(1, 5000, True), self.disc(2, 1000)]))
+        self.check_index(allocator)
+        self.assertEqual(allocator.discs[0].free(), 0)
+        self.assertEqual(allocator.first_fit(1), 1)
+        self.assertEqual(allocator.best_fit(1), 1)
+
+    def place(self, disc_number, reserved):
+        """
+        :return: the disc after a 1000 byte file leaves it with less than kSealFree, holding reserved bytes for
+        another archive, and the allocator it was placed through
+        """
+        disc = archive_agent.Disc(disc_number)
+        disc.size = archive_agent.kFullSize - archive_agent.kSealFree - reserved - 500
+        disc.reserved = reserved
+        allocator = archive_agent.DiscAllocator(Catalog([disc]))
+        path = archive_agent.kWorkingPath + '/placed_{0}.zip'.format(disc_number)
+        with open(path, 'wb') as out:
+            out.write(b'\0' * 1000)
+        self.assertTrue(allocator.place(archive_agent.File(path)))
+        self.assertTrue(os.path.isfile(disc.location + '/placed_{0}.zip'.format(disc_number)))
+        self.check_index(allocator)
+        return disc, allocator
+
+    def test_placing_seals_a_nearly_full_disc(self):
+        disc, allocator = self.place(9001, 0)
+        self.assertTrue(disc.is_full)
+        self.assertEqual(disc.free(), 0)
+        self.assertTrue(archive_agent.cat.discs()[9001][2])
+        self.assertIsNone(allocator.first_fit(1))
+
+    def test_a_reserved_disc_is_not_sealed(self):
+        disc, allocator = self.place(9002, 4096)
+        self.assertFalse(disc.is_full)
+        self.assertEqual(allocator.first_fit(1), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()